@@ -12,6 +12,8 @@ class MqttConfig(AppConfig):
 
 
     def ready(self):
+        from . import signals  # noqa: F401  (registers lamp cache invalidation)
+
         # Require an explicit opt-in to autostart the bridge during runserver.
         # This avoids surprising behavior where the bridge starts in the same
         # process (and possibly before ChannelNameRouter/consumers are ready)
@@ -0,0 +1,206 @@
+"""Asyncio-native MQTT bridge (``manage.py run_mqtt --async``).
+
+paho's network I/O is driven from the asyncio event loop through its socket
+callbacks (the pattern from paho's ``loop_asyncio`` example), so no extra
+dependency is needed. Synchronous ORM work runs on a bounded thread pool and
+the resulting channel layer sends are awaited concurrently; a slow database
+write no longer stalls the socket.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import paho.mqtt.client as mqtt
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .ingest import IngestPipeline
+from .mqtt_bridge import build_client, prepare_bridge, status_subscription
+from .write_buffer import build_write_buffer
+
+
+class _AsyncioHelper:
+    """
+    Wire a paho client's socket into an asyncio event loop.
+
+    ``pause()`` stops reading the socket for backpressure. A pause lasts at
+    most ``max_pause`` seconds: PINGRESP and other control packets arrive on
+    the same socket, and left unread they would trip the keepalive.
+    """
+
+    def __init__(self, loop, client, max_pause=None):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self.sock = None
+        self.paused = False
+        self.max_pause = max_pause
+        self._unpause = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.sock = sock
+        # a reconnect while paused stays paused
+        if not self.paused:
+            self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.sock = None
+        if self.misc is not None:
+            self.misc.cancel()
+
+    def pause(self):
+        """Stop reading the socket until ``resume()`` or ``max_pause`` elapses."""
+        if self.paused:
+            return
+        self.paused = True
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock)
+        if self.max_pause:
+            self._unpause = self.loop.call_later(self.max_pause, self.resume)
+
+    def resume(self):
+        if not self.paused:
+            return
+        self.paused = False
+        if self._unpause is not None:
+            self._unpause.cancel()
+            self._unpause = None
+        if self.sock is not None:
+            self.loop.add_reader(self.sock, self.client.loop_read)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+class AsyncBridge:
+    """Consume ``Devices/+/status`` on an event loop and fan out concurrently."""
+
+    def __init__(self, broker=None, port=None, on_message_extra=None, orm_workers=None,
+                 max_in_flight=None):
+        self.broker = broker or settings.MQTT_BROKER
+        self.port = port or settings.MQTT_PORT
+        self.pipeline = IngestPipeline()
+        self.write_buffer = None
+        self.pipeline.add_hook(on_message_extra)
+        self.executor = ThreadPoolExecutor(
+            max_workers=orm_workers or getattr(settings, "MQTT_BRIDGE_ORM_WORKERS", 4),
+            thread_name_prefix="mqtt-bridge-orm",
+        )
+        # Bound on messages being processed at once; socket reads pause beyond it.
+        self.max_in_flight = max_in_flight or getattr(settings, "MQTT_BRIDGE_MAX_IN_FLIGHT", 1000)
+        # Longest read pause, well inside the 60 s keepalive.
+        self.max_pause = getattr(settings, "MQTT_BRIDGE_MAX_PAUSE", 10.0)
+        self.channel_layer = None
+        self.loop = None
+        self.client = None
+        self.helper = None
+        self._pending = 0
+        self._token_locks = {}
+        self._disconnected = None
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        print(f"Connected to MQTT broker {self.broker}:{self.port} rc={reason_code}", flush=True)
+        client.subscribe(status_subscription())
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        print(f"⚠️ Disconnected from MQTT broker rc={reason_code}", flush=True)
+        self._disconnected.set()
+
+    def _on_message(self, client, userdata, msg):
+        self._pending += 1
+        task = self.loop.create_task(self._handle(msg.topic, msg.payload))
+        task.add_done_callback(self._message_done)
+        if self._pending >= self.max_in_flight and not self.helper.paused:
+            # Backpressure: stop reading from the broker until we catch up
+            # (or, at the latest, until the next keepalive exchange is due).
+            self.helper.pause()
+
+    def _message_done(self, task):
+        self._pending -= 1
+        if self.helper.paused and self._pending <= self.max_in_flight // 2:
+            self.helper.resume()
+
+    async def _handle(self, topic, payload_bytes):
+        token = topic.split("/")[1] if topic.count("/") >= 2 else topic
+        # Per-token lock (FIFO) keeps each device's messages in arrival order
+        # while different devices are processed concurrently.
+        entry = self._token_locks.get(token)
+        if entry is None:
+            entry = self._token_locks[token] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._process(topic, payload_bytes)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._token_locks[token]
+
+    async def _process(self, topic, payload_bytes):
+        event = await self.loop.run_in_executor(
+            self.executor, self.pipeline.handle, topic, payload_bytes
+        )
+        await self.pipeline.deliver(self.channel_layer, event)
+        if self.pipeline.hooks:
+            await self.loop.run_in_executor(self.executor, self.pipeline.run_hooks, event)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.channel_layer = get_channel_layer()
+        self._disconnected = asyncio.Event()
+        await self.loop.run_in_executor(self.executor, prepare_bridge)
+        self.write_buffer = self.pipeline.write_buffer = build_write_buffer()
+
+        self.client = build_client()
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.helper = _AsyncioHelper(self.loop, self.client, max_pause=self.max_pause)
+
+        delay = 1
+        while True:
+            self._disconnected.clear()
+            try:
+                self.client.connect(self.broker, self.port, 60)
+                delay = 1
+            except OSError as e:
+                print(f"⚠️ MQTT connect to {self.broker}:{self.port} failed: {e}", flush=True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            await self._disconnected.wait()
+            await asyncio.sleep(delay)
+
+    def shutdown(self):
+        if self.client is not None:
+            try:
+                self.client.disconnect()
+            except Exception:
+                pass
+        self.executor.shutdown(wait=True)
+        if self.write_buffer is not None:
+            self.write_buffer.stop()
+
+
+def start_async_bridge(broker=None, port=None, on_message_extra=None):
+    """Run the asyncio bridge until interrupted; blocks like ``start_bridge``."""
+    bridge = AsyncBridge(broker=broker, port=port, on_message_extra=on_message_extra)
+    try:
+        asyncio.run(bridge.run())
+    finally:
+        bridge.shutdown()
@@ -0,0 +1,101 @@
+"""Event-driven confirmation of lamp commands.
+
+A caller that publishes ``ON``/``OFF`` registers a waiter for the lamp token
+first. The bridge announces every device status it sees on the
+``confirm_<token>`` channel layer group; the process holding the waiter is a
+member of that group only while someone is waiting, so the waiter wakes as
+soon as the device answers instead of polling the database.
+"""
+import threading
+from contextlib import contextmanager
+
+from .lamp_cache import normalize_token
+from .layer_listener import ChannelListener
+
+
+CONFIRM_TYPE = "lamp.confirm"
+
+
+def confirm_group(token):
+    return f"confirm_{token}"
+
+
+def status_message(token, status):
+    return {"type": CONFIRM_TYPE, "token": str(token), "status": bool(status)}
+
+
+class Waiter:
+    def __init__(self, desired_status):
+        self.desired_status = bool(desired_status)
+        self.status = None
+        self._event = threading.Event()
+
+    def resolve(self, status):
+        self.status = bool(status)
+        self._event.set()
+
+    def wait(self, timeout):
+        """Block until the device reports the desired status; returns True if it did."""
+        return self._event.wait(timeout)
+
+
+class ConfirmationRegistry:
+    """Per-process map of lamp token -> waiters for the next matching status."""
+
+    def __init__(self, listener=None):
+        self._listener = listener
+        self._lock = threading.Lock()
+        self._membership_lock = threading.Lock()
+        self._waiters = {}
+
+    def _get_listener(self):
+        if self._listener is None:
+            with self._lock:
+                if self._listener is None:
+                    listener = ChannelListener("confirmations")
+                    listener.on(CONFIRM_TYPE, self.handle_status)
+                    self._listener = listener.start()
+        return self._listener
+
+    @contextmanager
+    def expect(self, token, desired_status):
+        """Register a waiter for ``token``; must be entered before publishing."""
+        key = normalize_token(token)
+        waiter = Waiter(desired_status)
+        listener = self._get_listener()
+        # Group membership changes are serialised so that a second waiter
+        # cannot publish before the first one's group_add has completed.
+        with self._membership_lock:
+            with self._lock:
+                waiters = self._waiters.setdefault(key, [])
+                waiters.append(waiter)
+                first = len(waiters) == 1
+            if first:
+                listener.add_group(confirm_group(key))
+        try:
+            yield waiter
+        finally:
+            with self._membership_lock:
+                with self._lock:
+                    waiters = self._waiters.get(key, [])
+                    if waiter in waiters:
+                        waiters.remove(waiter)
+                    last = not waiters
+                    if last:
+                        self._waiters.pop(key, None)
+                if last:
+                    listener.discard_group(confirm_group(key))
+
+    def handle_status(self, message):
+        """Wake every waiter on the token whose desired status was reported."""
+        key = normalize_token(message.get("token"))
+        status = bool(message.get("status"))
+        with self._lock:
+            waiters = list(self._waiters.get(key, ()))
+        for waiter in waiters:
+            if waiter.desired_status == status:
+                waiter.resolve(status)
+
+
+# Shared per-process registry used by Places_Lamp.services.lamp_control.
+confirmations = ConfirmationRegistry()
@@ -2,15 +2,34 @@ from channels.consumer import SyncConsumer
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from asgiref.sync import async_to_sync
 from asgiref.sync import sync_to_async
-import paho.mqtt.publish as publish
-from Places_Lamp.models import Lamp
+from Places_Lamp.models import Lamp, LampStateSequence
 from django.conf import settings
 from django.contrib.auth import get_user_model
 import json
 from channels.layers import get_channel_layer
+from django.db.models import Q
+from urllib.parse import parse_qs
+from . import ws_codec
+from .lamp_cache import lamp_group, normalize_token
+from .presence import PRESENCE_GROUP, joined_message, presence
+from .publisher import get_publisher
+import asyncio
 
 BROKER_URL = settings.MQTT_BROKER
 
+# Initial sync formats a LightConsumer client can ask for with ?sync=<mode>.
+SYNC_SNAPSHOT = "snapshot"
+SYNC_PER_LAMP = "per_lamp"
+# No sync on connect; the client's first {"since": <seq or null>} message triggers it.
+SYNC_ON_REQUEST = "on_request"
+# Column order of each row in a "snapshot" frame's "lamps" array.
+SNAPSHOT_FIELDS = ["token", "status", "establish", "lamp", "room"]
+
+
+def visible_lamps(user):
+    """Lamps the user owns or that are shared with them directly or via the home."""
+    return Lamp.objects.accessible_by(user)
+
 
 class MqttConsumer(SyncConsumer):
     # ... (Keep your MqttConsumer class as is, for brevity)
@@ -51,32 +70,27 @@ class MqttConsumer(SyncConsumer):
         if parsed is not None:
             try:
                 lamp.status = parsed
-                lamp.save(update_fields=["status"])
+                Lamp.set_state(lamp.pk, status=parsed)
             except Exception as e:
                 print("⚠️ Failed to save lamp status:", e)
 
-        # Broadcast to all authorized users of this lamp
-        # collect targets: home owner, lamp.shared_with, home.shared_with
-        targets = [lamp.room.home.owner]
-        targets += list(lamp.shared_with.all())
-        targets += list(lamp.room.home.shared_with.all())
-
-        for target in targets:
-            async_to_sync(self.channel_layer.group_send)(
-                f"user_{target.id}",
-                {
-                    "type": "lamp.status",
-                    "text": {
-                        "lamp": lamp.name,
-                        "token": str(lamp.token),
-                        "status": bool(lamp.status),
-                        "raw": payload,
-                        # Pass connection status on subscription, though device-initiated updates
-                        # typically mean connection is established. This is for full sync.
-                        "establish": lamp.connection, 
-                    },
+        # Broadcast to all authorized users of this lamp: their sockets
+        # joined the lamp's group at connect time.
+        async_to_sync(self.channel_layer.group_send)(
+            lamp_group(lamp.token),
+            {
+                "type": "lamp.status",
+                "text": {
+                    "lamp": lamp.name,
+                    "token": str(lamp.token),
+                    "status": bool(lamp.status),
+                    "raw": payload,
+                    # Pass connection status on subscription, though device-initiated updates
+                    # typically mean connection is established. This is for full sync.
+                    "establish": lamp.connection, 
                 },
-            )
+            },
+        )
 
     def mqtt_pub(self, event):
         """
@@ -88,7 +102,8 @@ class MqttConsumer(SyncConsumer):
         token = event['text']['token']
         payload = event['text']['payload']
         try:
-            lamp = Lamp.objects.get(token=token)
+            # room/home loaded so can_access answers the owner case without a query
+            lamp = Lamp.objects.select_related("room__home").get(token=token)
         except Lamp.DoesNotExist:
             print("⚠️ Invalid lamp token")
             return
@@ -136,7 +151,7 @@ class MqttConsumer(SyncConsumer):
         print(f"MQTT PUB → {user.username} → {topic}={payload_to_send}", flush=True)
 
         try:
-            publish.single(topic, payload_to_send, hostname=BROKER_URL)
+            get_publisher().publish(topic, payload_to_send)
             print(f"MQTT publish succeeded for topic {topic} payload={payload_to_send}", flush=True)
         except Exception as e:
             # keep consumer resilient and log publish errors
@@ -144,6 +159,36 @@ class MqttConsumer(SyncConsumer):
         
 class LightConsumer(AsyncJsonWebsocketConsumer):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # token -> latest update not yet sent (see lamp_status)
+        self.pending_updates = {}
+        self.flush_task = None
+        # set in connect() when the client negotiated smartlight.msgpack.v1
+        self.use_msgpack = False
+        # homes/rooms/lamps filter from the client's last "subscribe" message
+        self.subscription = None
+        self.lamp_tokens = set()
+        self.heartbeat_task = None
+
+    async def send_json(self, content, close=False):
+        """Send a frame with the encoder this connection negotiated."""
+        if self.use_msgpack:
+            await self.send(bytes_data=ws_codec.encode_frame(content), close=close)
+        else:
+            await super().send_json(content, close=close)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if bytes_data is not None and self.use_msgpack:
+            try:
+                content = ws_codec.decode_message(bytes_data)
+            except Exception as e:
+                print("⚠️ Bad msgpack message from client:", e, flush=True)
+                return
+            await self.receive_json(content, **kwargs)
+        else:
+            await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
     @staticmethod
     def parse_bool(p):
         if(p=="1" or p=="on" or p=="ON") : 
@@ -153,58 +198,165 @@ class LightConsumer(AsyncJsonWebsocketConsumer):
         else : 
             return None
 
-    # --- New Function: Fetching Lamps Asynchronously ---
+    # --- Initial sync: one query, one frame by default ---
     @sync_to_async
-    def get_user_lamps_for_sync(self):
-        """Retrieves all unique lamps owned by or shared with the user."""
+    def get_user_lamps_for_sync(self, since=None):
+        """
+        Rows of every lamp the user can see (owned, shared directly or via the
+        home), in one query. With `since`, only lamps whose state changed after
+        that sequence number, unless `since` is older than the sequence floor.
+        Returns `(seq, is_full, rows)`.
+        """
         user = self.scope["user"]
-        
-        owned_homes = user.places.all()
-        owned_lamps_list = []
-        for home in owned_homes:
-            for room in home.rooms.all():
-                owned_lamps_list.extend(list(room.lamps.select_related('room__home').all())) # Added select_related for efficiency
-        
-        shared_lamps_qs = user.shared_lamps.select_related('room__home').all()
-        
-        # Deduplicate and return unique lamps
-        return {
-            l.id: l 
-            for l in (owned_lamps_list + list(shared_lamps_qs))
-        }.values()
-
-    # --- New Function: Sending Initial State ---
-    async def send_initial_lamp_status(self):
-        """Sends the current established status for all lamps to the client."""
-        all_lamps = await self.get_user_lamps_for_sync()
-        
-        for lamp in all_lamps:
-            # Payload tailored to the client-side JS logic
-            payload = {
-                "token": str(lamp.token),
-                "status": bool(lamp.status),
-                "lamp": lamp.name,
-                "room": lamp.room.name,
-                # CRITICAL: This flag tells the JS where to put the row (Established vs. Unestablished)
-                "establish": lamp.connection 
-            }
-            
-            # Use self.send_json for sending to the current client
-            await self.send_json(payload)
-            
-        print(f"Sent initial state for {len(all_lamps)} lamps to {self.scope['user'].username}.")
+        # Read the counter before the lamps: a write committed in between is
+        # then sent again on the next resync instead of being missed.
+        last, floor = LampStateSequence.current()
+        lamps = self.subscribed_lamps()
+        is_full = since is None or since < floor or since > last
+        if not is_full:
+            lamps = lamps.filter(state_seq__gt=since)
+        rows = list(
+            lamps.order_by("id")
+            .values_list("token", "status", "connection", "name", "room__name")
+        )
+        return last, is_full, rows
+
+    def query_param(self, name, default=None):
+        params = parse_qs(self.scope.get("query_string", b"").decode())
+        return params.get(name, [default])[0]
+
+    @staticmethod
+    def parse_since(value):
+        try:
+            since = int(value)
+        except (TypeError, ValueError):
+            return None
+        return since if since >= 0 else None
+
+    def sync_mode(self):
+        """Initial sync format negotiated with ``?sync=``; defaults to a single snapshot frame."""
+        mode = self.query_param("sync", SYNC_SNAPSHOT)
+        return mode if mode in (SYNC_SNAPSHOT, SYNC_PER_LAMP, SYNC_ON_REQUEST) else SYNC_SNAPSHOT
+
+    async def send_initial_lamp_status(self, since=None):
+        """Sends the state of every visible lamp, or of those changed after `since`."""
+        seq, is_full, rows = await self.get_user_lamps_for_sync(since)
+
+        if self.sync_mode() == SYNC_PER_LAMP:
+            # Older clients expect one frame per lamp.
+            for token, status, connection, name, room_name in rows:
+                await self.send_json({
+                    "token": str(token),
+                    "status": bool(status),
+                    "lamp": name,
+                    "room": room_name,
+                    # CRITICAL: This flag tells the JS where to put the row (Established vs. Unestablished)
+                    "establish": connection,
+                })
+        else:
+            frame = {"type": "snapshot" if is_full else "delta", "seq": seq}
+            if not is_full:
+                frame["since"] = since
+            frame["fields"] = SNAPSHOT_FIELDS
+            frame["lamps"] = [
+                [str(token), bool(status), bool(connection), name, room_name]
+                for token, status, connection, name, room_name in rows
+            ]
+            await self.send_json(frame)
+
+        kind = "initial state" if is_full else f"changes since {since}"
+        print(f"Sent {kind} for {len(rows)} lamps to {self.scope['user'].username}.")
+
 
+    @sync_to_async
+    def get_visible_tokens(self):
+        return {str(token) for token in self.subscribed_lamps().values_list("token", flat=True)}
+
+    def subscribed_lamps(self):
+        """Visible lamps, narrowed to the client's ``subscribe`` filter if it sent one."""
+        lamps = visible_lamps(self.scope["user"])
+        if self.subscription is not None:
+            lamps = lamps.filter(
+                Q(room__home_id__in=self.subscription["homes"])
+                | Q(room_id__in=self.subscription["rooms"])
+                | Q(token__in=self.subscription["lamps"])
+            )
+        return lamps
+
+    @staticmethod
+    def parse_subscription(content):
+        """``{"homes": [...], "rooms": [...], "lamps": [...]}`` -> id/token sets; None when empty."""
+        def ids(values):
+            result = set()
+            for value in values or ():
+                try:
+                    result.add(int(value))
+                except (TypeError, ValueError):
+                    pass
+            return result
+
+        subscription = {
+            "homes": ids(content.get("homes")),
+            "rooms": ids(content.get("rooms")),
+            "lamps": {t for t in map(normalize_token, content.get("lamps") or ()) if t},
+        }
+        return subscription if any(subscription.values()) else None
+
+    async def subscribe(self, content):
+        """Restrict this socket's events and snapshots to the requested homes/rooms/lamps."""
+        self.subscription = self.parse_subscription(content)
+        await self.join_lamp_groups()
+        # drop anything buffered for lamps outside the new filter
+        self.pending_updates = {
+            token: update for token, update in self.pending_updates.items() if token in self.lamp_tokens
+        }
+        await self.send_initial_lamp_status()
+
+    async def join_lamp_groups(self):
+        """Be in exactly the ``lamp_<token>`` groups of the lamps this socket should see."""
+        tokens = await self.get_visible_tokens()
+        joined = self.lamp_tokens
+        added, removed = tokens - joined, joined - tokens
+        await asyncio.gather(
+            *[self.channel_layer.group_add(lamp_group(t), self.channel_name) for t in added],
+            *[self.channel_layer.group_discard(lamp_group(t), self.channel_name) for t in removed],
+        )
+        self.lamp_tokens = tokens
+        # Tell the bridges someone is watching before any snapshot is read, so
+        # no update is skipped between the snapshot and the next event.
+        await sync_to_async(presence.join, thread_sensitive=False)(added, self.channel_name)
+        await sync_to_async(presence.leave, thread_sensitive=False)(removed, self.channel_name)
+        if added:
+            await self.channel_layer.group_send(PRESENCE_GROUP, joined_message(added))
+
+    async def presence_heartbeat(self):
+        """Refresh this socket's presence entries well within ``PRESENCE_TTL``."""
+        while True:
+            await asyncio.sleep(presence.heartbeat_seconds)
+            await sync_to_async(presence.heartbeat, thread_sensitive=False)(self.lamp_tokens, self.channel_name)
 
     async def connect(self):
         user = self.scope["user"]
         print("LightConsumer.connect: user =", getattr(user, "username", None), "auth=", getattr(user, "is_authenticated", False), flush=True)
         if user.is_authenticated:
+            # user_<id> only carries access changes and per-user notices;
+            # lamp updates arrive on the lamp_<token> groups.
             self.user_group_name = f"user_{user.id}"
             await self.channel_layer.group_add(self.user_group_name, self.channel_name)
-            await self.accept()
+            await self.join_lamp_groups()
+            if presence.enabled:
+                self.heartbeat_task = asyncio.ensure_future(self.presence_heartbeat())
+            # Binary msgpack frames for clients that offer the subprotocol.
+            if ws_codec.SUBPROTOCOL in (self.scope.get("subprotocols") or ()):
+                self.use_msgpack = True
+                await self.accept(subprotocol=ws_codec.SUBPROTOCOL)
+            else:
+                await self.accept()
             
             # CRITICAL ADDITION: Re-synchronize state upon connection/reconnection
-            await self.send_initial_lamp_status()
+            # (only what changed when the client says which sequence it has seen)
+            if self.sync_mode() != SYNC_ON_REQUEST:
+                await self.send_initial_lamp_status(self.parse_since(self.query_param("since")))
             
         else:
             print("LightConsumer.connect: anonymous user, closing connection", flush=True)
@@ -214,9 +366,27 @@ class LightConsumer(AsyncJsonWebsocketConsumer):
         user = self.scope["user"]
         if user.is_authenticated:
             await self.channel_layer.group_discard(f"user_{user.id}", self.channel_name)
+            await asyncio.gather(*[
+                self.channel_layer.group_discard(lamp_group(t), self.channel_name)
+                for t in self.lamp_tokens
+            ])
+            await sync_to_async(presence.leave, thread_sensitive=False)(self.lamp_tokens, self.channel_name)
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
 
     async def receive_json(self, content):
         # ... (Keep receive_json logic mostly as is, but ensure lamp.connection is passed in the broadcast)
+        if content.get("type") == "subscribe":
+            # {"type": "subscribe", "homes": [ids], "rooms": [ids], "lamps": [tokens]};
+            # all empty means every visible lamp again
+            await self.subscribe(content)
+            return
+        if "since" in content and "token" not in content:
+            # {"since": <seq>} asks for a (delta) resync on this connection
+            await self.send_initial_lamp_status(self.parse_since(content["since"]))
+            return
         token = content.get("token")
         payload = content.get("payload") 
         user = self.scope.get("user")
@@ -239,8 +409,8 @@ class LightConsumer(AsyncJsonWebsocketConsumer):
             # process doesn't pick up the 'mqtt' channel message.
             try:
                 topic = f"Devices/{token}/command"
-                # publish.single is blocking; run it in a thread via sync_to_async
-                await sync_to_async(publish.single)(topic, "DEL", hostname=BROKER_URL)
+                # shared persistent connection; no per-command broker handshake
+                await get_publisher().apublish(topic, "DEL")
                 print(f"Direct DEL publish succeeded for topic {topic}", flush=True)
             except Exception as e:
                 print("⚠️ Direct DEL publish failed:", e, flush=True)
@@ -248,40 +418,18 @@ class LightConsumer(AsyncJsonWebsocketConsumer):
             # lamp.delete()
             # or lamp.delete() only after device confirms
             # Broadcast to other users that lamp was deleted:
-            # Broadcast deletion to all authorized users of this lamp
-            # Gather targets and lamp metadata in a sync function to avoid
-            # accessing Django ORM relations from the async event loop.
-            def _gather_targets(tkn):
-                l = Lamp.objects.select_related('room__home').get(token=tkn)
-                owner = l.room.home.owner
-                shared_ids = list(l.shared_with.values_list('id', flat=True))
-                home_shared_ids = list(l.room.home.shared_with.values_list('id', flat=True))
-                return {
-                    'owner_id': owner.id,
-                    'shared_ids': shared_ids,
-                    'home_shared_ids': home_shared_ids,
-                    'lamp_name': l.name,
-                }
-
+            # every authorized socket is in the lamp's group.
+            deleted = {"type": "lamp.status", "text": {"token": str(token), "status": False, "deleted": True}}
             try:
-                info = await sync_to_async(_gather_targets)(token)
+                exists = await sync_to_async(Lamp.objects.filter(token=token).exists)()
             except Exception:
+                exists = False
+            if not exists:
                 # If lamp cannot be found, at least notify the requester
-                await self.channel_layer.group_send(
-                    f"user_{getattr(user,'id',None)}",
-                    {"type": "lamp.status", "text": {"token": str(token), "status": False, "deleted": True}},
-                )
+                await self.channel_layer.group_send(f"user_{getattr(user,'id',None)}", deleted)
                 return
 
-            target_ids = [info['owner_id']] + info['shared_ids'] + info['home_shared_ids']
-            # de-duplicate ids
-            target_ids = list(dict.fromkeys(target_ids))
-
-            for uid in target_ids:
-                await self.channel_layer.group_send(
-                    f"user_{uid}",
-                    {"type": "lamp.status", "text": {"token": str(token), "status": False, "deleted": True}},
-                )
+            await self.channel_layer.group_send(lamp_group(token), deleted)
             # Immediately delete the lamp from the database (destructive)
             try:
                 await sync_to_async(Lamp.objects.filter(token=token).delete)()
@@ -322,11 +470,7 @@ class LightConsumer(AsyncJsonWebsocketConsumer):
                     return None
 
                 if new_status is not None:
-                    l.__class__.objects.filter(pk=l.pk).update(status=new_status)
-
-                owner = l.room.home.owner
-                shared_ids = list(l.shared_with.values_list('id', flat=True))
-                home_shared_ids = list(l.room.home.shared_with.values_list('id', flat=True))
+                    Lamp.set_state(l.pk, status=new_status)
 
                 return {
                     'lamp_name': l.name,
@@ -334,18 +478,12 @@ class LightConsumer(AsyncJsonWebsocketConsumer):
                     'status': bool(new_status) if new_status is not None else bool(l.status),
                     'raw': payload,
                     'establish': l.connection,
-                    'owner_id': owner.id,
-                    'shared_ids': shared_ids,
-                    'home_shared_ids': home_shared_ids,
                 }
 
             info = await sync_to_async(_prepare_and_update)(token, user, parsed)
             if not info:
                 return
 
-            target_ids = [info['owner_id']] + info['shared_ids'] + info['home_shared_ids']
-            target_ids = list(dict.fromkeys(target_ids))
-
             data = {
                 'lamp': info['lamp_name'],
                 'token': info['token'],
@@ -354,8 +492,7 @@ class LightConsumer(AsyncJsonWebsocketConsumer):
                 'establish': info['establish'],
             }
 
-            for uid in target_ids:
-                await self.channel_layer.group_send(f"user_{uid}", {"type": "lamp.status", "text": data})
+            await self.channel_layer.group_send(lamp_group(info['token']), {"type": "lamp.status", "text": data})
 
             # Fallback MQTT PUB logic (run in thread) with plain text payload.
             try:
@@ -376,7 +513,7 @@ class LightConsumer(AsyncJsonWebsocketConsumer):
                 else:
                     fb_payload = str(payload)
 
-                await sync_to_async(publish.single)(topic, fb_payload, hostname=BROKER_URL)
+                await get_publisher().apublish(topic, fb_payload)
                 print(f"Fallback MQTT PUB → {topic}={fb_payload}", flush=True)
             except Exception as e:
                 print("⚠️ Fallback MQTT publish failed:", e, flush=True)
@@ -386,8 +523,34 @@ class LightConsumer(AsyncJsonWebsocketConsumer):
     async def lamp_status(self, event):
         """
         Updates coming from MQTT (via MqttConsumer).
+        Held for LIGHT_WS_COALESCE_WINDOW seconds so that intermediate states
+        (rapid toggles, optimistic update + device confirmation) collapse into
+        the latest state per lamp, sent in one frame.
         """
         text = event.get("text") or {}
+        window = getattr(settings, "LIGHT_WS_COALESCE_WINDOW", 0)
+        if window <= 0:
+            await self.send_update(text)
+            return
+        token = str(text.get("token"))
+        self.pending_updates[token] = {**self.pending_updates.get(token, {}), **text}
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_updates_later(window))
+
+    async def flush_updates_later(self, window):
+        await asyncio.sleep(window)
+        # events arriving while we send start the next window
+        self.flush_task = None
+        updates = list(self.pending_updates.values())
+        self.pending_updates = {}
+        if len(updates) == 1 or self.sync_mode() == SYNC_PER_LAMP:
+            # per-lamp clients only understand one lamp per frame
+            for update in updates:
+                await self.send_update(update)
+        elif updates:
+            await self.send_json({"type": "batch", "events": updates})
+
+    async def send_update(self, text):
         # The payload now includes 'establish', which the JS handles correctly.
         try:
             await self.send_json(text)
@@ -408,4 +571,12 @@ class LightConsumer(AsyncJsonWebsocketConsumer):
                 try:
                     print("⚠️ fallback send_json also failed:", e2, flush=True)
                 except Exception:
-                    pass
\ No newline at end of file
+                    pass
+
+    async def lamp_connection(self, event):
+        """Device (re)connected; same frame shape as a status update."""
+        await self.lamp_status(event)
+
+    async def lamp_access(self, event):
+        """A lamp was shared, unshared, added or moved: re-join the right lamp groups."""
+        await self.join_lamp_groups()
@@ -0,0 +1,201 @@
+"""Single-pass ingest pipeline for device status messages.
+
+Each ``Devices/<token>/status`` message goes through the stages below exactly
+once, in order:
+
+1. parse   – decode JSON, interpret ``msg``/``establish``, resolve the lamp
+             from ``lamp_cache``;
+2. persist – write status/connection to the database, directly or through
+             the write-behind buffer (``MQTT.write_buffer``);
+3. fan-out – one ``lamp.status``/``lamp.connection`` on the ``lamp_<token>``
+             group every authorised socket has joined (skipped when
+             ``MQTT.presence`` knows nobody is watching), and the
+             ``confirm_<token>`` announcement for waiting commands;
+4. hooks   – ``on_message_extra`` and any ``MQTT_INGEST_HOOKS``.
+
+The bridge used to also forward every raw message to the ``mqtt`` channel,
+where ``MqttConsumer.mqtt_sub`` looked the lamp up, saved and broadcast a
+second time. That path is only kept behind ``MQTT_INGEST_LEGACY_FORWARD``.
+"""
+import asyncio
+import json
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Tuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from Places_Lamp.models import Lamp
+from .confirmations import confirm_group, status_message
+from .lamp_cache import LampEntry, lamp_cache, lamp_group
+from .presence import presence as default_presence
+
+
+def decode_payload(payload_bytes):
+    """Decode a device payload as JSON; returns None when it is not JSON."""
+    try:
+        # decode bytes to string and parse JSON
+        return json.loads(payload_bytes.decode("utf-8"))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        print("⚠️ Failed to parse payload as JSON, raw:", payload_bytes)
+        return None
+
+
+def parse_status(payload):
+    """Interpret a status payload as ``(status, establish)``; either may be None."""
+    status, establish = None, None
+    if not isinstance(payload, dict):
+        return status, establish
+    p = payload.get("msg", "")
+    e = payload.get("establish", "")
+    if p in ("1", "on", "ON"):
+        status = True
+    elif p in ("0", "off", "OFF"):
+        status = False
+    if e == "Connected":
+        establish = True
+    return status, establish
+
+
+def forward_message(topic, payload):
+    """Message for the named 'mqtt' channel consumed by MqttConsumer.mqtt_sub."""
+    return {"type": "mqtt.sub", "text": {"topic": topic, "payload": payload}}
+
+
+@dataclass
+class IngestEvent:
+    topic: str
+    token: str
+    payload: Any
+    status: Optional[bool] = None
+    establish: Optional[bool] = None
+    entry: Optional[LampEntry] = None
+    # (group, message) pairs produced by the fan-out stage
+    sends: List[Tuple[str, dict]] = field(default_factory=list)
+    # legacy 'mqtt' channel message, only set in compatibility mode
+    forward: Optional[dict] = None
+
+
+class IngestPipeline:
+    """Run parse → persist → fan-out → hooks once per device message."""
+
+    def __init__(self, persist=None, fan_out=None, legacy_forward=None, hooks=None,
+                 write_buffer=None, presence=None):
+        self.persist_enabled = (
+            persist if persist is not None else getattr(settings, "MQTT_INGEST_PERSIST", True)
+        )
+        self.fan_out_enabled = (
+            fan_out if fan_out is not None else getattr(settings, "MQTT_INGEST_FAN_OUT", True)
+        )
+        self.legacy_forward = (
+            legacy_forward
+            if legacy_forward is not None
+            else getattr(settings, "MQTT_INGEST_LEGACY_FORWARD", False)
+        )
+        if hooks is None:
+            hooks = [import_string(path) for path in getattr(settings, "MQTT_INGEST_HOOKS", ())]
+        self.hooks = list(hooks)
+        # When set, persistence is deferred to a WriteBehindBuffer.
+        self.write_buffer = write_buffer
+        # Answers whether any socket is in a lamp's group right now.
+        self.presence = presence if presence is not None else default_presence
+
+    def add_hook(self, hook):
+        """Register ``hook(topic, payload)``; called once per message."""
+        if hook is not None:
+            self.hooks.append(hook)
+
+    # -- stages ---------------------------------------------------------
+
+    def parse(self, topic, payload_bytes) -> IngestEvent:
+        payload = decode_payload(payload_bytes)
+        parts = topic.split("/")
+        event = IngestEvent(topic=topic, token=parts[1] if len(parts) > 1 else "", payload=payload)
+        event.status, event.establish = parse_status(payload)
+        if event.status is not None or event.establish is not None:
+            event.entry = lamp_cache.get(event.token)
+            if event.entry is None:
+                print("⚠️ Unknown lamp token in topic:", topic, flush=True)
+        return event
+
+    def persist(self, event: IngestEvent):
+        entry = event.entry
+        if event.status is not None:
+            changes = {"status": event.status}
+        elif event.establish is not None:
+            changes = {"connection": event.establish}
+        else:
+            return
+        if self.write_buffer is not None:
+            self.write_buffer.record(entry.lamp_id, **changes)
+        else:
+            Lamp.set_state(entry.lamp_id, **changes)
+        lamp_cache.set_state(event.token, **changes)
+
+    def watched(self, entry):
+        if self.presence.is_watched(entry.token):
+            return True
+        self.presence.skipped += 1
+        return False
+
+    def fan_out(self, event: IngestEvent):
+        entry = event.entry
+        if event.status is not None:
+            # Every socket allowed to see this lamp is in its group
+            data = {
+                "lamp": entry.name,
+                "token": entry.token,
+                "status": bool(event.status),
+                "raw": event.payload,
+                "room": entry.room_name,
+            }
+            if self.watched(entry):
+                event.sends.append((lamp_group(entry.token), {"type": "lamp.status", "text": data}))
+            # Wake any set_lamp_status() call waiting on this lamp.
+            event.sends.append(
+                (confirm_group(entry.token), status_message(entry.token, event.status))
+            )
+        elif event.establish is not None and self.watched(entry):
+            data = {
+                "lamp": entry.name,
+                "token": entry.token,
+                "status": entry.status,
+                "raw": event.payload,
+                "establish": True,
+                "room": entry.room_name,
+            }
+            event.sends.append((lamp_group(entry.token), {"type": "lamp.connection", "text": data}))
+
+    def run_hooks(self, event: IngestEvent):
+        for hook in self.hooks:
+            try:
+                hook(event.topic, event.payload)
+            except Exception as e:
+                print("⚠️ Ingest hook failed:", e, flush=True)
+
+    # -- drivers --------------------------------------------------------
+
+    def handle(self, topic, payload_bytes) -> IngestEvent:
+        """Synchronous part: parse, persist and build fan-out messages."""
+        event = self.parse(topic, payload_bytes)
+        if event.entry is not None:
+            try:
+                if self.persist_enabled:
+                    self.persist(event)
+                if self.fan_out_enabled:
+                    self.fan_out(event)
+            except Exception as e:
+                print("Bridge: failed direct DB update/broadcast:", e, flush=True)
+        if self.legacy_forward:
+            event.forward = forward_message(topic, event.payload)
+        return event
+
+    async def deliver(self, channel_layer, event: IngestEvent):
+        """Await every channel layer send of ``event`` concurrently."""
+        sends = [channel_layer.group_send(group, message) for group, message in event.sends]
+        if event.forward is not None:
+            sends.append(channel_layer.send("mqtt", event.forward))
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print("⚠️ Bridge channel layer send failed:", result, flush=True)
@@ -0,0 +1,184 @@
+"""In-process cache of lamp metadata and ACL targets for the MQTT bridge.
+
+Every status message used to resolve ``Lamp.objects.get(token=...)`` and then
+walk the owner / shared_with relations to find who should be notified. The
+bridge now keeps ``token -> LampEntry`` resident (viewers come from the
+``LampAccess`` table), warms it once at startup and
+drops entries when ``MQTT.signals`` reports that a lamp, room or home changed.
+"""
+import threading
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass, replace
+from typing import Optional, Tuple
+
+from Places_Lamp.models import Lamp, LampAccess
+
+
+# Channel layer group every process holding a LampCache listens on.
+INVALIDATION_GROUP = "lamp_cache"
+INVALIDATION_TYPE = "lamp.cache.invalidate"
+
+
+@dataclass(frozen=True)
+class LampEntry:
+    lamp_id: int
+    token: str
+    name: str
+    room_id: int
+    room_name: Optional[str]
+    home_id: int
+    target_user_ids: Tuple[int, ...]
+    # Last state seen by this process; only used to fill in broadcasts.
+    status: bool = False
+    connection: bool = False
+
+
+def normalize_token(token) -> Optional[str]:
+    """Return the canonical string form of a lamp token, or None if invalid."""
+    try:
+        return str(uuid.UUID(str(token)))
+    except (TypeError, ValueError):
+        return None
+
+
+_LAMP_FIELDS = (
+    "id",
+    "token",
+    "name",
+    "status",
+    "connection",
+    "room_id",
+    "room__name",
+    "room__home_id",
+    "room__home__owner_id",
+)
+
+
+def lamp_group(token):
+    """Channel layer group joined by every WebSocket allowed to see ``token``."""
+    return f"lamp_{normalize_token(token) or token}"
+
+
+def _build_entries(rows, access):
+    entries = {}
+    for lamp_id, token, name, status, connection, room_id, room_name, home_id, owner_id in rows:
+        # owner first, then everyone else with a LampAccess row; de-duplicated
+        targets = [owner_id] + access.get(lamp_id, [])
+        key = str(token)
+        entries[key] = LampEntry(
+            lamp_id=lamp_id,
+            token=key,
+            name=name,
+            room_id=room_id,
+            room_name=room_name,
+            home_id=home_id,
+            target_user_ids=tuple(dict.fromkeys(targets)),
+            status=bool(status),
+            connection=bool(connection),
+        )
+    return entries
+
+
+def _load(lamp_filter=None):
+    """Load entries in two queries (lamps, their LampAccess rows)."""
+    lamps = Lamp.objects.all()
+    if lamp_filter:
+        lamps = lamps.filter(**lamp_filter)
+    rows = list(lamps.values_list(*_LAMP_FIELDS))
+    if not rows:
+        return {}
+
+    access = defaultdict(list)
+    for lamp_id, user_id in LampAccess.objects.filter(
+        lamp_id__in=[row[0] for row in rows]
+    ).order_by("lamp_id", "user_id").values_list("lamp_id", "user_id"):
+        access[lamp_id].append(user_id)
+
+    return _build_entries(rows, access)
+
+
+def viewer_ids(**lamp_filter):
+    """Ids of every user who can see at least one lamp matching ``lamp_filter``."""
+    ids = set()
+    for entry in _load(lamp_filter).values():
+        ids.update(entry.target_user_ids)
+    return ids
+
+
+class LampCache:
+    """Thread-safe ``token -> LampEntry`` map with targeted invalidation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def warm(self):
+        """Replace the cache contents with every lamp in the database."""
+        entries = _load()
+        with self._lock:
+            self._entries = entries
+        return len(entries)
+
+    def get(self, token) -> Optional[LampEntry]:
+        """Return the entry for ``token``, loading it on a miss."""
+        key = normalize_token(token)
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        loaded = _load({"token": key}).get(key)
+        if loaded is not None:
+            with self._lock:
+                self._entries[key] = loaded
+        return loaded
+
+    def set_state(self, token, status=None, connection=None):
+        """Record the latest device-reported state for ``token``."""
+        key = normalize_token(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            changes = {}
+            if status is not None:
+                changes["status"] = bool(status)
+            if connection is not None:
+                changes["connection"] = bool(connection)
+            self._entries[key] = replace(entry, **changes)
+
+    def invalidate(self, lamps=(), rooms=(), homes=(), everything=False):
+        """Drop entries matching any of the given lamp, room or home ids."""
+        with self._lock:
+            if everything:
+                self._entries = {}
+                return
+            lamps, rooms, homes = set(lamps), set(rooms), set(homes)
+            stale = [
+                key
+                for key, entry in self._entries.items()
+                if entry.lamp_id in lamps or entry.room_id in rooms or entry.home_id in homes
+            ]
+            for key in stale:
+                del self._entries[key]
+
+    def handle_invalidation(self, message):
+        """Channel layer handler for ``lamp.cache.invalidate`` messages."""
+        self.invalidate(
+            lamps=message.get("lamps") or (),
+            rooms=message.get("rooms") or (),
+            homes=message.get("homes") or (),
+            everything=bool(message.get("all")),
+        )
+
+
+# Shared per-process instance used by the bridge.
+lamp_cache = LampCache()
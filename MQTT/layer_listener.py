@@ -0,0 +1,109 @@
+"""Receive channel-layer messages in processes that are not Channels consumers.
+
+The MQTT bridge (and other long-running management commands) are plain
+Python processes, so they cannot rely on a ``ChannelNameRouter`` to deliver
+group messages. ``ChannelListener`` owns a private channel on a daemon thread
+with its own event loop and dispatches every received message by ``type``.
+"""
+import asyncio
+import threading
+
+from channels.layers import get_channel_layer
+
+
+# channels_redis expires group membership after a day by default; re-adding
+# well before that keeps a long-running process subscribed.
+GROUP_REFRESH_SECONDS = 3600
+
+
+class ChannelListener:
+    """Dispatch channel-layer messages addressed to this process to handlers."""
+
+    def __init__(self, name="listener"):
+        self.name = name
+        self.channel_name = None
+        self._handlers = {}
+        self._groups = set()
+        self._loop = None
+        self._channel_layer = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    def on(self, message_type, handler):
+        """Register ``handler(message)`` for messages whose type is ``message_type``."""
+        self._handlers[message_type] = handler
+
+    def start(self, groups=(), timeout=10.0):
+        """Start the listener thread and join ``groups``; returns once subscribed."""
+        if self._thread is not None:
+            for group in groups:
+                self.add_group(group)
+            return self
+        self._groups.update(groups)
+        self._thread = threading.Thread(
+            target=self._run, name=f"{self.name}-channel-listener", daemon=True
+        )
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            print(f"⚠️ {self.name}: channel listener did not start in {timeout}s", flush=True)
+        return self
+
+    def add_group(self, group, timeout=5.0):
+        """Join ``group`` from any thread."""
+        self._groups.add(group)
+        self._call(self._channel_layer.group_add(group, self.channel_name), timeout)
+
+    def discard_group(self, group, timeout=5.0):
+        """Leave ``group`` from any thread."""
+        self._groups.discard(group)
+        self._call(self._channel_layer.group_discard(group, self.channel_name), timeout)
+
+    def _call(self, coro, timeout):
+        if self._loop is None or not self._ready.is_set():
+            coro.close()
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+        except Exception as e:
+            print(f"⚠️ {self.name}: channel layer call failed:", e, flush=True)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._serve())
+
+    async def _serve(self):
+        self._channel_layer = get_channel_layer()
+        self.channel_name = await self._channel_layer.new_channel()
+        await self._join_groups()
+        self._ready.set()
+        refresher = asyncio.ensure_future(self._refresh_groups())
+        try:
+            while True:
+                try:
+                    message = await self._channel_layer.receive(self.channel_name)
+                except Exception as e:
+                    print(f"⚠️ {self.name}: channel receive failed:", e, flush=True)
+                    await asyncio.sleep(1.0)
+                    continue
+                handler = self._handlers.get(message.get("type"))
+                if handler is None:
+                    continue
+                try:
+                    handler(message)
+                except Exception as e:
+                    print(f"⚠️ {self.name}: handler for {message.get('type')} failed:", e, flush=True)
+        finally:
+            refresher.cancel()
+
+    async def _join_groups(self):
+        for group in list(self._groups):
+            try:
+                await self._channel_layer.group_add(group, self.channel_name)
+            except Exception as e:
+                print(f"⚠️ {self.name}: failed to join group {group}:", e, flush=True)
+
+    async def _refresh_groups(self):
+        while True:
+            await asyncio.sleep(GROUP_REFRESH_SECONDS)
+            await self._join_groups()
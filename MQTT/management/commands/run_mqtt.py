@@ -1,15 +1,101 @@
-from django.core.management.base import BaseCommand
+import multiprocessing
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 from MQTT.mqtt_bridge import start_bridge
+from MQTT.async_bridge import start_async_bridge
 from SmartLight import settings
 
 
 class Command(BaseCommand):
     help = "Run MQTT bridge that forwards messages into Django Channels"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--async",
+            action="store_true",
+            dest="use_async",
+            default=getattr(settings, "MQTT_BRIDGE_ASYNC", False),
+            help="Run the asyncio-native bridge (ORM work on a thread pool, concurrent fan-out).",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Shard threads for the blocking bridge (default MQTT_BRIDGE_WORKERS; 0 = inline).",
+        )
+        parser.add_argument(
+            "--instances",
+            type=int,
+            default=getattr(settings, "MQTT_BRIDGE_INSTANCES", 1),
+            help="Bridge processes sharing MQTT_SHARED_SUBSCRIPTION_GROUP (default MQTT_BRIDGE_INSTANCES).",
+        )
+
     def handle(self, *args, **options):
         broker = settings.MQTT_BROKER
         port =settings.MQTT_PORT
+        instances = options["instances"]
+        if instances > 1 and not getattr(settings, "MQTT_SHARED_SUBSCRIPTION_GROUP", ""):
+            raise CommandError(
+                "--instances > 1 requires MQTT_SHARED_SUBSCRIPTION_GROUP; otherwise "
+                "every instance would process every message."
+            )
+        # supervisor stops us with SIGTERM; unwind normally so the bridge can
+        # flush its write-behind buffer.
+        signal.signal(signal.SIGTERM, self._terminate)
         try:
-            start_bridge(broker=broker, port=port)
+            if instances > 1:
+                self._run_instances(instances, broker, port, options)
+            else:
+                self._run_bridge(broker, port, options)
         except KeyboardInterrupt:
             self.stdout.write(self.style.NOTICE("MQTT bridge stopped"))
+
+    @staticmethod
+    def _run_bridge(broker, port, options):
+        if options["use_async"]:
+            start_async_bridge(broker=broker, port=port)
+        else:
+            start_bridge(broker=broker, port=port, workers=options["workers"])
+
+    def _run_instances(self, instances, broker, port, options):
+        # Children must not share the parent's database connections.
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(
+                target=self._run_instance,
+                args=(broker, port, options),
+                name=f"mqtt-bridge-{index}",
+            )
+            for index in range(instances)
+        ]
+        for process in processes:
+            process.start()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Started {instances} bridge instances in shared group "
+                f"{settings.MQTT_SHARED_SUBSCRIPTION_GROUP!r}"
+            )
+        )
+        try:
+            for process in processes:
+                process.join()
+        finally:
+            # forward the stop to every instance so each flushes its buffer
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in processes:
+                process.join(timeout=15)
+
+    @classmethod
+    def _run_instance(cls, broker, port, options):
+        try:
+            cls._run_bridge(broker, port, options)
+        except KeyboardInterrupt:
+            pass
+
+    @staticmethod
+    def _terminate(signum, frame):
+        raise KeyboardInterrupt
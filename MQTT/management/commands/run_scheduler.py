@@ -0,0 +1,35 @@
+import signal
+
+from django.core.management.base import BaseCommand
+from MQTT.layer_listener import ChannelListener
+from MQTT.scheduler import SCHEDULE_CHANGED_TYPE, SCHEDULE_GROUP, ScheduleEngine
+
+
+class Command(BaseCommand):
+    help = "Run the lamp scheduler that publishes ON/OFF commands when user schedules are due"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--horizon",
+            type=int,
+            default=None,
+            help="Seconds of upcoming transitions kept in memory (default SCHEDULER_HORIZON).",
+        )
+
+    def handle(self, *args, **options):
+        engine = ScheduleEngine(horizon=options["horizon"])
+        # subscribe before the first load so no edit falls between the two
+        listener = ChannelListener("scheduler")
+        listener.on(SCHEDULE_CHANGED_TYPE, engine.handle_changed)
+        listener.start(groups=[SCHEDULE_GROUP])
+
+        signal.signal(signal.SIGTERM, self._terminate)
+        self.stdout.write(self.style.SUCCESS(f"Scheduler running, horizon {engine.horizon}"))
+        try:
+            engine.run_forever()
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.NOTICE("Scheduler stopped"))
+
+    @staticmethod
+    def _terminate(signum, frame):
+        raise KeyboardInterrupt
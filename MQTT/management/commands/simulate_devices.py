@@ -0,0 +1,234 @@
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+from MQTT.mqtt_bridge import MqttBridge
+from MQTT.simulator import (
+    CommandProbe,
+    DbWriteSampler,
+    FakeFleet,
+    FanOutProbe,
+    delete_fleet,
+    ensure_fleet,
+    percentile,
+    run_paced,
+)
+from SmartLight import settings
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate a fleet of lamps against an MQTT broker and report bridge throughput, "
+        "command confirmation latency and DB write rates"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--devices", type=int, default=100, help="Number of simulated lamps.")
+        parser.add_argument("--duration", type=float, default=30.0, help="Seconds of load.")
+        parser.add_argument(
+            "--status-rate", type=float, default=0.2,
+            help="State reports per lamp per second ({\"msg\": ...}).",
+        )
+        parser.add_argument(
+            "--connect-rate", type=float, default=0.0,
+            help="{\"establish\": \"Connected\"} reports per lamp per second.",
+        )
+        parser.add_argument(
+            "--command-rate", type=float, default=5.0,
+            help="ON/OFF commands per second across the fleet (timed to confirmation).",
+        )
+        parser.add_argument(
+            "--connections", type=int, default=8,
+            help="Broker connections the simulated lamps are spread over.",
+        )
+        parser.add_argument("--broker", default=None, help="Broker host (default MQTT_BROKER).")
+        parser.add_argument("--port", type=int, default=None, help="Broker port (default MQTT_PORT).")
+        parser.add_argument(
+            "--bridge", action="store_true",
+            help="Also run a blocking MqttBridge in this process instead of a separate run_mqtt.",
+        )
+        parser.add_argument(
+            "--settle", type=float, default=3.0,
+            help="Seconds to wait after the load before checking what reached the DB.",
+        )
+        parser.add_argument(
+            "--timeout", type=float, default=5.0, help="Seconds to wait for each command confirmation."
+        )
+        parser.add_argument("--cleanup", action="store_true", help="Delete the simulated lamps afterwards.")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+
+    def handle(self, *args, **options):
+        if options["devices"] < 1:
+            raise CommandError("--devices must be at least 1")
+        broker = options["broker"] or settings.MQTT_BROKER
+        port = options["port"] or settings.MQTT_PORT
+        devices = options["devices"]
+        if type(get_channel_layer()) is InMemoryChannelLayer:
+            # Fan-out and confirmations are observed over the channel layer, so
+            # it has to be shared with the bridge (Redis in every deployment).
+            raise CommandError("simulate_devices needs a cross-process channel layer, not InMemoryChannelLayer")
+
+        user, lamps = ensure_fleet(devices)
+        tokens = [str(lamp.token) for lamp in lamps]
+        self.stdout.write(f"Simulating {devices} lamps on {broker}:{port} as user {user.username!r}")
+
+        bridge = None
+        if options["bridge"]:
+            bridge = MqttBridge(broker=broker, port=port).start()
+            threading.Thread(target=bridge.run_forever, name="simulate-bridge", daemon=True).start()
+
+        fan_out = FanOutProbe(tokens).start()
+        fleet = FakeFleet(tokens, broker, port, connections=options["connections"])
+        try:
+            fleet.start()
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        commands = CommandProbe(fleet, timeout=options["timeout"])
+        sampler = DbWriteSampler([lamp.id for lamp in lamps]).start()
+
+        stop = threading.Event()
+        status_tokens = itertools.cycle(tokens)
+        connect_tokens = itertools.cycle(tokens)
+        command_tokens = itertools.cycle(tokens)
+        # Commands block until confirmed, so they run on a pool sized for the
+        # rate times the worst-case wait.
+        pool = ThreadPoolExecutor(
+            max_workers=max(4, int(options["command_rate"] * options["timeout"]) + 1),
+            thread_name_prefix="simulate-command",
+        )
+        drivers = [
+            threading.Thread(
+                target=run_paced,
+                args=(devices * options["status_rate"], lambda: fleet.report_state(next(status_tokens)), stop),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=run_paced,
+                args=(devices * options["connect_rate"], lambda: fleet.report_connected(next(connect_tokens)), stop),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=run_paced,
+                args=(options["command_rate"], lambda: pool.submit(commands.send, next(command_tokens)), stop),
+                daemon=True,
+            ),
+        ]
+
+        started = time.monotonic()
+        for driver in drivers:
+            driver.start()
+        try:
+            while time.monotonic() - started < options["duration"]:
+                time.sleep(min(5.0, max(0.0, options["duration"] - (time.monotonic() - started))))
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f"[{elapsed:5.1f}s] published={sum(fleet.published.values())} "
+                    f"fanned_out={fan_out.total()} confirmed={len(commands.latencies)} "
+                    f"timed_out={commands.timed_out}"
+                )
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.NOTICE("Interrupted, reporting what was measured"))
+        finally:
+            stop.set()
+            for driver in drivers:
+                driver.join()
+            load_seconds = time.monotonic() - started
+            pool.shutdown(wait=True)
+
+        time.sleep(options["settle"])
+        sampler.stop()
+        report = self._report(fleet, fan_out, commands, sampler, load_seconds)
+        fleet.stop()
+        fan_out.stop()
+        if bridge is not None:
+            bridge.stop()
+        if options["cleanup"]:
+            delete_fleet()
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self._print(report)
+
+    @staticmethod
+    def _report(fleet, fan_out, commands, sampler, load_seconds):
+        published = dict(fleet.published)
+        sent = sum(published.values())
+        fanned_out = fan_out.total()
+        final = sampler.snapshot()
+        # Rows whose persisted status matches what the lamp last reported.
+        consistent = sum(
+            1 for lamp_id, token in zip(sampler.lamp_ids, fleet.tokens)
+            if final.get(lamp_id, (None,))[0] == fleet.state[token]
+        )
+        latencies_ms = [latency * 1000 for latency in commands.latencies]
+        fan_out_seconds = (
+            fan_out.last_at - fan_out.first_at
+            if fan_out.first_at is not None and fan_out.last_at > fan_out.first_at
+            else load_seconds
+        )
+        return {
+            "devices": len(fleet.tokens),
+            "load_seconds": round(load_seconds, 2),
+            "published": published,
+            "publish_rate": round(sent / load_seconds, 1),
+            "bridge": {
+                "fanned_out": fanned_out,
+                "throughput": round(fanned_out / fan_out_seconds, 1),
+                "delivery_ratio": round(fanned_out / sent, 3) if sent else None,
+            },
+            "commands": {
+                "sent": commands.sent,
+                "confirmed": len(latencies_ms),
+                "timed_out": commands.timed_out,
+                "failed": commands.failed,
+                "skipped_in_flight": commands.skipped,
+                "latency_ms": {
+                    name: round(value, 1) if value is not None else None
+                    for name, value in (
+                        ("p50", percentile(latencies_ms, 50)),
+                        ("p90", percentile(latencies_ms, 90)),
+                        ("p99", percentile(latencies_ms, 99)),
+                        ("max", max(latencies_ms) if latencies_ms else None),
+                    )
+                },
+            },
+            "db": {
+                "rows_changed_per_second_avg": (
+                    round(sum(sampler.samples) / len(sampler.samples), 1) if sampler.samples else 0.0
+                ),
+                "rows_changed_per_second_peak": round(max(sampler.samples), 1) if sampler.samples else 0.0,
+                "consistent_lamps": consistent,
+            },
+        }
+
+    def _print(self, report):
+        bridge, commands, db = report["bridge"], report["commands"], report["db"]
+        latency = commands["latency_ms"]
+        self.stdout.write(self.style.SUCCESS("Simulation report"))
+        self.stdout.write(
+            f"  devices:   {report['devices']} for {report['load_seconds']}s, "
+            f"published {report['published']} ({report['publish_rate']}/s)"
+        )
+        self.stdout.write(
+            f"  bridge:    {bridge['fanned_out']} fan-out messages, {bridge['throughput']}/s, "
+            f"delivery ratio {bridge['delivery_ratio']}"
+        )
+        self.stdout.write(
+            f"  commands:  sent {commands['sent']}, confirmed {commands['confirmed']}, "
+            f"timed out {commands['timed_out']}, failed {commands['failed']}, "
+            f"skipped {commands['skipped_in_flight']}"
+        )
+        self.stdout.write(
+            f"  latency:   p50={latency['p50']}ms p90={latency['p90']}ms "
+            f"p99={latency['p99']}ms max={latency['max']}ms"
+        )
+        self.stdout.write(
+            f"  db writes: {db['rows_changed_per_second_avg']} rows/s avg, "
+            f"{db['rows_changed_per_second_peak']} peak, "
+            f"{db['consistent_lamps']}/{report['devices']} lamps persisted in their last state"
+        )
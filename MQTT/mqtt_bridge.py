@@ -4,127 +4,151 @@ import paho.mqtt.client as mqtt
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from SmartLight import settings
-from Places_Lamp.models import Lamp
-import json
+from .ingest import IngestPipeline
+from .lamp_cache import INVALIDATION_GROUP, INVALIDATION_TYPE, lamp_cache
+from .layer_listener import ChannelListener
+from .presence import PRESENCE_GROUP, PRESENCE_JOINED_TYPE, presence
+from .sharding import ShardedDispatcher, report_stats_forever
+from .write_buffer import build_write_buffer
 
 
-def start_bridge(broker: Optional[str] = None, port: Optional[int] = None, on_message_extra=None):
-    """Start an MQTT client that forwards Devices/macadd/status to Channels.
+STATUS_TOPIC = "Devices/+/status"
 
-    This function blocks (calls loop_forever). Call it in a background thread if
-    you need non-blocking behavior.
+
+def status_subscription(shared_group=None):
+    """Topic filter for device status, as an MQTT v5 shared subscription if grouped.
+
+    Every bridge subscribed with the same ``$share/<group>/`` prefix receives a
+    disjoint part of the message stream, so several processes can split the
+    fleet without handling any message twice.
     """
-    broker = broker or settings.MQTT_BROKER
-    port = port or settings.MQTT_PORT
-    channel_layer = get_channel_layer()
-    try:
-        print("Channel layer backend:", type(channel_layer), flush=True)
-    except Exception:
-        pass
+    if shared_group is None:
+        shared_group = getattr(settings, "MQTT_SHARED_SUBSCRIPTION_GROUP", "")
+    if shared_group:
+        return f"$share/{shared_group}/{STATUS_TOPIC}"
+    return STATUS_TOPIC
+
+
+def build_client(shared_group=None):
+    """paho client for a bridge; shared subscriptions need protocol v5."""
+    if shared_group is None:
+        shared_group = getattr(settings, "MQTT_SHARED_SUBSCRIPTION_GROUP", "")
+    protocol = mqtt.MQTTv5 if shared_group else mqtt.MQTTv311
+    return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=protocol)
+
+
+def prepare_bridge():
+    """Warm the lamp cache and start listening for invalidations and new watchers."""
+    # Keep token -> lamp/ACL metadata resident so status messages need no reads.
+    print(f"Bridge: warmed lamp cache with {lamp_cache.warm()} lamps", flush=True)
+    listener = ChannelListener("mqtt-bridge")
+    listener.on(INVALIDATION_TYPE, lamp_cache.handle_invalidation)
+    listener.on(PRESENCE_JOINED_TYPE, presence.handle_joined)
+    listener.start(groups=[INVALIDATION_GROUP, PRESENCE_GROUP])
+    return listener
+
+
+class MqttBridge:
+    """Blocking bridge: paho callbacks feed the ingest pipeline via shard threads."""
+
+    def __init__(self, broker=None, port=None, on_message_extra=None, workers=None,
+                 shared_group=None):
+        self.broker = broker or settings.MQTT_BROKER
+        self.port = port or settings.MQTT_PORT
+        self.workers = workers if workers is not None else getattr(settings, "MQTT_BRIDGE_WORKERS", 4)
+        self.shared_group = (
+            shared_group
+            if shared_group is not None
+            else getattr(settings, "MQTT_SHARED_SUBSCRIPTION_GROUP", "")
+        )
+        self.channel_layer = None
+        self.write_buffer = None
+        self.pipeline = None
+        self.dispatcher = None
+        self._on_message_extra = on_message_extra
+
+    def start(self):
+        """Warm caches and start the write buffer and shard threads."""
+        self.channel_layer = get_channel_layer()
+        try:
+            print("Channel layer backend:", type(self.channel_layer), flush=True)
+        except Exception:
+            pass
+        prepare_bridge()
+        self.write_buffer = build_write_buffer()
+        self.pipeline = IngestPipeline(write_buffer=self.write_buffer)
+        self.pipeline.add_hook(self._on_message_extra)
+        if self.workers > 0:
+            self.dispatcher = ShardedDispatcher(
+                self.process,
+                workers=self.workers,
+                queue_size=getattr(settings, "MQTT_BRIDGE_QUEUE_SIZE", 1000),
+            ).start()
+            stats_interval = getattr(settings, "MQTT_BRIDGE_STATS_INTERVAL", 60)
+            if stats_interval:
+                report_stats_forever(self.dispatcher, stats_interval)
+        return self
 
+    def stop(self):
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+        if self.write_buffer is not None:
+            self.write_buffer.stop()
 
     # subscribe to topic i want
-    def on_connect(client, userdata, flags, rc):
-        print(f"Connected to MQTT broker {broker}:{port} rc={rc}")
-        client.subscribe("Devices/+/status")
+    def on_connect(self, client, userdata, flags, reason_code, properties=None):
+        print(f"Connected to MQTT broker {self.broker}:{self.port} rc={reason_code}", flush=True)
+        client.subscribe(status_subscription(self.shared_group))
 
     # behavior when new message arive from subscribed topic
-    def on_message(client, userdata, msg):
-        topic = msg.topic
-        payload_bytes = msg.payload
-        try:
-        # decode bytes to string and parse JSON
-            payload = json.loads(payload_bytes.decode("utf-8"))
-        except json.JSONDecodeError:
-            print("⚠️ Failed to parse payload as JSON, raw:", payload_bytes)
-            payload = None
-        print(f"MQTT recv {topic} -> {payload}")
-        # Try to update Lamp in DB directly so web UI sees changes even if
-        # the named-channel consumer doesn't get invoked across processes.
-        try:
-            token = topic.split("/")[1]
-            # interpret simple payloads
-            status , establish = None , None
-            p = payload.get("msg","")
-            e = payload.get("establish","")
-            if p in ("1", "on", "ON"):
-                status = True
-            elif p in ("0", "off", "OFF"):
-                status = False
-            if e=="Connected" : 
-                establish=True
-            
-            
-            if status is not None:
-                lamp = Lamp.objects.get(token=token)
-                lamp.status = status
-                lamp.save(update_fields=["status"])
-                # Broadcast to all authorized users of this lamp
-                targets = [lamp.room.home.owner]
-                targets += list(lamp.shared_with.all())
-                targets += list(lamp.room.home.shared_with.all())
-                data = {
-                    "lamp": lamp.name,
-                    "token": str(lamp.token),
-                    "status": bool(lamp.status),
-                    "raw": payload,
-                    # "establish": False,
-                    "room": getattr(lamp.room, 'name', None),
-                }
-                for target in targets:
-                    async_to_sync(channel_layer.group_send)(
-                        f"user_{target.id}", {"type": "lamp.status", "text": data}
-                    )
-                print("Bridge: updated Lamp and broadcasted to groups", flush=True)
-            elif establish is not None : 
-                lamp = Lamp.objects.get(token=token)
-                lamp.connection = establish
-                lamp.save(update_fields=["connection"])
-                # Broadcast to all authorized users of this lamp
-                targets = [lamp.room.home.owner]
-                targets += list(lamp.shared_with.all())
-                targets += list(lamp.room.home.shared_with.all())
-                data = {
-                    "lamp": lamp.name,
-                    "token": str(lamp.token),
-                    "status": bool(lamp.status),
-                    "raw": payload,
-                    "establish": True,
-                    "room": getattr(lamp.room, 'name', None),
-                }
-                for target in targets:
-                    async_to_sync(channel_layer.group_send)(
-                        f"user_{target.id}", {"type": "lamp.connection", "text": data}
-                    )
-                print("Bridge: updated Lamp and broadcasted to groups", flush=True)
-        
-        except Exception as _e:
-            # Non-fatal: continue to also send the raw message into the channel layer
-            print("Bridge: failed direct DB update/broadcast:", _e , flush=True)
-
-        # Always forward the raw message into the named 'mqtt' channel so
-        # existing SyncConsumer/MqttConsumer can pick it up if available.
-        try:
-            print("Bridge sending to channel 'mqtt'", flush=True)
-            async_to_sync(channel_layer.send)(
-                "mqtt",
-                {"type": "mqtt.sub", "text": {"topic": topic, "payload": payload}},
+    def on_message(self, client, userdata, msg):
+        if self.dispatcher is None:
+            self.process(msg.topic, msg.payload)
+            return
+        parts = msg.topic.split("/")
+        self.dispatcher.submit(parts[1] if len(parts) > 1 else msg.topic, msg.topic, msg.payload)
+
+    def process(self, topic, payload_bytes):
+        # parse, update the DB and build the fan-out exactly once
+        event = self.pipeline.handle(topic, payload_bytes)
+        print(f"MQTT recv {event.topic} -> {event.payload}")
+        if self.dispatcher is not None:
+            # shard threads keep one event loop each for channel layer sends
+            self.dispatcher.local.loop.run_until_complete(
+                self.pipeline.deliver(self.channel_layer, event)
             )
-            print("Bridge channel send completed", flush=True)
-        except Exception as e:
-            print("⚠️ Bridge failed to send to channel layer:", e, flush=True)
-        if on_message_extra:
-            try:
-                on_message_extra(topic, payload)
-            except Exception:
-                pass
-
-    client = mqtt.Client()
-    client.on_connect = on_connect
-    client.on_message = on_message
-
-    client.connect(broker, port, 60)
+        else:
+            # One event loop hop per message instead of one per group.
+            async_to_sync(self.pipeline.deliver)(self.channel_layer, event)
+        self.pipeline.run_hooks(event)
+
+    def run_forever(self):
+        client = build_client(self.shared_group)
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        client.connect(self.broker, self.port, 60)
+        try:
+            client.loop_forever()
+        finally:
+            client.disconnect()
+
+
+def start_bridge(broker: Optional[str] = None, port: Optional[int] = None, on_message_extra=None,
+                 workers: Optional[int] = None):
+    """Start an MQTT client that forwards Devices/macadd/status to Channels.
+
+    This function blocks (calls loop_forever). Call it in a background thread if
+    you need non-blocking behavior. See ``MQTT.async_bridge`` for the asyncio
+    variant used by ``run_mqtt --async``.
+
+    Messages are handed to ``workers`` shard threads keyed by device token
+    (``MQTT_BRIDGE_WORKERS``); ``workers=0`` handles them on paho's thread.
+    With ``MQTT_SHARED_SUBSCRIPTION_GROUP`` set, the bridge joins an MQTT v5
+    shared subscription so several instances split the device fleet.
+    """
+    bridge = MqttBridge(broker=broker, port=port, on_message_extra=on_message_extra,
+                        workers=workers).start()
     try:
-        client.loop_forever()
+        bridge.run_forever()
     finally:
-        client.disconnect()
+        bridge.stop()
@@ -0,0 +1,192 @@
+"""Which lamps currently have a live ``LightConsumer`` watching them.
+
+Most of the fleet reports status while nobody has the app open, yet every
+report used to cost a ``group_send`` on the Redis channel layer. Each socket
+now records the lamps it joined in a Redis sorted set per lamp
+(``smartlight:presence:<token>``, member = channel name, score = last
+heartbeat) and removes them again on disconnect. Open sockets refresh their
+entries every ``PRESENCE_HEARTBEAT_SECONDS``; entries older than
+``PRESENCE_TTL`` (a few heartbeats) belong to workers that died without
+disconnecting and no longer count. The ingest pipeline asks
+``presence.is_watched(token)`` before fanning out and skips the lamp group
+send when nobody is there.
+
+Answers are cached per process for ``PRESENCE_CACHE_SECONDS``. A socket that
+joins announces its lamps on ``PRESENCE_GROUP`` so bridges drop a cached
+"not watched" straight away instead of at the end of the cache window.
+Whenever Redis cannot be reached the registry fails open: every lamp counts
+as watched and fan-out behaves as before.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+
+# Channel layer group every bridge process listens on for new watchers.
+PRESENCE_GROUP = "lamp_presence"
+PRESENCE_JOINED_TYPE = "lamp.presence.joined"
+
+KEY_PREFIX = "smartlight:presence:"
+
+
+def presence_key(token):
+    return f"{KEY_PREFIX}{token}"
+
+
+def joined_message(tokens):
+    """Announcement that ``tokens`` just gained a watcher."""
+    return {"type": PRESENCE_JOINED_TYPE, "tokens": sorted(str(token) for token in tokens)}
+
+
+class PresenceRegistry:
+    """Redis-backed lamp presence with a short per-process cache of answers."""
+
+    def __init__(
+        self, client=None, ttl=None, heartbeat_seconds=None, cache_seconds=None, retry_seconds=None,
+        enabled=None, clock=None,
+    ):
+        self._client = client
+        self._ttl = ttl
+        self._heartbeat_seconds = heartbeat_seconds
+        self._cache_seconds = cache_seconds
+        self._retry_seconds = retry_seconds
+        self._enabled = enabled
+        self.clock = clock or time.time
+        # token -> (expires_at, watched)
+        self._cache = {}
+        self._lock = threading.Lock()
+        # monotonic time before which Redis is not tried again after an error
+        self._down_until = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    # settings are read lazily so tests can override them
+
+    @property
+    def enabled(self):
+        if self._enabled is not None:
+            return self._enabled
+        return getattr(settings, "PRESENCE_ENABLED", True)
+
+    @property
+    def heartbeat_seconds(self):
+        if self._heartbeat_seconds is not None:
+            return self._heartbeat_seconds
+        return getattr(settings, "PRESENCE_HEARTBEAT_SECONDS", 60.0)
+
+    @property
+    def ttl(self):
+        # a socket that died without disconnect() stops counting after this
+        if self._ttl is not None:
+            return self._ttl
+        return getattr(settings, "PRESENCE_TTL", 3 * self.heartbeat_seconds)
+
+    @property
+    def cache_seconds(self):
+        if self._cache_seconds is not None:
+            return self._cache_seconds
+        return getattr(settings, "PRESENCE_CACHE_SECONDS", 2.0)
+
+    @property
+    def retry_seconds(self):
+        if self._retry_seconds is not None:
+            return self._retry_seconds
+        return getattr(settings, "PRESENCE_RETRY_SECONDS", 30.0)
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+
+            self._client = redis.Redis(
+                host=settings.REDIS_HOST,
+                port=settings.REDIS_PORT,
+                socket_timeout=0.5,
+                socket_connect_timeout=0.5,
+            )
+        return self._client
+
+    def _available(self):
+        return self.enabled and time.monotonic() >= self._down_until
+
+    def _failed(self, action, error):
+        self._down_until = time.monotonic() + self.retry_seconds
+        print(f"⚠️ Presence registry {action} failed, treating every lamp as watched:", error, flush=True)
+
+    # -- LightConsumer side ---------------------------------------------
+
+    def join(self, tokens, channel_name):
+        """Record that ``channel_name`` watches ``tokens``; also its heartbeat."""
+        if not tokens or not self._available():
+            return
+        now = self.clock()
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for token in tokens:
+                key = presence_key(token)
+                pipe.zadd(key, {channel_name: now})
+                # sockets that vanished without disconnecting
+                pipe.zremrangebyscore(key, "-inf", now - self.ttl)
+                pipe.expire(key, int(self.ttl))
+            pipe.execute()
+        except Exception as e:
+            self._failed("join", e)
+
+    def heartbeat(self, tokens, channel_name):
+        """Keep an open socket's entries younger than ``ttl``."""
+        self.join(tokens, channel_name)
+
+    def leave(self, tokens, channel_name):
+        """Forget that ``channel_name`` watches ``tokens``."""
+        if not tokens or not self._available():
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for token in tokens:
+                pipe.zrem(presence_key(token), channel_name)
+            pipe.execute()
+        except Exception as e:
+            self._failed("leave", e)
+
+    # -- bridge side ----------------------------------------------------
+
+    def is_watched(self, token):
+        """True unless Redis says no live socket watches ``token``."""
+        if not self.enabled:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(token)
+            if cached is not None and cached[0] > now:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        if not self._available():
+            return True
+        try:
+            watched = self.client.zcount(presence_key(token), self.clock() - self.ttl, "+inf") > 0
+        except Exception as e:
+            self._failed("lookup", e)
+            return True
+        with self._lock:
+            self._cache[token] = (now + self.cache_seconds, watched)
+        return watched
+
+    def forget(self, tokens=None):
+        """Drop cached answers for ``tokens`` (all of them when None)."""
+        with self._lock:
+            if tokens is None:
+                self._cache.clear()
+            else:
+                for token in tokens:
+                    self._cache.pop(str(token), None)
+
+    def handle_joined(self, message):
+        """Channel layer handler for ``lamp.presence.joined`` messages."""
+        self.forget(message.get("tokens") or ())
+
+
+# Shared per-process instance used by the bridge and the consumers.
+presence = PresenceRegistry()
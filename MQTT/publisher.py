@@ -0,0 +1,146 @@
+"""Long-lived, shared MQTT publisher.
+
+``paho.mqtt.publish.single`` opens a TCP connection and performs a full
+CONNECT/DISCONNECT handshake for every command. ``MqttPublisher`` keeps a
+small pool of persistent connections instead; paho's network threads
+reconnect them automatically and ``publish()`` is safe to call from any
+thread (``apublish()`` from async code).
+"""
+import atexit
+import itertools
+import threading
+import uuid
+
+import paho.mqtt.client as mqtt
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+
+class PublishError(Exception):
+    """The broker could not be reached or refused the message."""
+
+
+class _Connection:
+    """One persistent broker connection driven by paho's background thread."""
+
+    def __init__(self, broker, port, index):
+        self.connected = threading.Event()
+        self.client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=f"smartlight-pub-{uuid.uuid4().hex[:12]}-{index}",
+        )
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.client.connect_async(broker, port, keepalive=60)
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            print("⚠️ MQTT publisher connect failed:", reason_code, flush=True)
+            return
+        self.connected.set()
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self.connected.clear()
+        if reason_code.is_failure:
+            print("⚠️ MQTT publisher disconnected, reconnecting:", reason_code, flush=True)
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+class MqttPublisher:
+    """Round-robin publisher over ``pool_size`` persistent connections."""
+
+    def __init__(self, broker=None, port=None, pool_size=None, connect_timeout=None):
+        self.broker = broker or settings.MQTT_BROKER
+        self.port = port or settings.MQTT_PORT
+        self.pool_size = max(1, pool_size or getattr(settings, "MQTT_PUBLISHER_POOL_SIZE", 1))
+        self.connect_timeout = (
+            connect_timeout
+            if connect_timeout is not None
+            else getattr(settings, "MQTT_PUBLISHER_CONNECT_TIMEOUT", 5.0)
+        )
+        self._connections = []
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+
+    def _pool(self):
+        if not self._connections:
+            with self._lock:
+                if not self._connections:
+                    self._connections = [
+                        _Connection(self.broker, self.port, i) for i in range(self.pool_size)
+                    ]
+        return self._connections
+
+    def _pick(self):
+        pool = self._pool()
+        start = next(self._next)
+        for offset in range(len(pool)):
+            conn = pool[(start + offset) % len(pool)]
+            if conn.connected.is_set():
+                return conn
+        # Nothing is connected right now: wait for the next one in line.
+        conn = pool[start % len(pool)]
+        if not conn.connected.wait(self.connect_timeout):
+            raise PublishError(f"MQTT broker {self.broker}:{self.port} is not reachable")
+        return conn
+
+    def is_connected(self):
+        return any(conn.connected.is_set() for conn in self._connections)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """Publish one message; raises ``PublishError`` on failure."""
+        conn = self._pick()
+        info = conn.client.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise PublishError(mqtt.error_string(info.rc))
+        return info
+
+    def publish_many(self, messages, qos=0, retain=False):
+        """
+        Publish ``(topic, payload)`` pairs back to back on one connection
+        without waiting in between; returns the topics paho refused.
+        """
+        conn = self._pick()
+        failed = []
+        for topic, payload in messages:
+            info = conn.client.publish(topic, payload, qos=qos, retain=retain)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                failed.append(topic)
+        return failed
+
+    async def apublish(self, topic, payload, qos=0, retain=False):
+        """Async variant; only leaves the event loop when it must wait to connect."""
+        if self.is_connected():
+            return self.publish(topic, payload, qos=qos, retain=retain)
+        return await sync_to_async(self.publish, thread_sensitive=False)(
+            topic, payload, qos=qos, retain=retain
+        )
+
+    def stop(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.stop()
+            except Exception:
+                pass
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher() -> MqttPublisher:
+    """Return the process-wide publisher, creating it on first use."""
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = MqttPublisher()
+                atexit.register(_publisher.stop)
+    return _publisher
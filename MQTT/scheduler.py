@@ -0,0 +1,372 @@
+"""Execution engine for ``UserSchedule``/``LampSchedul``.
+
+``manage.py run_scheduler`` keeps the upcoming on/off transitions of every
+schedule in a min-heap and sleeps until the earliest one is due. Every
+schedule stores its next transition in the indexed ``next_fire_at`` column,
+so only a window of ``SCHEDULER_HORIZON`` seconds is loaded, with one range
+scan; the next window is loaded when half of the current one has passed.
+The table is never polled and recurrence rules are never expanded at read
+time: after a transition fires, the schedule's next one is computed, saved
+and pushed.
+
+Schedules changed through the API are announced by ``MQTT.signals`` on the
+``lamp_schedule`` channel layer group. The engine reloads just those rows.
+Heap entries carry the schedule's version at push time, so entries of an
+edited or deleted schedule are skipped instead of searched for and removed.
+
+After every wake-up the instant processed so far is stored in
+``ScheduleCheckpoint``. On start, ``catch_up`` reads it and applies only the
+transitions missed since then (a range scan on ``next_fire_at``), each lamp
+collapsed to the state it should be in now, in one batch.
+
+Lamps are resolved when a transition fires, so attaching or detaching lamps
+(``LampSchedul``) needs no heap change. Everything due at the same wake-up
+fires as one tick: one query for the lamps, one pipelined burst of commands
+on a single broker connection, one bulk status write and one fan-out pass.
+"""
+import asyncio
+import heapq
+import itertools
+import threading
+from dataclasses import dataclass
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from Places_Lamp.models import Lamp, LampSchedul, LampStateSequence, ScheduleCheckpoint, UserSchedule
+from .lamp_cache import lamp_group
+from .presence import presence as default_presence
+from .publisher import get_publisher
+
+
+# Channel layer group the scheduler listens on for schedule edits.
+SCHEDULE_GROUP = "lamp_schedule"
+SCHEDULE_CHANGED_TYPE = "lamp.schedule.changed"
+
+
+def changed_message(schedule_ids):
+    return {"type": SCHEDULE_CHANGED_TYPE, "schedules": sorted(schedule_ids)}
+
+
+@dataclass
+class TickStats:
+    ticks: int = 0
+    commands: int = 0
+    # seconds between the earliest scheduled instant of a tick and its publish
+    last_lag: float = 0.0
+    # worst lag since the last stats() call
+    max_lag: float = 0.0
+
+
+class ScheduleEngine:
+    """Min-heap of upcoming transitions, filled one time window at a time."""
+
+    def __init__(self, horizon=None, max_sleep=None, publisher=None, clock=timezone.now, presence=None):
+        self.horizon = timedelta(
+            seconds=horizon if horizon is not None else getattr(settings, "SCHEDULER_HORIZON", 3600)
+        )
+        # upper bound on one sleep, so a wall clock jump is noticed eventually
+        self.max_sleep = max_sleep if max_sleep is not None else getattr(settings, "SCHEDULER_MAX_SLEEP", 300)
+        self.publisher = publisher
+        self.clock = clock
+        self.wake = threading.Event()
+        # Answers whether any socket is in a lamp's group right now.
+        self.presence = presence if presence is not None else default_presence
+        self.tick_stats = TickStats()
+        self._heap = []
+        self._versions = {}
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._loaded_until = None
+        # instant catch_up covered up to; the first window starts there
+        self._resume_at = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    # -- loading --------------------------------------------------------
+
+    def _push(self, schedule_id, at, status, start, end):
+        # start=None also queues overdue transitions; they fire on the next wake-up
+        if at is not None and (start is None or start <= at) and at < end:
+            version = self._versions.get(schedule_id, 0)
+            heapq.heappush(self._heap, (at, next(self._order), schedule_id, status, version))
+
+    def load_window(self, start, end):
+        """Push every transition in ``[start, end)``; one range scan on ``next_fire_at``."""
+        rows = UserSchedule.objects.firing_between(start, end).values_list("pk", "next_fire_at", "next_status")
+        with self._lock:
+            for schedule_id, at, status in rows:
+                self._push(schedule_id, at, status, start, end)
+            self._loaded_until = end
+
+    def extend(self, now):
+        """Load the next window once half of the loaded one has passed."""
+        if self._loaded_until is None:
+            # nothing between catch-up and this first load may fall through
+            start = min(self._resume_at or now, now)
+            self.load_window(start, now + self.horizon)
+        elif self._loaded_until - now < self.horizon / 2:
+            self.load_window(self._loaded_until, now + self.horizon)
+
+    def reload(self, schedule_ids):
+        """Replace the transitions of ``schedule_ids`` (edited, created or deleted)."""
+        schedule_ids = set(schedule_ids)
+        rows = list(
+            UserSchedule.objects.filter(pk__in=schedule_ids).values_list("pk", "next_fire_at", "next_status")
+        )
+        with self._lock:
+            for schedule_id in schedule_ids:
+                # entries pushed with an older version are now ignored
+                self._versions[schedule_id] = self._versions.get(schedule_id, 0) + 1
+            if self._loaded_until is None:
+                return
+            for schedule_id, at, status in rows:
+                # a schedule that is already due must still fire and advance
+                self._push(schedule_id, at, status, None, self._loaded_until)
+
+    def handle_changed(self, message):
+        """Channel layer handler for ``lamp.schedule.changed`` messages."""
+        try:
+            self.reload(message.get("schedules") or ())
+        finally:
+            close_old_connections()
+        self.wake.set()
+
+    # -- firing ---------------------------------------------------------
+
+    def _drop_stale(self):
+        while self._heap and self._heap[0][4] != self._versions.get(self._heap[0][2], 0):
+            heapq.heappop(self._heap)
+
+    def pop_due(self, now):
+        """Remove and return the current ``(at, schedule_id, status)`` transitions due by ``now``."""
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                at, _, schedule_id, status, version = heapq.heappop(self._heap)
+                if version == self._versions.get(schedule_id, 0):
+                    due.append((at, schedule_id, status))
+        return due
+
+    def fire(self, due):
+        """Fire one tick of due transitions; returns the number of commands sent."""
+        if not due:
+            return 0
+        sent, published_at = self.apply(due)
+        self._record_tick(due, sent, published_at or self.clock())
+        self.advance(due)
+        return sent
+
+    def apply(self, due):
+        """
+        Send ``due`` transitions as one batch; returns the number of commands
+        sent and when the burst was handed to the broker connection.
+        """
+        lamps = {}
+        # only lamps the schedule's owner can still see, as set_lamp_status requires
+        for schedule_id, *lamp in LampSchedul.objects.filter(
+            user_schedul_id__in={schedule_id for _, schedule_id, _ in due},
+            lamp__access__user_id=F("user_schedul__owner_id"),
+        ).distinct().values_list("user_schedul_id", "lamp_id", "lamp__token", "lamp__name", "lamp__room__name"):
+            lamps.setdefault(schedule_id, []).append(lamp)
+        # due is in firing order: a lamp in several transitions ends in the last one's state
+        final = {}
+        for _, schedule_id, status in due:
+            for lamp_id, token, name, room in lamps.get(schedule_id, ()):
+                final[lamp_id] = (str(token), name, room, status)
+        if not final:
+            return 0, None
+
+        publisher = self.publisher or get_publisher()
+        commands = [
+            (f"Devices/{token}/command", "ON" if status else "OFF") for token, _, _, status in final.values()
+        ]
+        try:
+            failed = set(publisher.publish_many(commands))
+        except Exception as e:
+            print("⚠️ Scheduler publish failed:", e, flush=True)
+            failed = {topic for topic, _ in commands}
+        published_at = self.clock()
+        for failed_topic in failed:
+            print(f"⚠️ Scheduler publish failed for {failed_topic}", flush=True)
+        sent = {
+            lamp_id: lamp for lamp_id, lamp in final.items() if f"Devices/{lamp[0]}/command" not in failed
+        }
+        if sent:
+            self._write_states(sent)
+            self._fan_out(sent)
+        return len(sent), published_at
+
+    def _record_tick(self, due, commands, published_at):
+        lag = max(0.0, (published_at - min(at for at, _, _ in due)).total_seconds())
+        stats = self.tick_stats
+        stats.ticks += 1
+        stats.commands += commands
+        stats.last_lag = lag
+        stats.max_lag = max(stats.max_lag, lag)
+        print(f"Scheduler tick: transitions={len(due)} commands={commands} lag={lag:.3f}s", flush=True)
+
+    def stats(self):
+        """Tick counters and publish lag; resets ``max_lag``."""
+        stats = self.tick_stats
+        report = {
+            "ticks": stats.ticks,
+            "commands": stats.commands,
+            "last_lag": round(stats.last_lag, 4),
+            "max_lag": round(stats.max_lag, 4),
+        }
+        stats.max_lag = 0.0
+        return report
+
+    @staticmethod
+    def _write_states(sent):
+        """One bulk status write for the tick, stamped like the write-behind buffer does."""
+        try:
+            with transaction.atomic():
+                seq = LampStateSequence.allocate(len(sent))
+                Lamp.objects.bulk_update(
+                    [
+                        Lamp(pk=lamp_id, status=status, state_seq=seq + offset)
+                        for offset, (lamp_id, (_, _, _, status)) in enumerate(sent.items())
+                    ],
+                    ["status", "state_seq"],
+                    batch_size=500,
+                )
+        except Exception as e:
+            print("⚠️ Scheduler status write failed:", e, flush=True)
+
+    def _fan_out(self, sent):
+        sends = []
+        for token, name, room, status in sent.values():
+            if not self.presence.is_watched(token):
+                self.presence.skipped += 1
+                continue
+            data = {
+                "lamp": name,
+                "token": token,
+                "status": status,
+                "raw": "ON" if status else "OFF",
+                "room": room,
+            }
+            sends.append((lamp_group(token), {"type": "lamp.status", "text": data}))
+        if sends:
+            async_to_sync(self._deliver)(sends)
+
+    @staticmethod
+    async def _deliver(sends):
+        """Send the whole tick's fan-out concurrently."""
+        channel_layer = get_channel_layer()
+        results = await asyncio.gather(
+            *(channel_layer.group_send(group, message) for group, message in sends), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print("⚠️ Scheduler channel layer send failed:", result, flush=True)
+
+    def advance(self, due):
+        """Store and queue the transition that follows each fired one."""
+        schedules = UserSchedule.objects.in_bulk({schedule_id for _, schedule_id, _ in due})
+        changed = []
+        for at, schedule_id, status in due:
+            schedule = schedules.get(schedule_id)
+            # skip schedules deleted or edited since; their reload queues them
+            if schedule is None or schedule.next_fire_at != at or schedule.next_status != status:
+                continue
+            schedule.advance(at)
+            changed.append((at, schedule))
+        if not changed:
+            return
+        # bulk_update sends no post_save, so this does not trigger a reload
+        UserSchedule.objects.bulk_update([schedule for _, schedule in changed], ["next_fire_at", "next_status"])
+        with self._lock:
+            if self._loaded_until is None:
+                return
+            for at, schedule in changed:
+                self._push(schedule.pk, schedule.next_fire_at, schedule.next_status, at, self._loaded_until)
+
+    def next_delay(self, now):
+        """Seconds until the next transition, the next window load or ``max_sleep``."""
+        delays = [self.max_sleep]
+        with self._lock:
+            self._drop_stale()
+            if self._heap:
+                delays.append((self._heap[0][0] - now).total_seconds())
+        if self._loaded_until is not None:
+            delays.append((self._loaded_until - self.horizon / 2 - now).total_seconds())
+        return max(0.0, min(delays))
+
+    def run_once(self, now=None):
+        """Fire what is due, make sure the window is loaded; returns seconds to sleep."""
+        now = now or self.clock()
+        self.extend(now)
+        due = self.pop_due(now)
+        while due:
+            self.fire(due)
+            # a fired transition may queue a follow-up that is already due
+            due = self.pop_due(now)
+        self._checkpoint(now)
+        return self.next_delay(now)
+
+    def _checkpoint(self, now):
+        try:
+            ScheduleCheckpoint.store(now)
+        except Exception as e:
+            print("⚠️ Scheduler checkpoint write failed:", e, flush=True)
+
+    # -- restart --------------------------------------------------------
+
+    def catch_up(self, now=None):
+        """
+        Apply what was missed since the checkpoint: every schedule whose next
+        transition passed while the scheduler was down is set to the state it
+        should be in now, all lamps in one batch. Returns the number of commands.
+        """
+        now = now or self.clock()
+        since = ScheduleCheckpoint.load()
+        if since is None:
+            # first start: there is nothing to replay, but transitions that
+            # passed since next_fire_at was filled must not strand the schedules
+            overdue = list(UserSchedule.objects.filter(next_fire_at__lte=now))
+            for schedule in overdue:
+                schedule.advance(now)
+            if overdue:
+                UserSchedule.objects.bulk_update(overdue, ["next_fire_at", "next_status"])
+            print(f"Scheduler first start: advanced {len(overdue)} overdue schedules", flush=True)
+            self._checkpoint(now)
+            self._resume_at = now
+            return 0
+        missed = []
+        schedules = list(UserSchedule.objects.filter(next_fire_at__gt=since, next_fire_at__lte=now))
+        for schedule in schedules:
+            # walk only this schedule's transitions in (since, now]
+            last = (schedule.next_fire_at, schedule.next_status)
+            following = schedule.next_transition(last[0])
+            while following is not None and following[0] <= now:
+                last, following = following, schedule.next_transition(following[0])
+            missed.append((last[0], schedule.pk, last[1]))
+            schedule.next_fire_at, schedule.next_status = following or (None, None)
+        sent = 0
+        if missed:
+            missed.sort(key=lambda transition: transition[0])
+            sent, _ = self.apply(missed)
+            UserSchedule.objects.bulk_update(schedules, ["next_fire_at", "next_status"])
+        print(f"Scheduler catch-up since {since:%Y-%m-%d %H:%M:%S}: schedules={len(missed)} "
+              f"commands={sent}", flush=True)
+        self._checkpoint(now)
+        self._resume_at = now
+        return sent
+
+    def run_forever(self, stop=None):
+        stop = stop or threading.Event()
+        self.catch_up()
+        while not stop.is_set():
+            delay = self.run_once()
+            close_old_connections()
+            self.wake.wait(delay)
+            self.wake.clear()
@@ -0,0 +1,120 @@
+"""Per-device ordered worker shards for the blocking bridge.
+
+paho calls ``on_message`` on its single network thread, so one slow lookup
+used to delay every other device. ``ShardedDispatcher`` hashes the device
+token onto one of N worker threads: messages of the same device stay in
+order, different devices are processed in parallel. Queues are bounded; a
+full shard blocks the network thread, which pushes back on the broker.
+"""
+import asyncio
+import queue
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+
+
+_STOP = object()
+
+
+@dataclass
+class ShardStats:
+    processed: int = 0
+    # seconds the most recently dequeued message waited in the queue
+    last_wait: float = 0.0
+    # worst wait since the last stats() call
+    max_wait: float = 0.0
+
+
+class ShardedDispatcher:
+    """Run ``handler(*args)`` on the worker that owns the message's token.
+
+    Each worker thread keeps its own event loop (exposed as ``loop`` on the
+    thread-local passed to the handler) so channel layer connections are
+    reused across messages instead of recreated per ``async_to_sync`` call.
+    """
+
+    def __init__(self, handler, workers=4, queue_size=1000, name="mqtt-bridge"):
+        self.handler = handler
+        self.name = name
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self._stats = [ShardStats() for _ in self.queues]
+        self._threads = []
+        self.local = threading.local()
+
+    def shard_for(self, token):
+        # crc32 is stable across processes, unlike hash() on str
+        return zlib.crc32(str(token).encode("utf-8")) % len(self.queues)
+
+    def start(self):
+        for index in range(len(self.queues)):
+            thread = threading.Thread(
+                target=self._work, args=(index,), name=f"{self.name}-shard-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, token, *args):
+        """Queue a message for its shard; blocks while that shard is full."""
+        self.queues[self.shard_for(token)].put((time.monotonic(), args))
+
+    def _work(self, index):
+        self.local.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.local.loop)
+        shard_queue, stats = self.queues[index], self._stats[index]
+        try:
+            while True:
+                item = shard_queue.get()
+                if item is _STOP:
+                    return
+                enqueued_at, args = item
+                wait = time.monotonic() - enqueued_at
+                stats.last_wait = wait
+                stats.max_wait = max(stats.max_wait, wait)
+                try:
+                    self.handler(*args)
+                except Exception as e:
+                    print(f"⚠️ {self.name} shard {index} handler failed:", e, flush=True)
+                stats.processed += 1
+        finally:
+            self.local.loop.close()
+
+    def stats(self):
+        """Queue depth and lag per shard; resets each shard's ``max_wait``."""
+        report = []
+        for index, (shard_queue, stats) in enumerate(zip(self.queues, self._stats)):
+            report.append(
+                {
+                    "shard": index,
+                    "depth": shard_queue.qsize(),
+                    "processed": stats.processed,
+                    "last_wait": round(stats.last_wait, 4),
+                    "max_wait": round(stats.max_wait, 4),
+                }
+            )
+            stats.max_wait = 0.0
+        return report
+
+    def stop(self, timeout=10.0):
+        """Let every shard drain its queue, then stop the workers."""
+        for shard_queue in self.queues:
+            shard_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+
+def report_stats_forever(dispatcher, interval):
+    """Log ``dispatcher.stats()`` every ``interval`` seconds on a daemon thread."""
+    def _run():
+        while True:
+            time.sleep(interval)
+            shards = dispatcher.stats()
+            depth = sum(s["depth"] for s in shards)
+            worst = max(s["max_wait"] for s in shards)
+            print(f"Bridge shards: depth={depth} max_wait={worst:.3f}s {shards}", flush=True)
+
+    thread = threading.Thread(target=_run, name=f"{dispatcher.name}-stats", daemon=True)
+    thread.start()
+    return thread
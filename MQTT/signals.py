@@ -0,0 +1,193 @@
+"""Signal handlers that keep per-process lamp caches coherent.
+
+Changes are announced after the transaction commits: the local cache is
+invalidated directly and every other process (bridge, web workers) is told
+through the ``lamp_cache`` channel layer group. The same changes raise the
+``LampStateSequence`` floor, so WebSocket clients that synced earlier get a
+full snapshot instead of a delta on their next reconnect.
+
+Users who gain or lose sight of a lamp are sent ``lamp.access`` on their
+``user_<id>`` group so their open sockets re-join the right ``lamp_<token>``
+groups.
+
+Schedule edits are sent to the ``lamp_schedule`` group so ``run_scheduler``
+reloads just the affected schedules.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from Places_Lamp.models import Home, Lamp, LampStateSequence, Room, UserSchedule
+from .lamp_cache import INVALIDATION_GROUP, INVALIDATION_TYPE, lamp_cache, viewer_ids
+from .scheduler import SCHEDULE_GROUP, changed_message
+
+
+# Saves that only touch device state do not change anything the cache keys on.
+STATE_FIELDS = frozenset({"status", "connection", "state_seq"})
+ACCESS_TYPE = "lamp.access"
+
+
+def announce_invalidation(lamps=(), rooms=(), homes=(), everything=False):
+    message = {
+        "type": INVALIDATION_TYPE,
+        "lamps": list(lamps),
+        "rooms": list(rooms),
+        "homes": list(homes),
+        "all": everything,
+    }
+
+    def _send():
+        lamp_cache.handle_invalidation(message)
+        try:
+            LampStateSequence.bump_floor()
+        except Exception as e:
+            print("⚠️ Failed to raise the lamp state sequence floor:", e, flush=True)
+        try:
+            async_to_sync(get_channel_layer().group_send)(INVALIDATION_GROUP, message)
+        except Exception as e:
+            print("⚠️ Failed to announce lamp cache invalidation:", e, flush=True)
+
+    transaction.on_commit(_send)
+
+
+def announce_access_change(user_ids):
+    """Tell ``user_ids``' sockets to recompute which lamp groups they belong to."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    def _send():
+        send = async_to_sync(get_channel_layer().group_send)
+        for user_id in user_ids:
+            try:
+                send(f"user_{user_id}", {"type": ACCESS_TYPE})
+            except Exception as e:
+                print("⚠️ Failed to announce lamp access change:", e, flush=True)
+
+    transaction.on_commit(_send)
+
+
+def announce_schedule_change(schedule_ids):
+    """Ask the scheduler to reload ``schedule_ids``."""
+    message = changed_message(schedule_ids)
+
+    def _send():
+        try:
+            async_to_sync(get_channel_layer().group_send)(SCHEDULE_GROUP, message)
+        except Exception as e:
+            print("⚠️ Failed to announce schedule change:", e, flush=True)
+
+    transaction.on_commit(_send)
+
+
+@receiver(pre_save, sender=Lamp)
+def lamp_moving(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or (update_fields and STATE_FIELDS.issuperset(update_fields)):
+        return
+    # Viewers of the old room lose the lamp if it moves to another home.
+    previous = Lamp.objects.filter(pk=instance.pk).values_list("room_id", flat=True).first()
+    if previous is not None and previous != instance.room_id:
+        instance._previous_viewer_ids = viewer_ids(pk=instance.pk)
+
+
+@receiver(post_save, sender=Lamp)
+def lamp_saved(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields and STATE_FIELDS.issuperset(update_fields):
+        return
+    announce_invalidation(lamps=[instance.pk])
+    if created or hasattr(instance, "_previous_viewer_ids"):
+        announce_access_change(
+            viewer_ids(pk=instance.pk) | getattr(instance, "_previous_viewer_ids", set())
+        )
+
+
+@receiver(post_delete, sender=Lamp)
+def lamp_deleted(sender, instance, **kwargs):
+    announce_invalidation(lamps=[instance.pk])
+
+
+@receiver(pre_save, sender=Room)
+def room_moving(sender, instance, **kwargs):
+    if instance.pk is None:
+        return
+    # Viewers of the old home lose the room's lamps when it moves.
+    previous = Room.objects.filter(pk=instance.pk).values_list("home_id", flat=True).first()
+    if previous is not None and previous != instance.home_id:
+        instance._previous_viewer_ids = viewer_ids(room_id=instance.pk)
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def room_changed(sender, instance, **kwargs):
+    announce_invalidation(rooms=[instance.pk])
+    if hasattr(instance, "_previous_viewer_ids"):
+        announce_access_change(viewer_ids(room_id=instance.pk) | instance._previous_viewer_ids)
+        del instance._previous_viewer_ids
+
+
+@receiver(pre_save, sender=Home)
+def home_changing_owner(sender, instance, **kwargs):
+    if instance.pk is None:
+        return
+    previous = Home.objects.filter(pk=instance.pk).values_list("owner_id", flat=True).first()
+    if previous is not None and previous != instance.owner_id:
+        instance._previous_viewer_ids = viewer_ids(room__home_id=instance.pk)
+
+
+@receiver(post_save, sender=Home)
+@receiver(post_delete, sender=Home)
+def home_changed(sender, instance, **kwargs):
+    announce_invalidation(homes=[instance.pk])
+    if hasattr(instance, "_previous_viewer_ids"):
+        announce_access_change(viewer_ids(room__home_id=instance.pk) | instance._previous_viewer_ids)
+        del instance._previous_viewer_ids
+
+
+def _sharing_access_change(instance, action, reverse, pk_set):
+    """Users whose visible lamps change with this m2m action."""
+    if reverse:
+        # instance is the user whose shares changed
+        announce_access_change([instance.pk])
+    elif action == "pre_clear":
+        # the cleared users are only known before the rows are gone
+        announce_access_change(instance.shared_with.values_list("id", flat=True))
+    elif pk_set:
+        announce_access_change(pk_set)
+
+
+@receiver(m2m_changed, sender=Lamp.shared_with.through)
+def lamp_sharing_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ("post_add", "post_remove", "pre_clear"):
+        _sharing_access_change(instance, action, reverse, pk_set)
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        announce_invalidation(lamps=[instance.pk])
+    elif pk_set:
+        announce_invalidation(lamps=pk_set)
+    else:
+        # user.shared_lamps.clear() does not report which lamps were affected
+        announce_invalidation(everything=True)
+
+
+@receiver(m2m_changed, sender=Home.shared_with.through)
+def home_sharing_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ("post_add", "post_remove", "pre_clear"):
+        _sharing_access_change(instance, action, reverse, pk_set)
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        announce_invalidation(homes=[instance.pk])
+    elif pk_set:
+        announce_invalidation(homes=pk_set)
+    else:
+        announce_invalidation(everything=True)
+
+
+@receiver(post_save, sender=UserSchedule)
+@receiver(post_delete, sender=UserSchedule)
+def schedule_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        announce_schedule_change([instance.pk])
@@ -0,0 +1,318 @@
+"""Synthetic device fleet and probes for load-testing the MQTT bridge.
+
+``FakeFleet`` plays N lamps over a handful of broker connections: each lamp
+subscribes to ``Devices/<token>/command``, answers ``ON``/``OFF`` with the
+matching ``{"msg": ...}`` status like the firmware does, and reports its
+state or ``{"establish": "Connected"}`` when told to. The probes measure the
+bridge from the outside (channel layer fan-out, command confirmation
+latency, rows written) and are driven by ``manage.py simulate_devices``.
+"""
+import json
+import math
+import threading
+import time
+from collections import Counter
+
+import paho.mqtt.client as mqtt
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+
+from Places_Lamp.models import Home, Room, Lamp, LampAccess
+from .confirmations import confirmations
+from .lamp_cache import lamp_group
+from .layer_listener import ChannelListener
+from .presence import PRESENCE_GROUP, joined_message, presence
+from .publisher import get_publisher
+
+
+FLEET_USERNAME = "simulated-fleet"
+FLEET_HOME = "Simulated fleet"
+FLEET_ROOM = "Simulated room"
+
+# Topics per SUBSCRIBE packet when a connection registers its lamps.
+SUBSCRIBE_CHUNK = 500
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values``; None when empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_paced(rate, action, stop):
+    """Call ``action()`` ``rate`` times per second until ``stop`` is set."""
+    if rate <= 0:
+        return
+    started = time.monotonic()
+    done = 0
+    while not stop.is_set():
+        due = int((time.monotonic() - started) * rate)
+        while done < due and not stop.is_set():
+            action()
+            done += 1
+        stop.wait(min(0.01, 1.0 / rate))
+
+
+def ensure_fleet(count):
+    """Return ``(user, lamps)`` for ``count`` simulated lamps, creating missing rows."""
+    User = get_user_model()
+    user, _ = User.objects.get_or_create(
+        username=FLEET_USERNAME, defaults={"phone_number": FLEET_USERNAME}
+    )
+    home, _ = Home.objects.get_or_create(owner=user, name=FLEET_HOME)
+    room, _ = Room.objects.get_or_create(home=home, name=FLEET_ROOM)
+    names = [f"sim-{index:05d}" for index in range(count)]
+    existing = set(Lamp.objects.filter(room=room, name__in=names).values_list("name", flat=True))
+    Lamp.objects.bulk_create(
+        [Lamp(room=room, name=name) for name in names if name not in existing],
+        batch_size=500,
+    )
+    # bulk_create skips the signals that maintain LampAccess
+    LampAccess.sync(Lamp.objects.filter(room=room).values_list("id", flat=True))
+    # Start every run from a known state so DB changes can be attributed.
+    Lamp.objects.filter(room=room).update(status=False, connection=False)
+    return user, list(Lamp.objects.filter(room=room, name__in=names).order_by("name"))
+
+
+def delete_fleet():
+    """Remove the simulated home (and with it every simulated lamp)."""
+    Home.objects.filter(owner__username=FLEET_USERNAME, name=FLEET_HOME).delete()
+
+
+class _DeviceConnection:
+    """One broker connection carrying the command topics of a slice of lamps."""
+
+    def __init__(self, fleet, broker, port, tokens, index):
+        self.fleet = fleet
+        self.tokens = tokens
+        self.ready = threading.Event()
+        self._pending = set()
+        self.client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2, client_id=f"smartlight-sim-{index}-{id(self):x}"
+        )
+        self.client.on_connect = self._on_connect
+        self.client.on_subscribe = self._on_subscribe
+        self.client.on_message = self._on_message
+        self.client.connect_async(broker, port, keepalive=60)
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            print("⚠️ Simulated fleet connect failed:", reason_code, flush=True)
+            return
+        topics = [(f"Devices/{token}/command", 0) for token in self.tokens]
+        for start in range(0, len(topics), SUBSCRIBE_CHUNK):
+            _, mid = client.subscribe(topics[start:start + SUBSCRIBE_CHUNK])
+            self._pending.add(mid)
+
+    def _on_subscribe(self, client, userdata, mid, reason_code_list, properties):
+        self._pending.discard(mid)
+        if not self._pending:
+            self.ready.set()
+
+    def _on_message(self, client, userdata, msg):
+        parts = msg.topic.split("/")
+        if len(parts) < 3:
+            return
+        self.fleet.answer(parts[1], msg.payload.decode("utf-8", "replace").strip().upper())
+
+    def publish(self, token, payload):
+        self.client.publish(f"Devices/{token}/status", json.dumps(payload))
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+class FakeFleet:
+    """``tokens`` simulated lamps spread over ``connections`` broker connections."""
+
+    def __init__(self, tokens, broker, port, connections=8):
+        self.tokens = [str(token) for token in tokens]
+        self.state = dict.fromkeys(self.tokens, False)
+        self.published = Counter()
+        self.ignored_commands = 0
+        self._lock = threading.Lock()
+        self._connections = []
+        self._owner = {}
+        self._broker = broker
+        self._port = port
+        self._connection_count = max(1, min(connections, len(self.tokens) or 1))
+
+    def start(self, timeout=30.0):
+        """Connect every slice and wait until all command topics are subscribed."""
+        for index in range(self._connection_count):
+            tokens = self.tokens[index::self._connection_count]
+            conn = _DeviceConnection(self, self._broker, self._port, tokens, index)
+            self._connections.append(conn)
+            for token in tokens:
+                self._owner[token] = conn
+        deadline = time.monotonic() + timeout
+        for conn in self._connections:
+            if not conn.ready.wait(max(0.0, deadline - time.monotonic())):
+                raise RuntimeError(
+                    f"simulated devices could not subscribe on {self._broker}:{self._port}"
+                )
+        return self
+
+    def _publish(self, token, payload, kind):
+        self._owner[token].publish(token, payload)
+        with self._lock:
+            self.published[kind] += 1
+
+    def report_state(self, token):
+        """Periodic status report: the lamp's current state, not a change."""
+        self._publish(token, {"msg": "ON" if self.state[token] else "OFF"}, "status")
+
+    def report_connected(self, token):
+        self._publish(token, {"establish": "Connected"}, "connected")
+
+    def answer(self, token, command):
+        """Apply ``ON``/``OFF`` and report the new state, as the firmware does."""
+        if token not in self.state:
+            return
+        if command not in ("ON", "OFF"):
+            with self._lock:
+                self.ignored_commands += 1
+            return
+        self.state[token] = command == "ON"
+        self._publish(token, {"msg": command}, "answer")
+
+    def stop(self):
+        for conn in self._connections:
+            try:
+                conn.stop()
+            except Exception:
+                pass
+        self._connections = []
+
+
+class FanOutProbe:
+    """Count the ``lamp.status``/``lamp.connection`` messages the bridge fans out to ``lamp_<token>``."""
+
+    def __init__(self, tokens):
+        self.counts = Counter()
+        self.first_at = None
+        self.last_at = None
+        self._lock = threading.Lock()
+        self._listener = ChannelListener("simulate-devices")
+        self._listener.on("lamp.status", self._count)
+        self._listener.on("lamp.connection", self._count)
+        self._tokens = [str(token) for token in tokens]
+        self._groups = [lamp_group(token) for token in tokens]
+
+    def start(self):
+        self._listener.start(groups=self._groups)
+        # Count as a watcher, or the bridge skips fan-out for the whole fleet.
+        presence.join(self._tokens, self._listener.channel_name)
+        async_to_sync(get_channel_layer().group_send)(PRESENCE_GROUP, joined_message(self._tokens))
+        return self
+
+    def stop(self):
+        presence.leave(self._tokens, self._listener.channel_name)
+
+    def _count(self, message):
+        now = time.monotonic()
+        with self._lock:
+            self.counts[message["type"]] += 1
+            if self.first_at is None:
+                self.first_at = now
+            self.last_at = now
+
+    def total(self):
+        with self._lock:
+            return sum(self.counts.values())
+
+
+class CommandProbe:
+    """Send commands the way ``set_lamp_status`` does and time their confirmation."""
+
+    def __init__(self, fleet, timeout=5.0):
+        self.fleet = fleet
+        self.timeout = timeout
+        self.latencies = []
+        self.sent = 0
+        self.timed_out = 0
+        self.failed = 0
+        self.skipped = 0
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def send(self, token):
+        with self._lock:
+            # one command per lamp at a time, so answers cannot be mixed up
+            if token in self._in_flight:
+                self.skipped += 1
+                return
+            self._in_flight.add(token)
+            self.sent += 1
+        try:
+            desired = not self.fleet.state[token]
+            with confirmations.expect(token, desired) as waiter:
+                started = time.monotonic()
+                try:
+                    get_publisher().publish(f"Devices/{token}/command", "ON" if desired else "OFF")
+                except Exception as e:
+                    print("⚠️ Simulated command publish failed:", e, flush=True)
+                    with self._lock:
+                        self.failed += 1
+                    return
+                confirmed = waiter.wait(self.timeout)
+                elapsed = time.monotonic() - started
+            with self._lock:
+                if confirmed:
+                    self.latencies.append(elapsed)
+                else:
+                    self.timed_out += 1
+        finally:
+            with self._lock:
+                self._in_flight.discard(token)
+
+
+class DbWriteSampler:
+    """Poll the simulated lamps' rows and count how many changed per interval."""
+
+    def __init__(self, lamp_ids, interval=1.0):
+        self.lamp_ids = list(lamp_ids)
+        self.interval = interval
+        self.samples = []  # rows changed per second, one entry per interval
+        self._last = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def snapshot(self):
+        rows = {}
+        for start in range(0, len(self.lamp_ids), 900):
+            chunk = self.lamp_ids[start:start + 900]
+            for lamp_id, status, connection in Lamp.objects.filter(pk__in=chunk).values_list(
+                "id", "status", "connection"
+            ):
+                rows[lamp_id] = (status, connection)
+        return rows
+
+    def start(self):
+        self._last = self.snapshot()
+        self._thread = threading.Thread(target=self._run, name="simulate-db-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        last_at = time.monotonic()
+        while not self._stop.wait(self.interval):
+            close_old_connections()
+            current = self.snapshot()
+            now = time.monotonic()
+            changed = sum(1 for lamp_id, row in current.items() if self._last.get(lamp_id) != row)
+            self.samples.append(changed / max(now - last_at, 1e-6))
+            self._last, last_at = current, now
+        close_old_connections()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 5)
@@ -1,3 +1,1178 @@
-from django.test import TestCase
+import asyncio
+import threading
+import uuid
+from datetime import timedelta
+from unittest.mock import patch
 
-# Create your tests here.
+import msgpack
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.timezone import now
+import paho.mqtt.client as mqtt
+from paho.mqtt.client import topic_matches_sub
+from rest_framework_simplejwt.tokens import AccessToken
+
+from Places_Lamp.models import (
+    Home, Room, Lamp, LampSchedul, LampStateSequence, ScheduleCheckpoint, UserSchedule,
+)
+from MQTT.consumers import LightConsumer, SNAPSHOT_FIELDS
+from MQTT.async_bridge import AsyncBridge, _AsyncioHelper
+from MQTT.confirmations import ConfirmationRegistry, confirm_group, status_message
+from MQTT.lamp_cache import LampCache, lamp_cache, lamp_group
+from MQTT.ingest import IngestPipeline
+from MQTT.mqtt_bridge import MqttBridge, status_subscription
+from MQTT.publisher import MqttPublisher, PublishError
+from MQTT.presence import PRESENCE_GROUP, PresenceRegistry, joined_message, presence_key
+from MQTT.scheduler import SCHEDULE_GROUP, ScheduleEngine
+from MQTT.sharding import ShardedDispatcher
+from MQTT.simulator import FakeFleet, percentile
+from MQTT.write_buffer import WriteBehindBuffer
+from MQTT import ws_codec
+from SmartLight import channels_jwt_middleware
+from SmartLight.channels_jwt_middleware import JWTAuthMiddlewareStack
+
+
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_ENABLED=False)
+class LampCacheTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        self.friend = User.objects.create_user(username="carol", password="pass", phone_number="2")
+        self.guest = User.objects.create_user(username="dave", password="pass", phone_number="3")
+        self.home = Home.objects.create(owner=self.owner, name="Main Home")
+        self.room = Room.objects.create(home=self.home, name="Living Room")
+        self.lamp = Lamp.objects.create(room=self.room, name="Ceiling")
+        self.lamp.shared_with.add(self.friend)
+        self.home.shared_with.add(self.guest)
+        self.cache = LampCache()
+
+    def test_warm_resolves_targets_without_further_queries(self):
+        self.cache.warm()
+        with self.assertNumQueries(0):
+            entry = self.cache.get(str(self.lamp.token))
+        self.assertEqual(entry.name, "Ceiling")
+        self.assertEqual(entry.room_name, "Living Room")
+        self.assertEqual(
+            entry.target_user_ids, (self.owner.id, self.friend.id, self.guest.id)
+        )
+
+    def test_miss_loads_single_lamp(self):
+        entry = self.cache.get(str(self.lamp.token).upper())
+        self.assertEqual(entry.lamp_id, self.lamp.id)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertIsNone(self.cache.get("not-a-token"))
+
+    def test_sharing_change_invalidates_entry(self):
+        from MQTT.lamp_cache import lamp_cache
+
+        lamp_cache.warm()
+        self.assertIn(self.guest.id, lamp_cache.get(self.lamp.token).target_user_ids)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.home.shared_with.remove(self.guest)
+        self.assertNotIn(self.guest.id, lamp_cache.get(self.lamp.token).target_user_ids)
+
+    def test_state_only_save_keeps_entry(self):
+        from MQTT.lamp_cache import lamp_cache
+
+        lamp_cache.warm()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.lamp.status = True
+            self.lamp.save(update_fields=["status"])
+        self.assertEqual(callbacks, [])
+
+
+class _FakeListener:
+    def __init__(self):
+        self.groups = set()
+
+    def add_group(self, group):
+        self.groups.add(group)
+
+    def discard_group(self, group):
+        self.groups.discard(group)
+
+
+class ConfirmationRegistryTests(TestCase):
+    token = "550e8400-e29b-41d4-a716-446655440000"
+
+    def setUp(self):
+        self.listener = _FakeListener()
+        self.registry = ConfirmationRegistry(listener=self.listener)
+
+    def test_matching_status_wakes_waiter(self):
+        with self.registry.expect(self.token, True) as waiter:
+            self.assertEqual(self.listener.groups, {confirm_group(self.token)})
+            self.registry.handle_status(status_message(self.token, False))
+            self.assertFalse(waiter.wait(0))
+            self.registry.handle_status(status_message(self.token.upper(), True))
+            self.assertTrue(waiter.wait(0))
+        self.assertEqual(self.listener.groups, set())
+
+    def test_group_kept_while_other_waiters_remain(self):
+        with self.registry.expect(self.token, True):
+            with self.registry.expect(self.token, False):
+                pass
+            self.assertEqual(self.listener.groups, {confirm_group(self.token)})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_ENABLED=False)
+class IngestPipelineTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        self.home = Home.objects.create(owner=self.owner, name="Main Home")
+        self.room = Room.objects.create(home=self.home, name="Living Room")
+        self.lamp = Lamp.objects.create(room=self.room, name="Ceiling")
+        lamp_cache.warm()
+        self.topic = f"Devices/{self.lamp.token}/status"
+
+    def test_status_needs_single_lamp_write_and_no_lamp_reads(self):
+        pipeline = IngestPipeline(hooks=[])
+        # state sequence UPDATE + SELECT, then the lamp UPDATE
+        with self.assertNumQueries(3):
+            event = pipeline.handle(self.topic, b'{"msg": "ON"}')
+        self.lamp.refresh_from_db()
+        self.assertTrue(self.lamp.status)
+        self.assertEqual(self.lamp.state_seq, LampStateSequence.current()[0])
+        groups = [group for group, _ in event.sends]
+        self.assertEqual(groups, [lamp_group(self.lamp.token), confirm_group(self.lamp.token)])
+        self.assertIsNone(event.forward)
+
+    def test_unknown_payload_is_ignored(self):
+        pipeline = IngestPipeline(hooks=[])
+        with self.assertNumQueries(0):
+            self.assertEqual(pipeline.handle(self.topic, b"garbage").sends, [])
+            self.assertEqual(pipeline.handle(self.topic, b'{"msg": "blink"}').sends, [])
+
+    def test_hooks_run_once_and_legacy_forward_is_opt_in(self):
+        calls = []
+        pipeline = IngestPipeline(legacy_forward=True, hooks=[lambda t, p: calls.append(p)])
+        event = pipeline.handle(self.topic, b'{"msg": "OFF"}')
+        pipeline.run_hooks(event)
+        self.assertEqual(calls, [{"msg": "OFF"}])
+        self.assertEqual(event.forward["type"], "mqtt.sub")
+
+
+class WriteBehindBufferTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        room = Room.objects.create(home=Home.objects.create(owner=owner, name="H"), name="R")
+        self.lamps = [Lamp.objects.create(room=room, name=f"L{i}") for i in range(3)]
+
+    def test_latest_state_per_lamp_is_flushed_in_bulk(self):
+        buffer = WriteBehindBuffer(interval=60, max_batch=100)
+        first, second, third = self.lamps
+        for status in (True, False, True):
+            buffer.record(first.id, status=status)
+        buffer.record(second.id, connection=True)
+        buffer.record(third.id, status=True, connection=True)
+        self.assertEqual(len(buffer), 3)
+
+        # one block of state sequence numbers (2) and one UPDATE per distinct
+        # field set (3), inside a single transaction (savepoint + release)
+        with self.assertNumQueries(7):
+            self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(len(buffer), 0)
+        for lamp in self.lamps:
+            lamp.refresh_from_db()
+        self.assertEqual((first.status, first.connection), (True, False))
+        self.assertEqual((second.status, second.connection), (False, True))
+        self.assertEqual((third.status, third.connection), (True, True))
+        self.assertEqual(sorted(lamp.state_seq for lamp in self.lamps), [1, 2, 3])
+
+    def test_max_batch_wakes_flusher(self):
+        buffer = WriteBehindBuffer(interval=60, max_batch=2)
+        buffer.record(self.lamps[0].id, status=True)
+        self.assertFalse(buffer._wake.is_set())
+        buffer.record(self.lamps[1].id, status=True)
+        self.assertTrue(buffer._wake.is_set())
+
+
+class ShardedDispatcherTests(SimpleTestCase):
+    def test_per_token_order_is_preserved(self):
+        seen = []
+        lock = threading.Lock()
+
+        def handler(token, seq):
+            with lock:
+                seen.append((token, seq))
+
+        dispatcher = ShardedDispatcher(handler, workers=3, queue_size=5).start()
+        tokens = [f"lamp-{i}" for i in range(6)]
+        for seq in range(20):
+            for token in tokens:
+                dispatcher.submit(token, token, seq)
+        dispatcher.stop()
+
+        self.assertEqual(len(seen), 120)
+        for token in tokens:
+            self.assertEqual([seq for t, seq in seen if t == token], list(range(20)))
+        stats = dispatcher.stats()
+        self.assertEqual(sum(s["processed"] for s in stats), 120)
+        self.assertTrue(all(s["depth"] == 0 for s in stats))
+
+    def test_token_always_maps_to_same_shard(self):
+        dispatcher = ShardedDispatcher(lambda *a: None, workers=8)
+        token = "550e8400-e29b-41d4-a716-446655440000"
+        self.assertEqual(len({dispatcher.shard_for(token) for _ in range(10)}), 1)
+
+
+class _StubInfo:
+    def __init__(self, rc):
+        self.rc = rc
+
+
+class _StubClient:
+    def __init__(self, refuse=()):
+        self.published = []
+        self.refuse = set(refuse)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if topic in self.refuse:
+            return _StubInfo(mqtt.MQTT_ERR_NO_CONN)
+        self.published.append((topic, payload))
+        return _StubInfo(mqtt.MQTT_ERR_SUCCESS)
+
+
+class _StubConnection:
+    def __init__(self, connected=True, refuse=()):
+        self.connected = threading.Event()
+        if connected:
+            self.connected.set()
+        self.client = _StubClient(refuse)
+
+    def stop(self):
+        pass
+
+
+class MqttPublisherTests(SimpleTestCase):
+    def publisher(self, *connections, connect_timeout=0.05):
+        publisher = MqttPublisher(broker="localhost", port=1883, pool_size=len(connections),
+                                  connect_timeout=connect_timeout)
+        publisher._connections = list(connections)
+        return publisher
+
+    def test_round_robin_skips_disconnected_connections(self):
+        first, down, last = _StubConnection(), _StubConnection(connected=False), _StubConnection()
+        publisher = self.publisher(first, down, last)
+        for index in range(4):
+            publisher.publish(f"Devices/t{index}/command", "ON")
+        self.assertEqual([t for t, _ in first.client.published], ["Devices/t0/command", "Devices/t3/command"])
+        self.assertEqual(down.client.published, [])
+        self.assertEqual([t for t, _ in last.client.published], ["Devices/t1/command", "Devices/t2/command"])
+
+    def test_raises_when_no_connection_comes_up(self):
+        publisher = self.publisher(_StubConnection(connected=False))
+        with self.assertRaises(PublishError):
+            publisher.publish("Devices/t/command", "ON")
+
+    def test_publish_many_reports_refused_messages(self):
+        connection = _StubConnection(refuse={"Devices/b/command"})
+        publisher = self.publisher(connection)
+        failed = publisher.publish_many([(f"Devices/{t}/command", "ON") for t in "abc"])
+        self.assertEqual(failed, ["Devices/b/command"])
+        self.assertEqual([t for t, _ in connection.client.published], ["Devices/a/command", "Devices/c/command"])
+
+    async def test_apublish_waits_for_a_connection_off_the_event_loop(self):
+        connection = _StubConnection(connected=False)
+        publisher = self.publisher(connection, connect_timeout=5)
+        task = asyncio.ensure_future(publisher.apublish("Devices/t/command", "ON"))
+        # the loop keeps running while apublish waits; a blocked loop would
+        # only get here after the timeout
+        await asyncio.sleep(0.05)
+        self.assertFalse(task.done())
+        connection.connected.set()
+        await asyncio.wait_for(task, 1)
+        self.assertEqual(connection.client.published, [("Devices/t/command", "ON")])
+
+
+class _FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class _RecordingLoop:
+    """Event loop stand-in that records socket reader changes."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.readers = []
+
+    def create_task(self, coro):
+        return self.loop.create_task(coro)
+
+    def call_later(self, delay, callback):
+        return self.loop.call_later(delay, callback)
+
+    def add_reader(self, sock, callback):
+        self.readers.append("add")
+
+    def remove_reader(self, sock):
+        self.readers.append("remove")
+
+
+class _StubPahoClient:
+    def loop_read(self):
+        pass
+
+    def loop_misc(self):
+        return mqtt.MQTT_ERR_SUCCESS
+
+
+class AsyncBridgeTests(SimpleTestCase):
+    def bridge(self, handler, max_in_flight=100, max_pause=None):
+        bridge = AsyncBridge(broker="localhost", port=1883, max_in_flight=max_in_flight)
+        bridge.loop = _RecordingLoop(asyncio.get_running_loop())
+        bridge.client = _StubPahoClient()
+        bridge.helper = _AsyncioHelper(bridge.loop, bridge.client, max_pause=max_pause)
+        bridge.helper.on_socket_open(bridge.client, None, object())
+        self.addCleanup(lambda: bridge.helper.misc.cancel())
+        bridge.loop.readers.clear()
+        bridge._process = handler
+        return bridge
+
+    def fill(self, bridge, count):
+        for index in range(count):
+            bridge._on_message(None, None, _FakeMessage(f"Devices/t{index}/status", b"{}"))
+
+    async def test_messages_of_one_token_are_handled_in_order(self):
+        handled = []
+
+        async def slow_handler(topic, payload):
+            # earlier messages take longer, so only the lock keeps the order
+            await asyncio.sleep(0.05 / int(payload))
+            handled.append((topic.split("/")[1], int(payload)))
+
+        bridge = self.bridge(slow_handler)
+        for payload in (1, 2, 3):
+            bridge._on_message(None, None, _FakeMessage("Devices/a/status", str(payload).encode()))
+        bridge._on_message(None, None, _FakeMessage("Devices/b/status", b"4"))
+        while bridge._pending:
+            await asyncio.sleep(0.01)
+        self.assertEqual([p for token, p in handled if token == "a"], [1, 2, 3])
+        # another device is not queued behind the slow one
+        self.assertEqual(handled[0], ("b", 4))
+        self.assertEqual(bridge._token_locks, {})
+
+    async def test_reading_pauses_at_max_in_flight_and_resumes_when_drained(self):
+        release = asyncio.Event()
+
+        async def blocked_handler(topic, payload):
+            await release.wait()
+
+        bridge = self.bridge(blocked_handler, max_in_flight=4)
+        self.fill(bridge, 3)
+        self.assertFalse(bridge.helper.paused)
+        bridge._on_message(None, None, _FakeMessage("Devices/t3/status", b"{}"))
+        self.assertTrue(bridge.helper.paused)
+        self.assertEqual(bridge.loop.readers, ["remove"])
+        release.set()
+        while bridge._pending:
+            await asyncio.sleep(0.01)
+        self.assertFalse(bridge.helper.paused)
+        self.assertEqual(bridge.loop.readers, ["remove", "add"])
+
+    async def test_reconnect_while_paused_keeps_reading_paused(self):
+        release = asyncio.Event()
+
+        async def blocked_handler(topic, payload):
+            await release.wait()
+
+        bridge = self.bridge(blocked_handler, max_in_flight=2)
+        self.fill(bridge, 2)
+        bridge.helper.on_socket_close(bridge.client, None, bridge.helper.sock)
+        bridge.helper.on_socket_open(bridge.client, None, object())
+        self.assertEqual(bridge.loop.readers, ["remove", "remove"])
+        release.set()
+        while bridge._pending:
+            await asyncio.sleep(0.01)
+        self.assertEqual(bridge.loop.readers, ["remove", "remove", "add"])
+
+    async def test_pause_is_bounded_so_keepalive_replies_are_read(self):
+        release = asyncio.Event()
+
+        async def blocked_handler(topic, payload):
+            await release.wait()
+
+        bridge = self.bridge(blocked_handler, max_in_flight=2, max_pause=0.02)
+        self.fill(bridge, 2)
+        self.assertTrue(bridge.helper.paused)
+        await asyncio.sleep(0.05)
+        # still over the bound, but the socket is read again
+        self.assertEqual(bridge._pending, 2)
+        self.assertFalse(bridge.helper.paused)
+        self.assertEqual(bridge.loop.readers, ["remove", "add"])
+        release.set()
+        while bridge._pending:
+            await asyncio.sleep(0.01)
+
+
+class _FakeBroker:
+    """In-process broker stand-in with MQTT v5 shared subscription semantics.
+
+    Plain subscriptions receive every matching message; members of a
+    ``$share/<group>/<filter>`` subscription receive each message round-robin,
+    exactly one member per group.
+    """
+
+    def __init__(self):
+        self.plain = []
+        self.shared = {}
+
+    def client(self):
+        broker = self
+
+        class _Client:
+            def subscribe(self, topic):
+                if topic.startswith("$share/"):
+                    _, group, topic_filter = topic.split("/", 2)
+                    members = broker.shared.setdefault((group, topic_filter), [[], 0])
+                    members[0].append(self)
+                else:
+                    broker.plain.append((topic, self))
+
+        return _Client()
+
+    def publish(self, topic, payload):
+        for topic_filter, client in self.plain:
+            if topic_matches_sub(topic_filter, topic):
+                client.on_message(client, None, _FakeMessage(topic, payload))
+        for (group, topic_filter), members in self.shared.items():
+            if topic_matches_sub(topic_filter, topic):
+                clients, turn = members
+                client = clients[turn % len(clients)]
+                members[1] = turn + 1
+                client.on_message(client, None, _FakeMessage(topic, payload))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_ENABLED=False, MQTT_WRITE_BEHIND_INTERVAL=0)
+class SharedSubscriptionTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        room = Room.objects.create(home=Home.objects.create(owner=owner, name="H"), name="R")
+        self.lamps = [Lamp.objects.create(room=room, name=f"L{i}") for i in range(4)]
+
+    def _connect(self, broker, handled, name):
+        bridge = MqttBridge(
+            on_message_extra=lambda topic, payload: handled.append((name, topic)),
+            workers=0,
+            shared_group="bridges",
+        )
+        with patch("MQTT.mqtt_bridge.prepare_bridge"):
+            bridge.start()
+        client = broker.client()
+        client.on_message = bridge.on_message
+        bridge.on_connect(client, None, {}, 0)
+        return bridge
+
+    def test_each_message_is_handled_once_across_instances(self):
+        self.assertEqual(status_subscription("bridges"), "$share/bridges/Devices/+/status")
+        broker = _FakeBroker()
+        handled = []
+        lamp_cache.warm()
+        bridges = [self._connect(broker, handled, f"bridge-{i}") for i in range(3)]
+
+        topics = []
+        for i in range(30):
+            lamp = self.lamps[i % len(self.lamps)]
+            topic = f"Devices/{lamp.token}/status"
+            topics.append(topic)
+            broker.publish(topic, b'{"msg": "ON"}')
+        for bridge in bridges:
+            bridge.stop()
+
+        self.assertEqual(sorted(t for _, t in handled), sorted(topics))
+        self.assertEqual({name for name, _ in handled}, {"bridge-0", "bridge-1", "bridge-2"})
+
+
+class _RecordingConnection:
+    def __init__(self):
+        self.sent = []
+
+    def publish(self, token, payload):
+        self.sent.append((token, payload))
+
+
+class SimulatorTests(SimpleTestCase):
+    def test_percentile_uses_nearest_rank(self):
+        values = [5, 1, 4, 2, 3]
+        self.assertEqual(percentile(values, 50), 3)
+        self.assertEqual(percentile(values, 99), 5)
+        self.assertIsNone(percentile([], 50))
+
+    def test_fake_lamp_answers_commands_like_firmware(self):
+        fleet = FakeFleet(["t1"], broker="localhost", port=1883)
+        conn = fleet._owner["t1"] = _RecordingConnection()
+        fleet.answer("t1", "ON")
+        fleet.answer("t1", "DEL")
+        fleet.report_state("t1")
+        self.assertEqual(conn.sent, [("t1", {"msg": "ON"}), ("t1", {"msg": "ON"})])
+        self.assertEqual(fleet.published, {"answer": 1, "status": 1})
+        self.assertEqual(fleet.ignored_commands, 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_ENABLED=False)
+class InitialSyncTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        self.viewer = User.objects.create_user(username="carol", password="pass", phone_number="2")
+        home = Home.objects.create(owner=self.owner, name="Main Home")
+        room = Room.objects.create(home=home, name="Living Room")
+        self.own = Lamp.objects.create(room=room, name="Own", status=True)
+        other_home = Home.objects.create(owner=self.viewer, name="Other")
+        other_room = Room.objects.create(home=other_home, name="Hall")
+        self.shared = Lamp.objects.create(room=other_room, name="Shared")
+        self.shared.shared_with.add(self.owner)
+        shared_home = Home.objects.create(owner=self.viewer, name="Guest Home")
+        shared_room = Room.objects.create(home=shared_home, name="Kitchen")
+        self.via_home = Lamp.objects.create(room=shared_room, name="ViaHome", connection=True)
+        shared_home.shared_with.add(self.owner)
+
+    async def _connect(self, path):
+        communicator = WebsocketCommunicator(LightConsumer.as_asgi(), path)
+        communicator.scope["user"] = self.owner
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_snapshot_is_one_frame_with_every_visible_lamp(self):
+        communicator = await self._connect("/ws/light/")
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "snapshot")
+        self.assertEqual(frame["fields"], SNAPSHOT_FIELDS)
+        self.assertEqual(
+            frame["lamps"],
+            [
+                [str(self.own.token), True, False, "Own", "Living Room"],
+                [str(self.shared.token), False, False, "Shared", "Hall"],
+                [str(self.via_home.token), False, True, "ViaHome", "Kitchen"],
+            ],
+        )
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_per_lamp_mode_sends_a_frame_per_lamp(self):
+        communicator = await self._connect("/ws/light/?sync=per_lamp")
+        frames = [await communicator.receive_json_from() for _ in range(3)]
+        self.assertEqual([f["lamp"] for f in frames], ["Own", "Shared", "ViaHome"])
+        self.assertEqual(frames[2]["establish"], True)
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    def test_sync_rows_come_from_one_query(self):
+        consumer = LightConsumer()
+        consumer.scope = {"user": self.owner}
+        # the state sequence counter, then every lamp in one query
+        with self.assertNumQueries(2):
+            _, is_full, rows = consumer.get_user_lamps_for_sync.__wrapped__(consumer)
+        self.assertTrue(is_full)
+        self.assertEqual(len(rows), 3)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_ENABLED=False)
+class DeltaResyncTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        room = Room.objects.create(home=Home.objects.create(owner=self.owner, name="Home"), name="Hall")
+        self.quiet = Lamp.objects.create(room=room, name="Quiet")
+        self.busy = Lamp.objects.create(room=room, name="Busy")
+
+    async def _sync(self, path, message=None):
+        communicator = WebsocketCommunicator(LightConsumer.as_asgi(), path)
+        communicator.scope["user"] = self.owner
+        await communicator.connect()
+        if message is not None:
+            await communicator.send_json_to(message)
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+        return frame
+
+    async def test_reconnect_gets_only_lamps_changed_since(self):
+        seq = (await self._sync("/ws/light/"))["seq"]
+        await sync_to_async(Lamp.set_state)(self.busy.pk, status=True)
+        frame = await self._sync(f"/ws/light/?since={seq}")
+        self.assertEqual(frame["type"], "delta")
+        self.assertEqual(frame["since"], seq)
+        self.assertEqual(frame["seq"], seq + 1)
+        self.assertEqual(frame["lamps"], [[str(self.busy.token), True, False, "Busy", "Hall"]])
+
+        frame = await self._sync("/ws/light/?sync=on_request", {"since": frame["seq"]})
+        self.assertEqual((frame["type"], frame["lamps"]), ("delta", []))
+
+    async def test_since_older_than_floor_falls_back_to_snapshot(self):
+        seq = (await self._sync("/ws/light/"))["seq"]
+        # e.g. a lamp was shared or deleted: deltas cannot express that
+        await sync_to_async(LampStateSequence.bump_floor)()
+        frame = await self._sync(f"/ws/light/?since={seq}")
+        self.assertEqual(frame["type"], "snapshot")
+        self.assertEqual(len(frame["lamps"]), 2)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_ENABLED=False)
+class LampGroupTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        self.friend = User.objects.create_user(username="carol", password="pass", phone_number="2")
+        room = Room.objects.create(home=Home.objects.create(owner=self.owner, name="Home"), name="Hall")
+        self.lamp = Lamp.objects.create(room=room, name="Ceiling")
+
+    def _share(self, add):
+        with self.captureOnCommitCallbacks(execute=True):
+            if add:
+                self.lamp.shared_with.add(self.friend)
+            else:
+                self.lamp.shared_with.clear()
+
+    async def _wait_for_membership(self, layer, member):
+        for _ in range(100):
+            if member(layer.groups.get(lamp_group(self.lamp.token), {})):
+                return
+            await asyncio.sleep(0.01)
+        self.fail("lamp group membership did not change")
+
+    async def test_sharing_changes_lamp_group_membership(self):
+        communicator = WebsocketCommunicator(LightConsumer.as_asgi(), "/ws/light/?sync=on_request")
+        communicator.scope["user"] = self.friend
+        await communicator.connect()
+        layer = get_channel_layer()
+        self.assertNotIn(lamp_group(self.lamp.token), layer.groups)
+
+        await sync_to_async(self._share)(True)
+        await self._wait_for_membership(layer, lambda members: len(members) == 1)
+        update = {"type": "lamp.status", "text": {"token": str(self.lamp.token), "status": True}}
+        await layer.group_send(lamp_group(self.lamp.token), update)
+        self.assertEqual((await communicator.receive_json_from())["status"], True)
+
+        await sync_to_async(self._share)(False)
+        await self._wait_for_membership(layer, lambda members: not members)
+        await communicator.disconnect()
+
+    def _move_room(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            room = self.lamp.room
+            room.home = Home.objects.create(owner=self.friend, name="Cabin")
+            room.save()
+
+    def _hand_over_home(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            home = self.lamp.room.home
+            home.owner = self.friend
+            home.save()
+
+    async def _assert_hand_over(self, change):
+        sockets = []
+        for user in (self.owner, self.friend):
+            communicator = WebsocketCommunicator(LightConsumer.as_asgi(), "/ws/light/?sync=on_request")
+            communicator.scope["user"] = user
+            await communicator.connect()
+            sockets.append(communicator)
+        layer = get_channel_layer()
+        before = set(layer.groups[lamp_group(self.lamp.token)])
+        self.assertEqual(len(before), 1)
+        # alice's socket leaves the lamp group and carol's joins it
+        await sync_to_async(change)()
+        await self._wait_for_membership(layer, lambda members: len(members) == 1 and set(members) != before)
+        for communicator in sockets:
+            await communicator.disconnect()
+
+    async def test_moving_a_room_to_another_home_changes_lamp_group_membership(self):
+        await self._assert_hand_over(self._move_room)
+
+    async def test_changing_a_home_owner_changes_lamp_group_membership(self):
+        await self._assert_hand_over(self._hand_over_home)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_ENABLED=False, LIGHT_WS_COALESCE_WINDOW=0.05)
+class CoalescingTests(SimpleTestCase):
+    async def _updates(self, query_string, events):
+        consumer = LightConsumer()
+        consumer.scope = {"query_string": query_string}
+        consumer.send_json = self._capture
+        self.frames = []
+        for event in events:
+            await consumer.lamp_status({"type": "lamp.status", "text": event})
+        await asyncio.sleep(0.1)
+        return self.frames
+
+    async def _capture(self, content):
+        self.frames.append(content)
+
+    async def test_window_keeps_latest_state_per_lamp_in_one_frame(self):
+        frames = await self._updates(b"", [
+            {"token": "a", "status": True, "lamp": "A"},
+            {"token": "a", "status": False},
+            {"token": "b", "status": True},
+            {"token": "a", "status": True},
+        ])
+        self.assertEqual(frames, [{"type": "batch", "events": [
+            {"token": "a", "status": True, "lamp": "A"},
+            {"token": "b", "status": True},
+        ]}])
+
+    async def test_per_lamp_clients_get_one_frame_per_lamp(self):
+        frames = await self._updates(b"sync=per_lamp", [
+            {"token": "a", "status": True},
+            {"token": "a", "status": False},
+            {"token": "b", "status": True},
+        ])
+        self.assertEqual(frames, [{"token": "a", "status": False}, {"token": "b", "status": True}])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_ENABLED=False, LIGHT_WS_COALESCE_WINDOW=0)
+class MsgpackSubprotocolTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        room = Room.objects.create(home=Home.objects.create(owner=self.owner, name="Home"), name="Hall")
+        self.lamp = Lamp.objects.create(room=room, name="Ceiling", status=True)
+
+    async def test_frames_are_compact_arrays_with_binary_tokens(self):
+        communicator = WebsocketCommunicator(
+            LightConsumer.as_asgi(), "/ws/light/", subprotocols=[ws_codec.SUBPROTOCOL, "other"]
+        )
+        communicator.scope["user"] = self.owner
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual(subprotocol, ws_codec.SUBPROTOCOL)
+
+        snapshot = msgpack.unpackb(await communicator.receive_from(), raw=False)
+        self.assertEqual(snapshot[0], ws_codec.FRAME_SNAPSHOT)
+        self.assertEqual(snapshot[2], [[self.lamp.token.bytes, True, False, "Ceiling", "Hall"]])
+
+        await get_channel_layer().group_send(lamp_group(self.lamp.token), {
+            "type": "lamp.status",
+            "text": {"token": str(self.lamp.token), "status": False, "lamp": "Ceiling", "raw": {"msg": "OFF"}},
+        })
+        update = msgpack.unpackb(await communicator.receive_from(), raw=False)
+        self.assertEqual(update, [ws_codec.FRAME_UPDATE, self.lamp.token.bytes, False, None, "Ceiling", None, False])
+        await communicator.disconnect()
+
+    async def test_subscribe_accepts_binary_lamp_tokens(self):
+        await sync_to_async(Lamp.objects.create)(room_id=self.lamp.room_id, name="Desk")
+        communicator = WebsocketCommunicator(
+            LightConsumer.as_asgi(), "/ws/light/?sync=on_request", subprotocols=[ws_codec.SUBPROTOCOL]
+        )
+        communicator.scope["user"] = self.owner
+        await communicator.connect()
+        message = {"type": "subscribe", "lamps": [self.lamp.token.bytes]}
+        await communicator.send_to(bytes_data=msgpack.packb(message, use_bin_type=True))
+        snapshot = msgpack.unpackb(await communicator.receive_from(), raw=False)
+        self.assertEqual([row[0] for row in snapshot[2]], [self.lamp.token.bytes])
+        await communicator.disconnect()
+
+    def test_client_message_token_may_be_raw_bytes(self):
+        token = "550e8400-e29b-41d4-a716-446655440000"
+        data = msgpack.packb({"since": 3, "token": uuid.UUID(token).bytes}, use_bin_type=True)
+        self.assertEqual(ws_codec.decode_message(data), {"since": 3, "token": token})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_ENABLED=False, LIGHT_WS_COALESCE_WINDOW=0)
+class SubscriptionFilterTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        home = Home.objects.create(owner=self.owner, name="Home")
+        self.hall = Room.objects.create(home=home, name="Hall")
+        self.kitchen = Room.objects.create(home=home, name="Kitchen")
+        self.hall_lamp = Lamp.objects.create(room=self.hall, name="Ceiling")
+        self.kitchen_lamp = Lamp.objects.create(room=self.kitchen, name="Counter")
+
+    async def test_subscribe_restricts_snapshot_and_events(self):
+        communicator = WebsocketCommunicator(LightConsumer.as_asgi(), "/ws/light/?sync=on_request")
+        communicator.scope["user"] = self.owner
+        await communicator.connect()
+        await communicator.send_json_to({"type": "subscribe", "rooms": [self.hall.id]})
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual([row[3] for row in snapshot["lamps"]], ["Ceiling"])
+
+        layer = get_channel_layer()
+        for lamp in (self.kitchen_lamp, self.hall_lamp):
+            await layer.group_send(lamp_group(lamp.token), {
+                "type": "lamp.status", "text": {"token": str(lamp.token), "status": True},
+            })
+        self.assertEqual((await communicator.receive_json_from())["token"], str(self.hall_lamp.token))
+        self.assertTrue(await communicator.receive_nothing())
+
+        # an empty filter goes back to every visible lamp
+        await communicator.send_json_to({"type": "subscribe"})
+        self.assertEqual(len((await communicator.receive_json_from())["lamps"]), 2)
+        await communicator.disconnect()
+
+
+class _FakeRedis:
+    """The sorted-set subset of redis-py that PresenceRegistry uses."""
+
+    def __init__(self):
+        self.sets = {}
+        self.lookups = 0
+        self.down = False
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def execute(self):
+        if self.down:
+            raise ConnectionError("redis is down")
+
+    def zadd(self, key, mapping):
+        self.sets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        self.sets.get(key, {}).pop(member, None)
+
+    def zremrangebyscore(self, key, low, high):
+        members = self.sets.get(key, {})
+        for member in [m for m, score in members.items() if score <= high]:
+            del members[member]
+
+    def expire(self, key, seconds):
+        pass
+
+    def zcount(self, key, low, high):
+        if self.down:
+            raise ConnectionError("redis is down")
+        self.lookups += 1
+        return sum(1 for score in self.sets.get(key, {}).values() if score >= low)
+
+
+class PresenceRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = _FakeRedis()
+        self.registry = PresenceRegistry(client=self.redis, cache_seconds=60, enabled=True)
+
+    def test_watched_until_last_socket_leaves(self):
+        self.assertFalse(self.registry.is_watched("t1"))
+        self.registry.join({"t1"}, "chan-a")
+        self.registry.join({"t1"}, "chan-b")
+        self.registry.forget()
+        self.assertTrue(self.registry.is_watched("t1"))
+        self.registry.leave({"t1"}, "chan-a")
+        self.registry.forget()
+        self.assertTrue(self.registry.is_watched("t1"))
+        self.registry.leave({"t1"}, "chan-b")
+        self.registry.forget()
+        self.assertFalse(self.registry.is_watched("t1"))
+
+    def test_answers_are_cached_until_a_join_is_announced(self):
+        self.assertFalse(self.registry.is_watched("t1"))
+        self.registry.join({"t1"}, "chan-a")
+        self.assertFalse(self.registry.is_watched("t1"))
+        self.assertEqual((self.redis.lookups, self.registry.hits), (1, 1))
+        self.registry.handle_joined(joined_message({"t1"}))
+        self.assertTrue(self.registry.is_watched("t1"))
+        self.assertEqual(self.redis.lookups, 2)
+
+    def test_fails_open_while_redis_is_down(self):
+        self.redis.down = True
+        self.assertTrue(self.registry.is_watched("t1"))
+        self.redis.down = False
+        # not retried before PRESENCE_RETRY_SECONDS
+        self.assertTrue(self.registry.is_watched("t1"))
+        self.assertEqual(self.redis.lookups, 0)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_ENABLED=False)
+class PresenceFanOutTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        room = Room.objects.create(home=Home.objects.create(owner=self.owner, name="Home"), name="Hall")
+        self.lamp = Lamp.objects.create(room=room, name="Ceiling")
+        self.token = str(self.lamp.token)
+        lamp_cache.warm()
+        self.redis = _FakeRedis()
+        self.registry = PresenceRegistry(client=self.redis, cache_seconds=60, enabled=True)
+
+    def test_unwatched_lamp_only_wakes_waiting_commands(self):
+        pipeline = IngestPipeline(hooks=[], presence=self.registry)
+        event = pipeline.handle(f"Devices/{self.token}/status", b'{"msg": "ON"}')
+        self.assertEqual([group for group, _ in event.sends], [confirm_group(self.token)])
+        event = pipeline.handle(f"Devices/{self.token}/status", b'{"establish": "Connected"}')
+        self.assertEqual(event.sends, [])
+        self.assertEqual(self.registry.skipped, 2)
+        self.lamp.refresh_from_db()
+        self.assertTrue(self.lamp.status)
+
+    async def test_light_consumer_maintains_presence(self):
+        layer = get_channel_layer()
+        announcements = await layer.new_channel()
+        await layer.group_add(PRESENCE_GROUP, announcements)
+        with patch("MQTT.consumers.presence", self.registry):
+            communicator = WebsocketCommunicator(LightConsumer.as_asgi(), "/ws/light/?sync=on_request")
+            communicator.scope["user"] = self.owner
+            await communicator.connect()
+            self.assertEqual(len(self.redis.sets[presence_key(self.token)]), 1)
+            self.assertEqual((await layer.receive(announcements))["tokens"], [self.token])
+            await communicator.disconnect()
+        self.assertEqual(self.redis.sets[presence_key(self.token)], {})
+
+    async def test_heartbeat_keeps_an_open_socket_watched_past_the_ttl(self):
+        clock = [1000.0]
+        registry = PresenceRegistry(
+            client=self.redis, ttl=30, heartbeat_seconds=0.01, cache_seconds=0, enabled=True,
+            clock=lambda: clock[0],
+        )
+        registry.join({"dead"}, "worker-gone")
+        with patch("MQTT.consumers.presence", registry):
+            communicator = WebsocketCommunicator(LightConsumer.as_asgi(), "/ws/light/?sync=on_request")
+            communicator.scope["user"] = self.owner
+            await communicator.connect()
+            clock[0] += 60
+            await asyncio.sleep(0.05)
+            self.assertTrue(registry.is_watched(self.token))
+            # a socket that vanished without disconnecting ages out
+            self.assertFalse(registry.is_watched("dead"))
+            await communicator.disconnect()
+        self.assertFalse(registry.is_watched(self.token))
+
+
+class JWTHandshakeTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="alice", password="pass", phone_number="1")
+        channels_jwt_middleware.user_cache.clear()
+        self.seen = []
+
+        async def inner(scope, receive, send):
+            self.seen.append(scope)
+
+        self.app = JWTAuthMiddlewareStack(inner)
+
+    def _handshake(self, token):
+        scope = {"type": "websocket", "query_string": f"token={token}".encode()}
+        async_to_sync(self.app)(scope, None, None)
+        return self.seen[-1]["user"]
+
+    def test_reconnect_is_served_from_cache_without_session(self):
+        token = str(AccessToken.for_user(self.user))
+        # the user row, nothing from the session tables
+        with self.assertNumQueries(1):
+            self.assertEqual(self._handshake(token), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self._handshake(token), self.user)
+        self.assertNotIn("session", self.seen[-1])
+        stats = channels_jwt_middleware.cache_stats()["users"]
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_expired_and_inactive_tokens_are_rejected(self):
+        expired = AccessToken.for_user(self.user)
+        expired.set_exp(lifetime=-timedelta(seconds=1))
+        self.assertFalse(self._handshake(str(expired)).is_authenticated)
+
+        token = str(AccessToken.for_user(self.user))
+        self.assertTrue(self._handshake(token).is_authenticated)
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(self._handshake(token).is_authenticated)
+
+
+class _RecordingPublisher:
+    def __init__(self):
+        self.published = []
+        self.bursts = 0
+
+    def publish_many(self, messages):
+        self.bursts += 1
+        self.published.extend(messages)
+        return []
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_ENABLED=False)
+class SchedulerTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        room = Room.objects.create(home=Home.objects.create(owner=self.owner, name="Home"), name="Hall")
+        self.lamp = Lamp.objects.create(room=room, name="Ceiling")
+        self.start = now().replace(microsecond=0)
+        self.publisher = _RecordingPublisher()
+        self.engine = ScheduleEngine(
+            horizon=600, max_sleep=300, publisher=self.publisher, presence=PresenceRegistry(enabled=False)
+        )
+
+    def schedule(self, on, off):
+        schedule = UserSchedule.objects.create(
+            owner=self.owner, on_time=self.start + timedelta(seconds=on), off_time=self.start + timedelta(seconds=off)
+        )
+        LampSchedul.objects.create(lamp=self.lamp, user_schedul=schedule)
+        return schedule
+
+    def test_sleeps_until_next_transition_and_fires_it(self):
+        self.schedule(60, 120)
+        self.schedule(700, 800)  # beyond the first window
+        self.assertEqual(self.engine.run_once(self.start), 60)
+        # one queued transition per schedule: the next one is queued when it fires
+        self.assertEqual(len(self.engine), 1)
+        self.engine.run_once(self.start + timedelta(seconds=60))
+        self.assertEqual(self.publisher.published, [(f"Devices/{self.lamp.token}/command", "ON")])
+        self.assertEqual(self.engine.run_once(self.start + timedelta(seconds=60)), 60)
+        self.engine.run_once(self.start + timedelta(seconds=120))
+        # past half of the window the next one is loaded with one query
+        # (and the checkpoint is stored with another)
+        with self.assertNumQueries(2):
+            self.engine.run_once(self.start + timedelta(seconds=301))
+        self.assertEqual(len(self.engine), 1)
+
+    def test_edits_replace_queued_transitions(self):
+        moved = self.schedule(60, 120)
+        deleted = self.schedule(30, 90)
+        self.engine.run_once(self.start)
+        moved.on_time = self.start + timedelta(seconds=100)
+        moved.save()
+        deleted_id = deleted.pk
+        deleted.delete()
+        self.engine.reload([moved.pk, deleted_id])
+        self.assertEqual(self.engine.next_delay(self.start), 100)
+        self.engine.run_once(self.start + timedelta(seconds=120))
+        self.assertEqual([payload for _, payload in self.publisher.published], ["ON", "OFF"])
+
+    def test_reload_of_an_already_due_schedule_still_fires_it(self):
+        schedule = self.schedule(60, 120)
+        schedule.recurrence = "FREQ=DAILY"
+        schedule.save()
+        self.engine.run_once(self.start)
+        # the change notification arrives after the transition was due
+        self.engine.clock = lambda: self.start + timedelta(seconds=70)
+        self.engine.reload([schedule.pk])
+        self.engine.run_once(self.start + timedelta(seconds=70))
+        self.assertEqual([payload for _, payload in self.publisher.published], ["ON"])
+        schedule.refresh_from_db()
+        self.assertEqual((schedule.next_fire_at, schedule.next_status), (self.start + timedelta(seconds=120), False))
+
+    def test_revoked_share_stops_the_schedule_switching_the_lamp(self):
+        friend = get_user_model().objects.create_user(username="bob", password="pass", phone_number="2")
+        self.lamp.room.home.shared_with.add(friend)
+        schedule = UserSchedule.objects.create(
+            owner=friend, on_time=self.start + timedelta(seconds=60), off_time=self.start + timedelta(seconds=120)
+        )
+        LampSchedul.objects.create(lamp=self.lamp, user_schedul=schedule)
+        self.engine.run_once(self.start)
+        self.lamp.room.home.shared_with.remove(friend)
+        self.engine.run_once(self.start + timedelta(seconds=60))
+        self.assertEqual(self.publisher.published, [])
+        schedule.refresh_from_db()
+        # the schedule itself still advances
+        self.assertEqual(schedule.next_fire_at, self.start + timedelta(seconds=120))
+
+    def test_recurring_schedule_advances_after_each_fire(self):
+        schedule = self.schedule(60, 120)
+        schedule.recurrence = "FREQ=DAILY"
+        schedule.save()
+        self.engine.run_once(self.start)
+        self.engine.run_once(self.start + timedelta(seconds=120))
+        self.assertEqual([payload for _, payload in self.publisher.published], ["ON", "OFF"])
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.next_fire_at, self.start + timedelta(days=1, seconds=60))
+        self.assertTrue(schedule.next_status)
+
+    def test_transitions_sharing_a_tick_fire_as_one_burst(self):
+        room = self.lamp.room
+        hall = [Lamp.objects.create(room=room, name=f"Hall {i}") for i in range(3)]
+        first, second = self.schedule(60, 120), self.schedule(60, 180)
+        for lamp in hall:
+            LampSchedul.objects.create(lamp=lamp, user_schedul=first)
+        # the ceiling lamp is in both schedules; it gets one command
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(lamp_group(str(self.lamp.token)), channel)
+        self.engine.run_once(self.start)
+        last_seq = LampStateSequence.current()[0]
+        # lamps, state sequence (2), bulk status write, advancing the two
+        # schedules (2), the checkpoint, plus the savepoint pair of the nested
+        # transaction
+        with self.assertNumQueries(9):
+            self.engine.run_once(self.start + timedelta(seconds=60))
+        self.assertEqual(self.publisher.bursts, 1)
+        self.assertEqual(len(self.publisher.published), 4)
+        self.assertEqual({payload for _, payload in self.publisher.published}, {"ON"})
+        lamps = Lamp.objects.filter(pk__in=[self.lamp.pk, *(lamp.pk for lamp in hall)])
+        self.assertTrue(all(lamp.status for lamp in lamps))
+        self.assertEqual(sorted(lamp.state_seq for lamp in lamps), list(range(last_seq + 1, last_seq + 5)))
+        message = async_to_sync(layer.receive)(channel)
+        self.assertEqual((message["type"], message["text"]["status"]), ("lamp.status", True))
+        stats = self.engine.stats()
+        self.assertEqual((stats["ticks"], stats["commands"]), (1, 4))
+        self.assertGreaterEqual(stats["max_lag"], 0)
+
+    def test_lag_is_measured_when_the_burst_is_published(self):
+        self.schedule(60, 120)
+        self.engine.run_once(self.start)
+        clock = iter([self.start + timedelta(seconds=61), self.start + timedelta(seconds=99)])
+        # the second reading would be after the status write and fan-out
+        self.engine.clock = lambda: next(clock)
+        self.engine.run_once(self.start + timedelta(seconds=60))
+        self.assertEqual(self.engine.stats()["last_lag"], 1.0)
+
+    def test_restart_applies_only_missed_final_states(self):
+        evening = Lamp.objects.create(room=self.lamp.room, name="Porch")
+        daily = self.schedule(60, 120)
+        daily.recurrence = "FREQ=DAILY"
+        daily.save()
+        LampSchedul.objects.create(lamp=evening, user_schedul=daily)
+        later = self.schedule(3000, 4000)
+        ScheduleCheckpoint.store(self.start)
+        # down for two days and a bit: the daily schedule is on again, the
+        # one-off one ran its whole course
+        restart = self.start + timedelta(days=2, seconds=90)
+        with self.assertNumQueries(10):
+            self.assertEqual(self.engine.catch_up(restart), 2)
+        self.assertEqual(self.publisher.bursts, 1)
+        # the ceiling lamp's last transition is the daily ON, after later's OFF
+        self.assertEqual(
+            sorted(self.publisher.published),
+            sorted([(f"Devices/{self.lamp.token}/command", "ON"), (f"Devices/{evening.token}/command", "ON")]),
+        )
+        daily.refresh_from_db()
+        later.refresh_from_db()
+        self.assertEqual((daily.next_fire_at, daily.next_status), (self.start + timedelta(days=2, seconds=120), False))
+        self.assertIsNone(later.next_fire_at)
+        self.assertEqual(ScheduleCheckpoint.load(), restart)
+        # a second start has nothing left to catch up
+        self.assertEqual(self.engine.catch_up(restart + timedelta(seconds=1)), 0)
+
+    def test_transition_between_catch_up_and_first_load_fires(self):
+        daily = self.schedule(5, 60)
+        daily.recurrence = "FREQ=DAILY"
+        daily.save()
+        ScheduleCheckpoint.store(self.start)
+        self.engine.catch_up(self.start + timedelta(seconds=4))
+        # the loop's first wake-up comes after the transition was due
+        self.engine.run_once(self.start + timedelta(seconds=6))
+        self.assertEqual([payload for _, payload in self.publisher.published], ["ON"])
+        daily.refresh_from_db()
+        self.assertEqual(daily.next_fire_at, self.start + timedelta(seconds=60))
+
+    def test_first_start_advances_overdue_schedules_without_firing(self):
+        daily = self.schedule(60, 120)
+        daily.recurrence = "FREQ=DAILY"
+        daily.save()
+        # next_fire_at was filled (by the migration) before these passed
+        restart = self.start + timedelta(seconds=90)
+        self.assertEqual(self.engine.catch_up(restart), 0)
+        self.assertEqual(self.publisher.published, [])
+        self.assertEqual(ScheduleCheckpoint.load(), restart)
+        daily.refresh_from_db()
+        self.assertEqual((daily.next_fire_at, daily.next_status), (self.start + timedelta(seconds=120), False))
+        self.engine.run_once(self.start + timedelta(seconds=120))
+        self.assertEqual([payload for _, payload in self.publisher.published], ["OFF"])
+
+    def test_schedule_saves_are_announced_to_the_scheduler(self):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(SCHEDULE_GROUP, channel)
+        with self.captureOnCommitCallbacks(execute=True):
+            schedule = self.schedule(60, 120)
+        message = async_to_sync(layer.receive)(channel)
+        self.engine.handle_changed(message)
+        self.assertEqual(message["schedules"], [schedule.pk])
+        self.assertTrue(self.engine.wake.is_set())
@@ -0,0 +1,119 @@
+"""Write-behind buffer for device status/connection updates.
+
+Flapping devices and devices that report on a timer used to cost one UPDATE
+per message, and SQLite serialises all of them against the web workers. The
+bridge records the latest state per lamp here instead and a background
+thread persists everything that changed with one ``bulk_update`` per field
+set every ``MQTT_WRITE_BEHIND_INTERVAL`` seconds (or as soon as
+``MQTT_WRITE_BEHIND_MAX_BATCH`` lamps are pending). WebSocket fan-out is not
+delayed; only persistence is.
+"""
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from Places_Lamp.models import Lamp, LampStateSequence
+
+
+class WriteBehindBuffer:
+    """Coalesce ``lamp_id -> latest state`` and flush it periodically."""
+
+    def __init__(self, interval=None, max_batch=None):
+        self.interval = (
+            interval if interval is not None else getattr(settings, "MQTT_WRITE_BEHIND_INTERVAL", 1.0)
+        )
+        self.max_batch = max(1, max_batch or getattr(settings, "MQTT_WRITE_BEHIND_MAX_BATCH", 500))
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.recorded = 0
+        self.flushed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def record(self, lamp_id, status=None, connection=None):
+        """Remember the newest state for ``lamp_id``; later values win."""
+        with self._lock:
+            state = self._pending.setdefault(lamp_id, {})
+            if status is not None:
+                state["status"] = bool(status)
+            if connection is not None:
+                state["connection"] = bool(connection)
+            self.recorded += 1
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Persist everything pending; returns the number of lamps written."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            try:
+                self._write(pending)
+            except Exception as e:
+                print("⚠️ Write-behind flush failed, will retry:", e, flush=True)
+                self._requeue(pending)
+                return 0
+            self.flushed += len(pending)
+            return len(pending)
+
+    def _write(self, pending):
+        # bulk_update writes the same columns for every object, so group the
+        # lamps by which fields actually changed.
+        by_fields = defaultdict(list)
+        with transaction.atomic():
+            # one block of state sequence numbers for the whole flush
+            seq = LampStateSequence.allocate(len(pending))
+            for offset, (lamp_id, state) in enumerate(pending.items()):
+                lamp = Lamp(pk=lamp_id, state_seq=seq + offset, **state)
+                by_fields[tuple(sorted(state)) + ("state_seq",)].append(lamp)
+            for fields, lamps in by_fields.items():
+                Lamp.objects.bulk_update(lamps, fields, batch_size=self.max_batch)
+
+    def _requeue(self, pending):
+        with self._lock:
+            for lamp_id, state in pending.items():
+                # anything recorded since the swap is newer and must win
+                newer = self._pending.get(lamp_id, {})
+                self._pending[lamp_id] = {**state, **newer}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="mqtt-write-behind", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            close_old_connections()
+            self.flush()
+
+    def stop(self):
+        """Stop the flush thread and persist whatever is still pending."""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=max(self.interval, 1.0) + 5)
+            self._thread = None
+        self.flush()
+
+
+def build_write_buffer():
+    """Return a started buffer, or None when write-behind is disabled."""
+    interval = getattr(settings, "MQTT_WRITE_BEHIND_INTERVAL", 1.0)
+    if not interval or interval <= 0:
+        return None
+    return WriteBehindBuffer(interval=interval).start()
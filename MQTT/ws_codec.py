@@ -0,0 +1,95 @@
+"""MessagePack encoding of ``LightConsumer`` frames (``smartlight.msgpack.v1``).
+
+JSON frames repeat every key and carry tokens as 36-character strings. A
+client that offers the ``smartlight.msgpack.v1`` WebSocket subprotocol gets
+binary frames instead: positional arrays tagged with a frame kind, tokens as
+the 16 raw UUID bytes, and no ``raw`` device payload.
+
+Frames (server → client)::
+
+    [0, token, status, establish, lamp, room, deleted]        # update
+    [1, [[token, status, establish, lamp, room, deleted], …]] # batch
+    [2, seq, [[token, status, establish, lamp, room], …]]     # snapshot
+    [3, seq, since, [[token, status, establish, lamp, room], …]]  # delta
+
+``status``/``establish`` are ``nil`` when the event does not carry them.
+Client messages are msgpack maps with the same keys as the JSON messages;
+a 16-byte ``token`` (or element of a ``subscribe`` message's ``lamps``) is
+accepted in place of the UUID string.
+"""
+import uuid
+
+import msgpack
+
+
+SUBPROTOCOL = "smartlight.msgpack.v1"
+
+FRAME_UPDATE = 0
+FRAME_BATCH = 1
+FRAME_SNAPSHOT = 2
+FRAME_DELTA = 3
+
+
+def pack_token(token):
+    """16 raw bytes for a UUID token; anything else is passed through as a string."""
+    try:
+        return uuid.UUID(str(token)).bytes
+    except (TypeError, ValueError):
+        return None if token is None else str(token)
+
+
+def unpack_token(token):
+    if isinstance(token, bytes) and len(token) == 16:
+        return str(uuid.UUID(bytes=token))
+    return token
+
+
+def _optional_bool(value):
+    return None if value is None else bool(value)
+
+
+def _update(text):
+    return [
+        pack_token(text.get("token")),
+        _optional_bool(text.get("status")),
+        _optional_bool(text.get("establish")),
+        text.get("lamp"),
+        text.get("room"),
+        bool(text.get("deleted", False)),
+    ]
+
+
+def _rows(content):
+    token_at = content["fields"].index("token")
+    rows = []
+    for row in content["lamps"]:
+        row = list(row)
+        row[token_at] = pack_token(row[token_at])
+        rows.append(row)
+    return rows
+
+
+def encode_frame(content):
+    """Encode a JSON-shaped ``LightConsumer`` frame as a compact msgpack array."""
+    kind = content.get("type")
+    if kind == "snapshot":
+        frame = [FRAME_SNAPSHOT, content.get("seq"), _rows(content)]
+    elif kind == "delta":
+        frame = [FRAME_DELTA, content.get("seq"), content.get("since"), _rows(content)]
+    elif kind == "batch":
+        frame = [FRAME_BATCH, [_update(event) for event in content["events"]]]
+    else:
+        frame = [FRAME_UPDATE] + _update(content)
+    return msgpack.packb(frame, use_bin_type=True)
+
+
+def decode_message(data):
+    """Decode a client message into the dict ``receive_json`` expects."""
+    content = msgpack.unpackb(data, raw=False)
+    if not isinstance(content, dict):
+        raise ValueError("smartlight.msgpack.v1 messages must be maps")
+    if "token" in content:
+        content["token"] = unpack_token(content["token"])
+    if isinstance(content.get("lamps"), list):
+        content["lamps"] = [unpack_token(token) for token in content["lamps"]]
+    return content
@@ -7,23 +7,30 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import status
 from Places_Lamp.services.lamp_control import set_lamp_status
+from Places_Lamp.schedule_index import schedule_indexes
 from VoiceAgent.services import exceptions as voice_exceptions
+from rest_framework.authentication import SessionAuthentication
+from User.authentication import LazyJWTAuthentication
+
+# Token-backed request.user: filter on <relation>_id=user.id so no user row is loaded.
+TOKEN_USER_AUTHENTICATION = [LazyJWTAuthentication, SessionAuthentication]
 
 class HomeHandller(viewsets.ModelViewSet):
     http_method_names = ['get', 'post', 'head', 'options']
     queryset = Home.objects.all()
     def get_queryset(self):
         user = self.request.user
-        return Home.objects.filter(owner=user)
+        return Home.objects.filter(owner_id=user.id)
     def get_serializer_class(self):
         if self.action in ["list", "retrieve"]:
             return HomeViewSerializer
         elif self.action in ["create", "update", "partial_update"] : 
             return HomePostSerializer
     def perform_create(self, serializer):
-        serializer.save(owner=self.request.user)
+        serializer.save(owner_id=self.request.user.id)
 
     permission_classes = [IsAuthenticated]
+    authentication_classes = TOKEN_USER_AUTHENTICATION
 
 # class ListRoom(ListAPIView) : 
 #     def get_queryset(self):
@@ -44,7 +51,7 @@ class RoomHandller(viewsets.ModelViewSet) :
         user = self.request.user
         # Room has no direct owner field; ownership is via the parent Home.
         return Room.objects.filter(
-            Q(home__owner=user) | Q(home__shared_with=user)
+            Q(home__owner_id=user.id) | Q(home__shared_with=user.id)
         ).distinct()
     def get_serializer_class(self):
         if self.action in ["list", "retrieve"]:
@@ -56,6 +63,7 @@ class RoomHandller(viewsets.ModelViewSet) :
         context["request"] = self.request
         return context
     permission_classes = [IsAuthenticated]
+    authentication_classes = TOKEN_USER_AUTHENTICATION
     
 
 # class LampView(ListAPIView) : 
@@ -78,10 +86,8 @@ class LampHandeller(viewsets.ModelViewSet) :
     http_method_names = ['get', 'post', 'head', 'options', 'patch']
     def get_queryset(self):
         user = self.request.user
-        return Lamp.objects.filter(
-            Q(room__home__owner = user) |
-            Q(shared_with = user)
-                            ).distinct()
+        # owned, shared directly or shared via the home
+        return Lamp.objects.accessible_by(user)
     def get_serializer_class(self):
         if self.action in ["list", "retrieve"]:
             return LampViewSerializer
@@ -92,6 +98,7 @@ class LampHandeller(viewsets.ModelViewSet) :
         context["request"] = self.request
         return context
     permission_classes=[IsAuthenticated]
+    authentication_classes = TOKEN_USER_AUTHENTICATION
 
     @action(detail=True, methods=["patch"], url_path="status")
     def set_status(self, request, pk=None):
@@ -116,9 +123,9 @@ class LampHandeller(viewsets.ModelViewSet) :
             )
 
         try:
-            # Core logic (permissions + MQTT + polling) lives in the shared
+            # Core logic (permissions + MQTT + confirmation) lives in the shared
             # service so it can be reused by the voice agent.
-            set_lamp_status(
+            result = set_lamp_status(
                 user=request.user,
                 lamp=lamp,
                 desired_status=bool(new_status),
@@ -148,20 +155,41 @@ class LampHandeller(viewsets.ModelViewSet) :
                 status=status_code or status.HTTP_400_BAD_REQUEST,
             )
 
-        # On success, return the full lamp representation as before.
+        # On success, return the full lamp representation as before. The
+        # bridge may persist the confirmed status a moment later
+        # (write-behind), so report the status the device confirmed.
+        confirmed = Lamp.objects.get(pk=lamp.pk)
+        confirmed.status = result["status"]
         serializer = LampViewSerializer(
-            Lamp.objects.get(pk=lamp.pk),
+            confirmed,
             context=self.get_serializer_context(),
         )
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=["get"], url_path="schedule_conflicts")
+    def schedule_conflicts(self, request, pk=None):
+        """
+        Pairs of schedules attached to this lamp whose windows overlap, with
+        the first overlapping span of each pair (recurring schedules are
+        checked SCHEDULE_CONFLICT_HORIZON days ahead).
+        """
+        lamp = self.get_object()
+        conflicts = schedule_indexes.get(lamp.pk).conflicts()
+        return Response(
+            [
+                {"schedules": [first, second], "start": start, "end": end}
+                for first, second, start, end in conflicts
+            ],
+            status=status.HTTP_200_OK,
+        )
+
 class LampSchedulHandeller(viewsets.ModelViewSet) : 
     queryset = LampSchedul.objects.all()
     http_method_names = ['get', 'post', 'head', 'options']
     def get_queryset(self):
         # it does only effect on GET and not POST requests
         user = self.request.user
-        return LampSchedul.objects.filter(user_schedul__owner=user)
+        return LampSchedul.objects.filter(user_schedul__owner_id=user.id)
     def get_serializer_class(self):
         if self.action in ["list", "retrieve"]:
             return LampViewSchedulSerializer
@@ -172,19 +200,21 @@ class LampSchedulHandeller(viewsets.ModelViewSet) :
         context["request"] = self.request
         return context
     permission_classes = [IsAuthenticated]
+    authentication_classes = TOKEN_USER_AUTHENTICATION
 
 class UserSchedulLampHandeller(viewsets.ModelViewSet) : 
     queryset = LampSchedul.objects.all()
     http_method_names = ['get', 'post', 'head', 'options']
     def get_queryset(self) : 
         user = self.request.user
-        return UserSchedule.objects.filter(user_schedul__owner=user)
+        return UserSchedule.objects.filter(owner_id=user.id)
     def get_serializer_class(self):
         if self.action in ["list", "retrieve"]:
             return UserSchedulView
         elif self.action in ["create", "update", "partial_update"] : 
             return UserSchedulPost
     permission_classes = [IsAuthenticated]
+    authentication_classes = TOKEN_USER_AUTHENTICATION
     def perform_create(self, serializer):
-        serializer.save(owner=self.request.user)
+        serializer.save(owner_id=self.request.user.id)
     
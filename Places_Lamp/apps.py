@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class PlacesLampConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'Places_Lamp'
+
+    def ready(self):
+        from . import signals  # noqa: F401  (keeps LampAccess up to date)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from Places_Lamp.models import LampAccess
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the LampAccess table from homes, rooms, lamps and shares "
+        "(after raw SQL, queryset.update() or bulk_create that bypass signals)"
+    )
+
+    def handle(self, *args, **options):
+        rows = LampAccess.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt lamp access: {rows} rows"))
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:39
+
+from django.db import migrations, models
+
+
+def create_counter(apps, schema_editor):
+    apps.get_model('Places_Lamp', 'LampStateSequence').objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Places_Lamp', '0004_alter_home_name_alter_home_unique_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LampStateSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last', models.BigIntegerField(default=0)),
+                ('floor', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='lamp',
+            name='state_seq',
+            field=models.BigIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(create_counter, migrations.RunPython.noop),
+    ]
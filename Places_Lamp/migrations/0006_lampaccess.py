@@ -0,0 +1,50 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:59
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_lamp_access(apps, schema_editor):
+    Lamp = apps.get_model('Places_Lamp', 'Lamp')
+    Home = apps.get_model('Places_Lamp', 'Home')
+    LampAccess = apps.get_model('Places_Lamp', 'LampAccess')
+    rows = set()
+    lamps_by_home = {}
+    for lamp_id, home_id, owner_id in Lamp.objects.values_list('id', 'room__home_id', 'room__home__owner_id'):
+        rows.add((owner_id, lamp_id, 'owner'))
+        lamps_by_home.setdefault(home_id, []).append(lamp_id)
+    for lamp_id, user_id in Lamp.shared_with.through.objects.values_list('lamp_id', 'customeuser_id'):
+        rows.add((user_id, lamp_id, 'lamp'))
+    for home_id, user_id in Home.shared_with.through.objects.values_list('home_id', 'customeuser_id'):
+        for lamp_id in lamps_by_home.get(home_id, ()):
+            rows.add((user_id, lamp_id, 'home'))
+    LampAccess.objects.bulk_create(
+        [LampAccess(user_id=user_id, lamp_id=lamp_id, via=via) for user_id, lamp_id, via in rows],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Places_Lamp', '0005_lamp_state_seq'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LampAccess',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('via', models.CharField(choices=[('owner', 'Home owner'), ('lamp', 'Lamp shared'), ('home', 'Home shared')], max_length=5)),
+                ('lamp', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='access', to='Places_Lamp.lamp')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lamp_access', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['lamp', 'user'], name='Places_Lamp_lamp_id_f014bd_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'lamp', 'via'), name='unique_lamp_access')],
+            },
+        ),
+        migrations.RunPython(fill_lamp_access, migrations.RunPython.noop),
+    ]
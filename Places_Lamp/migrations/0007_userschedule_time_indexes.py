@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Places_Lamp', '0006_lampaccess'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='userschedule',
+            name='off_time',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='userschedule',
+            name='on_time',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:06
+
+import Places_Lamp.recurrence
+from django.db import migrations, models
+from django.utils.timezone import now
+
+
+def fill_next_fire(apps, schema_editor):
+    UserSchedule = apps.get_model('Places_Lamp', 'UserSchedule')
+    current = now()
+    schedules = list(UserSchedule.objects.all())
+    for schedule in schedules:
+        schedule.next_fire_at, schedule.next_status = Places_Lamp.recurrence.next_transition(
+            schedule.on_time, schedule.off_time, after=current
+        ) or (None, None)
+    UserSchedule.objects.bulk_update(schedules, ['next_fire_at', 'next_status'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Places_Lamp', '0007_userschedule_time_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userschedule',
+            name='next_fire_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='userschedule',
+            name='next_status',
+            field=models.BooleanField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='userschedule',
+            name='recurrence',
+            field=models.CharField(blank=True, max_length=255, validators=[Places_Lamp.recurrence.validate_recurrence]),
+        ),
+        migrations.AddField(
+            model_name='userschedule',
+            name='timezone',
+            field=models.CharField(default='UTC', max_length=64, validators=[Places_Lamp.recurrence.validate_timezone]),
+        ),
+        migrations.RunPython(fill_next_fire, migrations.RunPython.noop),
+    ]
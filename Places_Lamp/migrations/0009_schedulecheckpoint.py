@@ -0,0 +1,20 @@
+# Generated by Django 5.2.4 on 2026-10-18 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Places_Lamp', '0008_userschedule_recurrence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('processed_until', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
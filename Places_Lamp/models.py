@@ -1,6 +1,12 @@
-from django.db import models
+from collections import defaultdict
+
+from django.db import models, transaction
+from django.db.models import F
 from django.conf import settings
+from django.utils.timezone import now
 import uuid
+
+from .recurrence import Rule, next_transition, validate_recurrence, validate_timezone
 # Create your models here.
 class Home(models.Model):
     """
@@ -47,6 +53,18 @@ class Room(models.Model):
         return self.name
 
 
+class LampQuerySet(models.QuerySet):
+    def accessible_by(self, user):
+        """
+        Lamps the user owns (via the home) or that are shared with them
+        directly or via the home, looked up in the LampAccess table.
+        """
+        user_id = getattr(user, "id", None)
+        if user_id is None:
+            return self.none()
+        return self.filter(pk__in=LampAccess.objects.filter(user_id=user_id).values("lamp_id"))
+
+
 class Lamp(models.Model):
     """
     Lamp model - represents a smart lamp in a room
@@ -62,6 +80,11 @@ class Lamp(models.Model):
         related_name="shared_lamps"
     )# we can have multy access
     token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)  # 🔒 secret key
+    # LampStateSequence number of the last status/connection write; lets
+    # reconnecting WebSocket clients ask only for lamps changed since then.
+    state_seq = models.BigIntegerField(default=0, db_index=True)
+
+    objects = LampQuerySet.as_manager()
 
     class Meta:
         unique_together = ("room", "name")  # avoid global uniqueness clash
@@ -75,31 +98,248 @@ class Lamp(models.Model):
         return self.name
     
     def can_access(self, user):
-        return (
-            user == self.room.home.owner
-            or user in self.shared_with.all()
-            or user in self.room.home.shared_with.all()
+        """
+        Same rule as ``Lamp.objects.accessible_by``. Answered from
+        select_related/prefetched data when that is enough, otherwise with one
+        EXISTS query on LampAccess; memoised per user on this instance, i.e.
+        for the request or consumer event that loaded it.
+        """
+        user_id = getattr(user, "id", None)
+        if user_id is None or not getattr(user, "is_authenticated", False):
+            return False
+        memo = self.__dict__.setdefault("_access_memo", {})
+        if user_id not in memo:
+            memo[user_id] = self._loaded_access(user_id)
+            if memo[user_id] is None:
+                memo[user_id] = LampAccess.objects.filter(user_id=user_id, lamp_id=self.pk).exists()
+        return memo[user_id]
+
+    def _loaded_access(self, user_id):
+        """True/False from already-loaded relations, or None when a query is needed."""
+        home = None
+        if Lamp.room.is_cached(self) and Room.home.is_cached(self.room):
+            home = self.room.home
+            if home.owner_id == user_id:
+                return True
+        lamp_shares = getattr(self, "_prefetched_objects_cache", {}).get("shared_with")
+        if lamp_shares is not None and any(u.pk == user_id for u in lamp_shares):
+            return True
+        home_shares = getattr(home, "_prefetched_objects_cache", {}).get("shared_with")
+        if home_shares is not None and any(u.pk == user_id for u in home_shares):
+            return True
+        if home is not None and lamp_shares is not None and home_shares is not None:
+            return False
+        return None
+
+    @classmethod
+    def set_state(cls, pk, **changes):
+        """Write status/connection of one lamp and stamp it with the next state sequence."""
+        with transaction.atomic(savepoint=False):
+            seq = LampStateSequence.allocate()
+            return cls.objects.filter(pk=pk).update(state_seq=seq, **changes)
+
+
+class LampStateSequence(models.Model):
+    """
+    Single-row counter behind Lamp.state_seq.
+    `last` is the newest number handed out. Clients that synced before `floor`
+    must take a full snapshot: lamps were added, removed, renamed or re-shared,
+    which a list of state changes cannot express.
+    """
+    last = models.BigIntegerField(default=0)
+    floor = models.BigIntegerField(default=0)
+
+    @classmethod
+    def allocate(cls, count=1):
+        """
+        Reserve `count` consecutive numbers and return the first one.
+        Call it inside the transaction that writes them: the counter row stays
+        locked until commit, so numbers become visible in commit order.
+        """
+        with transaction.atomic(savepoint=False):
+            if not cls.objects.filter(pk=1).update(last=F("last") + count):
+                cls.objects.get_or_create(pk=1)
+                cls.objects.filter(pk=1).update(last=F("last") + count)
+            last = cls.objects.values_list("last", flat=True).get(pk=1)
+        return last - count + 1
+
+    @classmethod
+    def bump_floor(cls):
+        """Invalidate every delta handed out so far."""
+        with transaction.atomic(savepoint=False):
+            if not cls.objects.filter(pk=1).update(last=F("last") + 1, floor=F("last") + 1):
+                cls.objects.get_or_create(pk=1, defaults={"last": 1, "floor": 1})
+
+    @classmethod
+    def current(cls):
+        """Return `(last, floor)`."""
+        row = cls.objects.filter(pk=1).values_list("last", "floor").first()
+        return row or (0, 0)
+
+
+class LampAccess(models.Model):
+    """
+    Denormalised "user can see lamp" table: one row per path that grants
+    access (home owner, lamp share, home share). Places_Lamp.signals keeps it
+    in step with Home/Room/Lamp saves and the shared_with relations;
+    `manage.py rebuild_lamp_access` recomputes it after bulk writes that
+    bypass signals.
+    """
+    VIA_OWNER = "owner"
+    VIA_LAMP = "lamp"
+    VIA_HOME = "home"
+    VIA_CHOICES = [
+        (VIA_OWNER, "Home owner"),
+        (VIA_LAMP, "Lamp shared"),
+        (VIA_HOME, "Home shared"),
+    ]
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="lamp_access")
+    lamp = models.ForeignKey(Lamp, on_delete=models.CASCADE, related_name="access")
+    via = models.CharField(max_length=5, choices=VIA_CHOICES)
+
+    class Meta:
+        constraints = [
+            # also the (user, ...) index behind accessible_by
+            models.UniqueConstraint(fields=["user", "lamp", "via"], name="unique_lamp_access"),
+        ]
+        # "who can see this lamp"
+        indexes = [models.Index(fields=["lamp", "user"])]
+
+    @classmethod
+    def expected(cls, lamps):
+        """`(user_id, lamp_id, via)` rows the source relations grant for `lamps`."""
+        rows = set()
+        lamps_by_home = defaultdict(list)
+        for lamp_id, home_id, owner_id in lamps.values_list("id", "room__home_id", "room__home__owner_id"):
+            rows.add((owner_id, lamp_id, cls.VIA_OWNER))
+            lamps_by_home[home_id].append(lamp_id)
+        if not lamps_by_home:
+            return rows
+        for user_id, lamp_id in Lamp.shared_with.through.objects.filter(
+            lamp_id__in=lamps.values("id")
+        ).values_list("customeuser_id", "lamp_id"):
+            rows.add((user_id, lamp_id, cls.VIA_LAMP))
+        for user_id, home_id in Home.shared_with.through.objects.filter(
+            home_id__in=list(lamps_by_home)
+        ).values_list("customeuser_id", "home_id"):
+            for lamp_id in lamps_by_home[home_id]:
+                rows.add((user_id, lamp_id, cls.VIA_HOME))
+        return rows
+
+    @classmethod
+    def grant(cls, rows):
+        """Insert `(user_id, lamp_id, via)` rows; existing ones are left alone."""
+        cls.objects.bulk_create(
+            [cls(user_id=user_id, lamp_id=lamp_id, via=via) for user_id, lamp_id, via in rows],
+            batch_size=1000,
+            ignore_conflicts=True,
         )
 
+    @classmethod
+    def sync(cls, lamp_ids):
+        """Bring the rows of `lamp_ids` in line with the source relations."""
+        lamp_ids = list(lamp_ids)
+        if not lamp_ids:
+            return
+        with transaction.atomic(savepoint=False):
+            expected = cls.expected(Lamp.objects.filter(pk__in=lamp_ids))
+            stale, present = [], set()
+            for pk, *row in cls.objects.filter(lamp_id__in=lamp_ids).values_list(
+                "pk", "user_id", "lamp_id", "via"
+            ):
+                row = tuple(row)
+                if row in expected:
+                    present.add(row)
+                else:
+                    stale.append(pk)
+            if stale:
+                cls.objects.filter(pk__in=stale).delete()
+            cls.grant(expected - present)
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute the whole table; returns the number of rows."""
+        with transaction.atomic():
+            cls.objects.all().delete()
+            rows = cls.expected(Lamp.objects.all())
+            cls.grant(rows)
+        return len(rows)
+
+
+class UserScheduleQuerySet(models.QuerySet):
+    def firing_between(self, start, end):
+        """Schedules whose next transition is in ``[start, end)``; an index range scan."""
+        return self.filter(next_fire_at__gte=start, next_fire_at__lt=end)
+
 
 class UserSchedule(models.Model):
 
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    on_time = models.DateTimeField()
-    off_time = models.DateTimeField()
-    
-    
+    # first occurrence; `recurrence` repeats it (see Places_Lamp/recurrence.py)
+    on_time = models.DateTimeField(db_index=True)
+    off_time = models.DateTimeField(db_index=True)
+    recurrence = models.CharField(max_length=255, blank=True, validators=[validate_recurrence])
+    timezone = models.CharField(max_length=64, default="UTC", validators=[validate_timezone])
+    # next on (next_status=True) or off transition, None once the schedule is over;
+    # kept up to date on save and by the scheduler after each fire
+    next_fire_at = models.DateTimeField(null=True, blank=True, db_index=True, editable=False)
+    next_status = models.BooleanField(null=True, editable=False)
+
+    objects = UserScheduleQuerySet.as_manager()
+
     def clean(self):
         """Validate that off_time is after on_time"""
         from django.core.exceptions import ValidationError
         if self.on_time and self.off_time and self.on_time >= self.off_time:
             raise ValidationError("Off time must be after on time")
-        
+        if self.recurrence and self.on_time and self.off_time:
+            try:
+                rule = Rule.parse(self.recurrence)
+            except ValueError:
+                return
+            if self.off_time - self.on_time >= rule.shortest_gap():
+                raise ValidationError("A recurring schedule must be off before its next occurrence")
+
+    def next_transition(self, after):
+        """``(at, status)`` of the first transition after ``after``, or None."""
+        return next_transition(self.on_time, self.off_time, self.recurrence, self.timezone, after)
+
+    def advance(self, after):
+        """Point ``next_fire_at``/``next_status`` at the first transition after ``after``."""
+        self.next_fire_at, self.next_status = self.next_transition(after) or (None, None)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or {"on_time", "off_time", "recurrence", "timezone"} & set(update_fields):
+            self.advance(now())
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "next_fire_at", "next_status"}
+        super().save(*args, **kwargs)
+
 
 class LampSchedul(models.Model) : 
     lamp = models.ForeignKey(Lamp , models.CASCADE)
     user_schedul = models.ForeignKey(UserSchedule , models.CASCADE)
 
 
+class ScheduleCheckpoint(models.Model):
+    """
+    Single-row record of the instant up to which the scheduler (MQTT.scheduler)
+    has fired every due transition. After a restart only transitions after it
+    are caught up.
+    """
+    processed_until = models.DateTimeField(null=True)
+
+    @classmethod
+    def load(cls):
+        return cls.objects.filter(pk=1).values_list("processed_until", flat=True).first()
+
+    @classmethod
+    def store(cls, instant):
+        if not cls.objects.filter(pk=1).update(processed_until=instant):
+            cls.objects.update_or_create(pk=1, defaults={"processed_until": instant})
+
+
 
 
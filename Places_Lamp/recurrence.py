@@ -0,0 +1,181 @@
+"""Recurrence rules for ``UserSchedule``.
+
+A schedule's ``on_time``/``off_time`` is its first occurrence; ``recurrence``
+repeats it with a subset of iCalendar RRULE::
+
+    FREQ=DAILY|WEEKLY;INTERVAL=<n>;BYDAY=MO,TU,...;UNTIL=<YYYYMMDD[THHMMSS[Z]]>
+
+Occurrences keep the wall-clock time of ``on_time`` in the schedule's
+``timezone``, so "every weekday at 07:00 Europe/Berlin" stays at 07:00 across
+DST changes. The on→off duration is the same for every occurrence.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from django.core.exceptions import ValidationError
+
+
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+FREQUENCIES = ("DAILY", "WEEKLY")
+
+
+class Rule:
+    """Parsed recurrence rule."""
+
+    def __init__(self, freq, interval=1, byday=None, until=None):
+        self.freq = freq
+        self.interval = interval
+        self.byday = byday
+        self.until = until
+
+    @classmethod
+    def parse(cls, text, tz=dt_timezone.utc):
+        """Parse ``text``; raises ``ValueError`` with a readable message."""
+        parts = {}
+        for part in text.strip().upper().removeprefix("RRULE:").split(";"):
+            if not part:
+                continue
+            key, sep, value = part.partition("=")
+            if not sep or not value:
+                raise ValueError(f"Malformed rule part {part!r}")
+            parts[key] = value
+        unknown = set(parts) - {"FREQ", "INTERVAL", "BYDAY", "UNTIL"}
+        if unknown:
+            raise ValueError(f"Unsupported rule parts: {', '.join(sorted(unknown))}")
+        freq = parts.get("FREQ")
+        if freq not in FREQUENCIES:
+            raise ValueError(f"FREQ must be one of {', '.join(FREQUENCIES)}")
+        try:
+            interval = int(parts.get("INTERVAL", 1))
+        except ValueError:
+            raise ValueError("INTERVAL must be a positive integer")
+        if interval < 1:
+            raise ValueError("INTERVAL must be a positive integer")
+        byday = None
+        if "BYDAY" in parts:
+            days = parts["BYDAY"].split(",")
+            if not all(day in WEEKDAYS for day in days):
+                raise ValueError(f"BYDAY takes {','.join(WEEKDAYS)}")
+            byday = frozenset(WEEKDAYS.index(day) for day in days)
+        until = None
+        if "UNTIL" in parts:
+            until = cls._parse_until(parts["UNTIL"], tz)
+        return cls(freq, interval, byday, until)
+
+    @staticmethod
+    def _parse_until(value, tz):
+        for fmt, zone in (("%Y%m%dT%H%M%SZ", dt_timezone.utc), ("%Y%m%dT%H%M%S", tz), ("%Y%m%d", tz)):
+            try:
+                until = datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            if fmt == "%Y%m%d":
+                # a date-only UNTIL includes that whole day
+                until += timedelta(days=1) - timedelta(microseconds=1)
+            return until.replace(tzinfo=zone)
+        raise ValueError("UNTIL must be YYYYMMDD or YYYYMMDDTHHMMSS[Z]")
+
+    def matches(self, day, first_day):
+        """Whether an occurrence starts on local date ``day``."""
+        if day < first_day:
+            return False
+        if self.freq == "DAILY":
+            return (day - first_day).days % self.interval == 0
+        weeks = ((day - first_day).days + first_day.weekday()) // 7
+        weekdays = self.byday if self.byday is not None else {first_day.weekday()}
+        return weeks % self.interval == 0 and day.weekday() in weekdays
+
+    def period(self):
+        """Longest gap between two occurrences."""
+        days = 1 if self.freq == "DAILY" else 7
+        return timedelta(days=days * self.interval)
+
+    def shortest_gap(self):
+        """Shortest possible gap between two occurrence starts."""
+        if self.freq == "WEEKLY" and self.byday is not None and len(self.byday) > 1:
+            return timedelta(days=1)
+        return self.period()
+
+
+def get_zone(name):
+    try:
+        return ZoneInfo(name or "UTC")
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown time zone {name!r}")
+
+
+def validate_recurrence(value):
+    if not value:
+        return
+    try:
+        Rule.parse(value)
+    except ValueError as e:
+        raise ValidationError(str(e))
+
+
+def validate_timezone(value):
+    try:
+        get_zone(value)
+    except ValueError as e:
+        raise ValidationError(str(e))
+
+
+def occurrence_after(on_time, rule, tz, after):
+    """Start of the first occurrence strictly after ``after``, or None."""
+    first = on_time.astimezone(tz)
+    if after < on_time:
+        return on_time
+    local_after = after.astimezone(tz)
+    day = max(local_after.date() - timedelta(days=1), first.date())
+    # every matching day is at most one period (plus the DST slack) away
+    for _ in range(rule.period().days + 3):
+        if rule.matches(day, first.date()):
+            start = datetime.combine(day, first.time(), tzinfo=tz).astimezone(dt_timezone.utc)
+            if start > after:
+                if rule.until is not None and start > rule.until:
+                    return None
+                return start
+        day += timedelta(days=1)
+    return None
+
+
+def next_transition(on_time, off_time, recurrence="", tz_name="UTC", after=None):
+    """
+    ``(at, status)`` of the first on (True) or off (False) transition
+    strictly after ``after``, or None when the schedule is over.
+    """
+    if on_time is None or off_time is None:
+        return None
+    if not recurrence:
+        for at, status in ((on_time, True), (off_time, False)):
+            if after is None or at > after:
+                return at, status
+        return None
+    tz = get_zone(tz_name)
+    rule = Rule.parse(recurrence, tz)
+    duration = off_time - on_time
+    if after is None:
+        return on_time, True
+    # the occurrence that is still on at ``after`` started at most ``duration`` before it
+    start = occurrence_after(on_time, rule, tz, after - duration)
+    if start is None:
+        return None
+    if start > after:
+        return start, True
+    return start + duration, False
+
+
+def windows(on_time, off_time, recurrence="", tz_name="UTC", start=None, end=None):
+    """Yield the ``(on, off)`` occurrences that overlap ``[start, end)``, in order."""
+    duration = off_time - on_time
+    if not recurrence:
+        if off_time > start and on_time < end:
+            yield on_time, off_time
+        return
+    tz = get_zone(tz_name)
+    rule = Rule.parse(recurrence, tz)
+    # an occurrence overlaps when it starts after ``start - duration``
+    current = occurrence_after(on_time, rule, tz, start - duration)
+    while current is not None and current < end:
+        yield current, current + duration
+        current = occurrence_after(on_time, rule, tz, current)
@@ -0,0 +1,155 @@
+"""Per-lamp index of schedule windows for overlap checks.
+
+Two schedules attached to the same lamp conflict when their on/off windows
+overlap: the one that ends first turns the lamp off while the other still
+wants it on. Every lamp's upcoming windows (one-off schedules at their real
+times, recurring ones expanded over ``SCHEDULE_CONFLICT_HORIZON`` days) are
+kept in an ``IntervalIndex``: sorted by start, with the running maximum of
+the ends next to them. A lookup
+bisects that running maximum and then scans only windows that start before
+the queried end, which is O(log n + k) while the lamp's windows do not
+overlap each other (the invariant ``LampPostSchedulSerializer`` enforces).
+
+Windows that reach past the horizon are also checked against the recurring
+schedules expanded over just that window, so a one-off schedule months ahead
+still meets the daily one it overlaps.
+
+Indexes are built with one query per lamp. ``schedule_indexes`` caches them
+per process for read-only listings; ``Places_Lamp.signals`` only drops the
+entries of edits made in the same process, so validation builds a fresh
+index instead.
+"""
+import bisect
+import itertools
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils.timezone import now
+
+from .models import UserSchedule
+from .recurrence import windows
+
+
+class IntervalIndex:
+    """Static set of half-open ``(start, end, key)`` intervals."""
+
+    def __init__(self, intervals):
+        self._items = sorted(intervals)
+        # _reach[i] is the latest end among the first i + 1 intervals
+        self._reach = list(itertools.accumulate((end for _, end, _ in self._items), max))
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def overlapping(self, start, end):
+        """Yield the intervals that overlap ``[start, end)``."""
+        # every interval before this one ends by ``start``
+        index = bisect.bisect_right(self._reach, start)
+        items = self._items
+        while index < len(items) and items[index][0] < end:
+            if items[index][1] > start:
+                yield items[index]
+            index += 1
+
+
+class ScheduleIndex:
+    """Upcoming windows of every schedule attached to one lamp."""
+
+    def __init__(self, lamp_id, start=None, horizon=None):
+        self.lamp_id = lamp_id
+        self.start = start or now()
+        self.end = self.start + (horizon or conflict_horizon())
+        schedules = list(
+            UserSchedule.objects.filter(lampschedul__lamp_id=lamp_id, next_fire_at__isnull=False).distinct()
+        )
+        # only these are cut off at the horizon
+        self.recurring = [schedule for schedule in schedules if schedule.recurrence]
+        self.index = IntervalIndex(
+            (on, off, schedule.pk) for schedule in schedules for on, off in self.schedule_windows(schedule)
+        )
+
+    def schedule_windows(self, schedule, start=None, end=None):
+        if end is None:
+            # a one-off schedule is indexed where it is, however far ahead
+            end = self.end if schedule.recurrence else max(self.end, schedule.off_time)
+        return windows(
+            schedule.on_time, schedule.off_time, schedule.recurrence, schedule.timezone, start or self.start, end
+        )
+
+    def overlapping(self, start, end):
+        """Indexed windows overlapping ``[start, end)``, plus recurring ones past the horizon."""
+        yield from self.index.overlapping(start, end)
+        if end > self.end:
+            for schedule in self.recurring:
+                for on, off in self.schedule_windows(schedule, max(start, self.end), end):
+                    yield on, off, schedule.pk
+
+    def conflicts_with(self, schedule):
+        """``{schedule_id: (start, end)}`` of the first overlap with each other schedule."""
+        found = {}
+        for on, off in self.schedule_windows(schedule):
+            for other_on, other_off, other in self.overlapping(on, off):
+                if other != schedule.pk and other not in found:
+                    found[other] = (max(on, other_on), min(off, other_off))
+        return found
+
+    def conflicts(self):
+        """Every conflicting pair once, as ``[(first_id, second_id, start, end)]`` by start."""
+        found = {}
+        for on, off, key in self.index:
+            for other_on, other_off, other in self.overlapping(on, off):
+                pair = (min(key, other), max(key, other))
+                if key != other and pair not in found:
+                    found[pair] = (max(on, other_on), min(off, other_off))
+        return sorted(
+            ((first, second, start, end) for (first, second), (start, end) in found.items()),
+            key=lambda conflict: conflict[2],
+        )
+
+
+def conflict_horizon():
+    return timedelta(days=getattr(settings, "SCHEDULE_CONFLICT_HORIZON", 28))
+
+
+class ScheduleIndexCache:
+    """
+    LRU of ``lamp_id -> ScheduleIndex``; an index is rebuilt after half its
+    horizon. Edits made by other processes do not reach it.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size if max_size is not None else getattr(settings, "SCHEDULE_INDEX_CACHE_SIZE", 1000)
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, lamp_id):
+        current = now()
+        with self._lock:
+            index = self._indexes.get(lamp_id)
+            if index is not None and current - index.start < (index.end - index.start) / 2:
+                self._indexes.move_to_end(lamp_id)
+                return index
+        index = ScheduleIndex(lamp_id, start=current)
+        if self.max_size > 0:
+            with self._lock:
+                self._indexes[lamp_id] = index
+                while len(self._indexes) > self.max_size:
+                    self._indexes.popitem(last=False)
+        return index
+
+    def forget(self, lamp_ids=None):
+        """Drop the indexes of ``lamp_ids`` (all of them when None)."""
+        with self._lock:
+            if lamp_ids is None:
+                self._indexes.clear()
+                return
+            for lamp_id in lamp_ids:
+                self._indexes.pop(lamp_id, None)
+
+
+schedule_indexes = ScheduleIndexCache()
@@ -2,7 +2,6 @@ from rest_framework.serializers import ModelSerializer
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from .models import * 
-from django.db.models import Q
 from drf_spectacular.utils import extend_schema_field
 
 @extend_schema_field(serializers.IntegerField)
@@ -29,7 +28,7 @@ class HomePostSerializer(ModelSerializer) :
         owner = getattr(request, "user", None)
         name = attrs.get("name")
         if owner and owner.is_authenticated and name:
-            exists = Home.objects.filter(owner=owner, name=name).exists()
+            exists = Home.objects.filter(owner_id=owner.id, name=name).exists()
             if exists:
                 raise serializers.ValidationError(
                     {"name": "You already have a home with this name."}
@@ -56,7 +55,7 @@ class RoomPostSerializer(ModelSerializer) :
         request = self.context["request"]
         if (request and request.user.is_authenticated) : 
             user = request.user
-            self.fields["home"].queryset = Home.objects.filter(owner=user)
+            self.fields["home"].queryset = Home.objects.filter(owner_id=user.id)
 
 class RoomVIewSerializer(ModelSerializer) : 
     home = serializers.CharField(source = "home.name")
@@ -91,7 +90,7 @@ class LampPostSerializer(ModelSerializer) :
         request = self.context["request"]
         if (request and request.user.is_authenticated) : 
             user = request.user
-            self.fields["room"].queryset = Room.objects.filter(home__owner=user)
+            self.fields["room"].queryset = Room.objects.filter(home__owner_id=user.id)
     
 
 
@@ -107,11 +106,22 @@ class LampPostSchedulSerializer(ModelSerializer) :
         request = self.context["request"]
         if (request and request.user.is_authenticated) : 
             user = request.user
-            self.fields["user_schedul"].queryset = UserSchedule.objects.filter(owner=user)
-            self.fields["lamp"].queryset = Lamp.objects.filter(
-                Q(room__home__owner=user) | 
-                Q(shared_with = user)
-            ).distinct()
+            self.fields["user_schedul"].queryset = UserSchedule.objects.filter(owner_id=user.id)
+            self.fields["lamp"].queryset = Lamp.objects.accessible_by(user)
+    def validate(self, attrs):
+        """
+        Reject a schedule whose windows overlap another schedule of the lamp.
+        The index is read from the DB: the per-process cache misses
+        attachments made through other workers.
+        """
+        from .schedule_index import ScheduleIndex
+        conflicts = ScheduleIndex(attrs["lamp"].pk).conflicts_with(attrs["user_schedul"])
+        if conflicts:
+            ids = ", ".join(str(schedule_id) for schedule_id in sorted(conflicts))
+            raise serializers.ValidationError(
+                {"user_schedul": f"Overlaps schedule(s) {ids} already attached to this lamp."}
+            )
+        return attrs
 
 
 class LampViewSchedulSerializer(ModelSerializer) : 
@@ -122,7 +132,17 @@ class LampViewSchedulSerializer(ModelSerializer) :
 class UserSchedulPost(ModelSerializer) : 
     class Meta  : 
         model = UserSchedule
-        fields = ["id" , "on_time" , "off_time"]
+        fields = ["id" , "on_time" , "off_time" , "recurrence" , "timezone"]
+    def validate(self, attrs):
+        """
+        Off after on, and a recurring schedule off before its next occurrence.
+        """
+        from django.core.exceptions import ValidationError as DjangoValidationError
+        try:
+            UserSchedule(**attrs).clean()
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.messages)
+        return attrs
 class UserSchedulView(ModelSerializer) : 
     class Meta : 
         model = UserSchedule
@@ -1,15 +1,16 @@
-import time
-
-import paho.mqtt.publish as publish
-from django.conf import settings
-
 from Places_Lamp.models import Lamp
+from MQTT.confirmations import confirmations
+from MQTT.publisher import get_publisher
 from VoiceAgent.services import exceptions as exc
 
 
+# Seconds to wait for the device to report the requested status.
+CONFIRMATION_TIMEOUT = 5.0
+
+
 def set_lamp_status(*, user, lamp: Lamp, desired_status: bool):
     """
-    Core MQTT + DB polling logic extracted from the REST view so it can be
+    Core MQTT + confirmation logic extracted from the REST view so it can be
     reused by the voice agent.
     """
     if not lamp.can_access(user):
@@ -20,36 +21,34 @@ def set_lamp_status(*, user, lamp: Lamp, desired_status: bool):
     payload = "ON" if desired_status else "OFF"
     topic = f"Devices/{lamp.token}/command"
 
-    try:
-        publish.single(
-            topic, payload, hostname=settings.MQTT_BROKER, port=settings.MQTT_PORT
-        )
-        print(f"MQTT PUB → {user.username} → {topic}={payload}", flush=True)
-    except Exception as e:  # pragma: no cover - network failure path
+    # Register for the device's status report before publishing so the
+    # answer cannot slip past us; the bridge wakes the waiter directly.
+    with confirmations.expect(lamp.token, desired_status) as waiter:
+        try:
+            get_publisher().publish(topic, payload)
+            print(f"MQTT PUB → {user.username} → {topic}={payload}", flush=True)
+        except Exception as e:  # pragma: no cover - network failure path
+            raise exc.DomainActionError(
+                f"Lamp status updated locally but MQTT publish failed: {e}",
+                status_code=200,
+            )
+
+        confirmed = waiter.wait(CONFIRMATION_TIMEOUT)
+
+    refreshed = Lamp.objects.select_related("room__home").get(pk=lamp.pk)
+    # A missed notification (e.g. channel layer hiccup) still counts if the
+    # bridge persisted the desired state in the meantime.
+    if not confirmed and bool(refreshed.status) != bool(desired_status):
         raise exc.DomainActionError(
-            f"Lamp status updated locally but MQTT publish failed: {e}",
-            status_code=200,
+            "Lamp status command timed out without device confirmation.", status_code=504
         )
 
-    deadline = time.time() + 5.0
-
-    while time.time() < deadline:
-        time.sleep(0.5)
-        refreshed = Lamp.objects.get(pk=lamp.pk)
-        if bool(refreshed.status) == bool(desired_status):
-            return {
-                "id": refreshed.id,
-                "name": refreshed.name,
-                "status": bool(refreshed.status),
-                "room_id": refreshed.room.id,
-                "room_name": refreshed.room.name,
-                "home_id": refreshed.room.home.id,
-                "home_name": refreshed.room.home.name,
-            }
-
-    current = Lamp.objects.get(pk=lamp.pk)
-    raise exc.DomainActionError(
-        "Lamp status command timed out without device confirmation.", status_code=504
-    )
-
-
+    return {
+        "id": refreshed.id,
+        "name": refreshed.name,
+        "status": bool(desired_status),
+        "room_id": refreshed.room.id,
+        "room_name": refreshed.room.name,
+        "home_id": refreshed.room.home.id,
+        "home_name": refreshed.room.home.name,
+    }
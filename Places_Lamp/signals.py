@@ -0,0 +1,106 @@
+"""Keep the LampAccess table in step with homes, rooms, lamps and shares.
+
+Share changes add or delete exactly the affected rows. Structural changes
+(a lamp created or moved, a room moved to another home, a home's owner
+changed) re-sync the rows of the lamps involved. Deletes are handled by the
+foreign keys' CASCADE.
+
+These receivers are connected before MQTT.signals (Places_Lamp comes first in
+INSTALLED_APPS), so the access change announcements there read the new rows.
+
+Schedule attachments and edits drop the affected lamps' cached schedule
+indexes (Places_Lamp.schedule_index).
+"""
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Home, Lamp, LampAccess, LampSchedul, Room, UserSchedule
+from .schedule_index import schedule_indexes
+
+
+# Saves that only touch device state cannot change who sees the lamp.
+STATE_FIELDS = frozenset({"status", "connection", "state_seq"})
+
+
+def _lamps_in_homes(home_ids):
+    return list(Lamp.objects.filter(room__home_id__in=home_ids).values_list("id", flat=True))
+
+
+@receiver(post_save, sender=Lamp)
+def lamp_access_lamp_saved(sender, instance, created, update_fields=None, raw=False, **kwargs):
+    if raw or (update_fields and STATE_FIELDS.issuperset(update_fields)):
+        return
+    LampAccess.sync([instance.pk])
+
+
+@receiver(post_save, sender=Room)
+def lamp_access_room_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        # the room may have moved to another home
+        LampAccess.sync(instance.lamps.values_list("id", flat=True))
+
+
+@receiver(post_save, sender=Home)
+def lamp_access_home_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        # the owner may have changed
+        LampAccess.sync(_lamps_in_homes([instance.pk]))
+
+
+@receiver(m2m_changed, sender=Lamp.shared_with.through)
+def lamp_access_lamp_shares(sender, instance, action, reverse, pk_set, **kwargs):
+    via = LampAccess.VIA_LAMP
+    if action == "post_add":
+        if reverse:
+            LampAccess.grant((instance.pk, lamp_id, via) for lamp_id in pk_set)
+        else:
+            LampAccess.grant((user_id, instance.pk, via) for user_id in pk_set)
+    elif action == "post_remove":
+        if reverse:
+            LampAccess.objects.filter(user_id=instance.pk, lamp_id__in=pk_set, via=via).delete()
+        else:
+            LampAccess.objects.filter(lamp_id=instance.pk, user_id__in=pk_set, via=via).delete()
+    elif action == "post_clear":
+        if reverse:
+            LampAccess.objects.filter(user_id=instance.pk, via=via).delete()
+        else:
+            LampAccess.objects.filter(lamp_id=instance.pk, via=via).delete()
+
+
+@receiver(m2m_changed, sender=Home.shared_with.through)
+def lamp_access_home_shares(sender, instance, action, reverse, pk_set, **kwargs):
+    via = LampAccess.VIA_HOME
+    if action == "post_add":
+        if reverse:
+            LampAccess.grant((instance.pk, lamp_id, via) for lamp_id in _lamps_in_homes(pk_set))
+        else:
+            lamp_ids = _lamps_in_homes([instance.pk])
+            LampAccess.grant((user_id, lamp_id, via) for user_id in pk_set for lamp_id in lamp_ids)
+    elif action == "post_remove":
+        if reverse:
+            LampAccess.objects.filter(
+                user_id=instance.pk, lamp__room__home_id__in=pk_set, via=via
+            ).delete()
+        else:
+            LampAccess.objects.filter(
+                user_id__in=pk_set, lamp__room__home_id=instance.pk, via=via
+            ).delete()
+    elif action == "post_clear":
+        if reverse:
+            LampAccess.objects.filter(user_id=instance.pk, via=via).delete()
+        else:
+            LampAccess.objects.filter(lamp__room__home_id=instance.pk, via=via).delete()
+
+
+@receiver(post_save, sender=LampSchedul)
+@receiver(post_delete, sender=LampSchedul)
+def schedule_index_attachment_changed(sender, instance, **kwargs):
+    schedule_indexes.forget([instance.lamp_id])
+
+
+@receiver(post_save, sender=UserSchedule)
+def schedule_index_schedule_saved(sender, instance, created, update_fields=None, raw=False, **kwargs):
+    if created or raw or (update_fields and {"next_fire_at", "next_status"}.issuperset(update_fields)):
+        return
+    # the windows may have moved
+    schedule_indexes.forget(LampSchedul.objects.filter(user_schedul=instance).values_list("lamp_id", flat=True))
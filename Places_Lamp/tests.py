@@ -1,3 +1,238 @@
-from django.test import TestCase
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import Home, Room, Lamp, LampAccess, LampSchedul, UserSchedule
+from .recurrence import next_transition
+from .schedule_index import IntervalIndex, schedule_indexes
+
+
+class LampAccessTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        self.friend = User.objects.create_user(username="bob", password="pass", phone_number="2")
+        self.guest = User.objects.create_user(username="carol", password="pass", phone_number="3")
+        self.stranger = User.objects.create_user(username="dave", password="pass", phone_number="4")
+        self.home = Home.objects.create(owner=self.owner, name="Main Home")
+        room = Room.objects.create(home=self.home, name="Hall")
+        self.lamp = Lamp.objects.create(room=room, name="Ceiling")
+        self.other = Lamp.objects.create(room=room, name="Desk")
+        self.lamp.shared_with.add(self.friend, self.guest)
+        self.home.shared_with.add(self.guest)
+
+    def test_accessible_by_follows_every_path_without_duplicates(self):
+        def names(user):
+            return list(Lamp.objects.accessible_by(user).order_by("name").values_list("name", flat=True))
+
+        self.assertEqual(names(self.owner), ["Ceiling", "Desk"])
+        self.assertEqual(names(self.friend), ["Ceiling"])
+        # shared both directly and via the home, still listed once
+        self.assertEqual(names(self.guest), ["Ceiling", "Desk"])
+        self.assertEqual(names(self.stranger), [])
+
+    def test_can_access_uses_one_exists_query_and_memoises(self):
+        lamp = Lamp.objects.get(pk=self.lamp.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(lamp.can_access(self.friend))
+            self.assertTrue(lamp.can_access(self.friend))
+        with self.assertNumQueries(1):
+            self.assertFalse(lamp.can_access(self.stranger))
+
+    def test_can_access_answers_from_loaded_relations(self):
+        lamp = Lamp.objects.select_related("room__home").get(pk=self.lamp.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(lamp.can_access(self.owner))
+        lamp = (
+            Lamp.objects.select_related("room__home")
+            .prefetch_related("shared_with", "room__home__shared_with")
+            .get(pk=self.other.pk)
+        )
+        with self.assertNumQueries(0):
+            self.assertTrue(lamp.can_access(self.guest))
+            self.assertFalse(lamp.can_access(self.friend))
+
+
+class LampAccessTableTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        self.friend = User.objects.create_user(username="bob", password="pass", phone_number="2")
+        self.home = Home.objects.create(owner=self.owner, name="Main Home")
+        self.room = Room.objects.create(home=self.home, name="Hall")
+        self.lamp = Lamp.objects.create(room=self.room, name="Ceiling")
+
+    def rows(self):
+        return set(LampAccess.objects.values_list("user__username", "lamp__name", "via"))
+
+    def test_rows_follow_shares_and_moves(self):
+        self.assertEqual(self.rows(), {("alice", "Ceiling", "owner")})
+        self.lamp.shared_with.add(self.friend)
+        self.friend.shared_homes.add(self.home)
+        self.assertEqual(self.rows(), {
+            ("alice", "Ceiling", "owner"), ("bob", "Ceiling", "lamp"), ("bob", "Ceiling", "home"),
+        })
+        self.friend.shared_lamps.clear()
+        self.home.shared_with.remove(self.friend)
+        self.assertEqual(self.rows(), {("alice", "Ceiling", "owner")})
+
+        # moving the room to bob's home hands the lamp over
+        self.room.home = Home.objects.create(owner=self.friend, name="Cabin")
+        self.room.save()
+        self.assertEqual(self.rows(), {("bob", "Ceiling", "owner")})
+
+    def test_rebuild_matches_incremental_rows(self):
+        self.lamp.shared_with.add(self.friend)
+        self.home.shared_with.add(self.friend)
+        Lamp.objects.create(room=self.room, name="Desk")
+        incremental = self.rows()
+        self.assertEqual(LampAccess.rebuild(), len(incremental))
+        self.assertEqual(self.rows(), incremental)
+
+
+class RecurrenceTests(SimpleTestCase):
+    def test_weekday_rule_keeps_local_time_across_dst(self):
+        berlin = ZoneInfo("Europe/Berlin")
+        on = datetime(2026, 3, 27, 7, 0, tzinfo=berlin)  # Friday, UTC+1
+        off = on + timedelta(hours=1)
+        rule = "FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR"
+        at, status = next_transition(on, off, rule, "Europe/Berlin", after=on)
+        self.assertEqual((at, status), (off, False))
+        # the weekend is skipped and Monday is in summer time (UTC+2)
+        at, status = next_transition(on, off, rule, "Europe/Berlin", after=off)
+        self.assertTrue(status)
+        self.assertEqual(at.astimezone(berlin), datetime(2026, 3, 30, 7, 0, tzinfo=berlin))
+        self.assertEqual(at, datetime(2026, 3, 30, 5, 0, tzinfo=timezone.utc))
+
+    def test_interval_and_until(self):
+        on = datetime(2026, 1, 1, 20, 0, tzinfo=timezone.utc)
+        off = on + timedelta(hours=2)
+        rule = "FREQ=DAILY;INTERVAL=2;UNTIL=20260105"
+        self.assertEqual(next_transition(on, off, rule, after=off)[0], on + timedelta(days=2))
+        self.assertEqual(next_transition(on, off, rule, after=on + timedelta(days=4))[0], off + timedelta(days=4))
+        self.assertIsNone(next_transition(on, off, rule, after=off + timedelta(days=4)))
+
+    def test_one_off_schedule(self):
+        on = datetime(2026, 1, 1, 20, 0, tzinfo=timezone.utc)
+        off = on + timedelta(hours=2)
+        self.assertEqual(next_transition(on, off, after=on - timedelta(seconds=1)), (on, True))
+        self.assertEqual(next_transition(on, off, after=on), (off, False))
+        self.assertIsNone(next_transition(on, off, after=off))
+
+
+class UserScheduleRecurrenceTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="alice", password="pass", phone_number="1")
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+
+    def test_next_fire_at_is_kept_on_save(self):
+        on = datetime(2020, 1, 1, 7, 0, tzinfo=timezone.utc)
+        schedule = UserSchedule.objects.create(
+            owner=self.user, on_time=on, off_time=on + timedelta(hours=1), recurrence="FREQ=DAILY"
+        )
+        self.assertTrue(schedule.next_status)
+        self.assertEqual(schedule.next_fire_at.timetz(), on.timetz())
+        self.assertLess(schedule.next_fire_at - datetime.now(timezone.utc), timedelta(days=1))
+        schedule.recurrence = ""
+        schedule.save(update_fields=["recurrence"])
+        schedule.refresh_from_db()
+        self.assertIsNone(schedule.next_fire_at)
+        self.assertEqual(
+            list(UserSchedule.objects.firing_between(on, on + timedelta(days=1))), []
+        )
+
+    def test_api_validates_rules(self):
+        data = {"on_time": "2030-01-01T07:00:00Z", "off_time": "2030-01-01T08:00:00Z"}
+        resp = self.client.post("/Profile/user_schedul/", {**data, "recurrence": "FREQ=HOURLY"})
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.post("/Profile/user_schedul/", {**data, "timezone": "Mars/Olympus"})
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.post(
+            "/Profile/user_schedul/",
+            {"on_time": "2030-01-01T07:00:00Z", "off_time": "2030-01-02T08:00:00Z", "recurrence": "FREQ=DAILY"},
+        )
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.post(
+            "/Profile/user_schedul/", {**data, "recurrence": "FREQ=WEEKLY;BYDAY=MO,FR", "timezone": "Asia/Tehran"}
+        )
+        self.assertEqual(resp.status_code, 201)
+        schedule = UserSchedule.objects.get()
+        self.assertEqual(schedule.next_fire_at, datetime(2030, 1, 1, 7, 0, tzinfo=timezone.utc))
+
+
+class IntervalIndexTests(SimpleTestCase):
+    def test_overlapping_skips_everything_that_ends_before(self):
+        index = IntervalIndex([(0, 10, "a"), (10, 20, "b"), (20, 30, "c"), (5, 8, "nested")])
+        self.assertEqual([key for _, _, key in index.overlapping(9, 21)], ["a", "b", "c"])
+        self.assertEqual([key for _, _, key in index.overlapping(6, 7)], ["a", "nested"])
+        self.assertEqual(list(index.overlapping(30, 40)), [])
+
+
+class ScheduleConflictTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="alice", password="pass", phone_number="1")
+        room = Room.objects.create(home=Home.objects.create(owner=self.user, name="Home"), name="Hall")
+        self.lamp = Lamp.objects.create(room=room, name="Ceiling")
+        self.base = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(days=1)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+        schedule_indexes.forget()
+
+    def schedule(self, on_hours, off_hours, recurrence=""):
+        return UserSchedule.objects.create(
+            owner=self.user,
+            on_time=self.base + timedelta(hours=on_hours),
+            off_time=self.base + timedelta(hours=off_hours),
+            recurrence=recurrence,
+        )
+
+    def attach(self, schedule):
+        return self.client.post("/Profile/lamp_schedul/", {"lamp": self.lamp.pk, "user_schedul": schedule.pk})
+
+    def test_overlapping_attachment_is_rejected(self):
+        evening = self.schedule(18, 22)
+        self.assertEqual(self.attach(evening).status_code, 201)
+        self.assertEqual(self.attach(self.schedule(22, 23)).status_code, 201)
+        resp = self.attach(self.schedule(21, 21.5))
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn(str(evening.pk), resp.data["user_schedul"][0])
+        # a daily schedule runs into tomorrow's window of the one-off ones
+        resp = self.attach(self.schedule(-8, -7, recurrence="FREQ=DAILY"))
+        self.assertEqual(resp.status_code, 201)
+        resp = self.attach(self.schedule(-2, -1, recurrence="FREQ=DAILY"))
+        self.assertEqual(resp.status_code, 400)
+
+    def test_overlaps_past_the_horizon_are_rejected(self):
+        self.assertEqual(self.attach(self.schedule(40 * 24, 40 * 24 + 2)).status_code, 201)
+        self.assertEqual(self.attach(self.schedule(40 * 24 + 1, 40 * 24 + 3)).status_code, 400)
+        # a daily schedule is expanded over the candidate's own window
+        self.assertEqual(self.attach(self.schedule(-8, -7, recurrence="FREQ=DAILY")).status_code, 201)
+        self.assertEqual(self.attach(self.schedule(50 * 24 - 8, 50 * 24 - 6)).status_code, 400)
+
+    def test_attachments_made_by_other_processes_are_seen(self):
+        evening = self.schedule(18, 22)
+        schedule_indexes.get(self.lamp.pk)
+        # another worker's write: no signal reaches this process's cache
+        LampSchedul.objects.bulk_create([LampSchedul(lamp=self.lamp, user_schedul=evening)])
+        self.assertEqual(self.attach(self.schedule(21, 23)).status_code, 400)
+
+    def test_conflicts_endpoint_lists_each_pair_once(self):
+        first, second, third = self.schedule(0, 4), self.schedule(3, 5), self.schedule(6, 7)
+        for schedule in (first, second, third):
+            # attached before validation existed
+            LampSchedul.objects.create(lamp=self.lamp, user_schedul=schedule)
+        resp = self.client.get(f"/Profile/lamp/{self.lamp.pk}/schedule_conflicts/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([conflict["schedules"] for conflict in resp.data], [[first.pk, second.pk]])
+        self.assertEqual(resp.data[0]["start"], self.base + timedelta(hours=3))
+        self.assertEqual(resp.data[0]["end"], self.base + timedelta(hours=4))
+        # moving a schedule drops the cached index
+        second.on_time = self.base + timedelta(hours=4)
+        second.save()
+        resp = self.client.get(f"/Profile/lamp/{self.lamp.pk}/schedule_conflicts/")
+        self.assertEqual(resp.data, [])
@@ -1,55 +1,153 @@
+import threading
+import time
+from collections import OrderedDict
 from urllib.parse import parse_qs
 
-import jwt
 from asgiref.sync import sync_to_async
 from channels.auth import AuthMiddlewareStack
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from django.db.models.signals import post_delete, post_save
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+class TTLCache:
+    """Small thread-safe LRU map whose entries also expire after ``ttl`` seconds."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+# str(user id) -> active user
+user_cache = TTLCache(
+    getattr(settings, "WS_JWT_USER_CACHE_SIZE", 10000), getattr(settings, "WS_JWT_USER_CACHE_TTL", 60)
+)
+
+
+def cache_stats():
+    """Hit/miss counters of the handshake caches."""
+    return {"users": user_cache.stats()}
+
+
+def _forget_user(sender, instance, **kwargs):
+    # a deactivated or deleted user must not keep connecting from the cache
+    user_cache.discard(str(instance.pk))
+
+
+post_save.connect(_forget_user, sender=settings.AUTH_USER_MODEL, dispatch_uid="ws_jwt_forget_user_saved")
+post_delete.connect(_forget_user, sender=settings.AUTH_USER_MODEL, dispatch_uid="ws_jwt_forget_user_deleted")
 
 
 @sync_to_async
-def _get_user_from_token(token: str):
+def _load_user(user_id):
+    """DB part of a cache miss: the active user row."""
+    User = get_user_model()
+    try:
+        user = User.objects.get(pk=user_id)
+    except User.DoesNotExist:
+        return None
+    if not user.is_active:
+        return None
+    user_cache.set(str(user.pk), user)
+    return user
+
+
+async def _get_user_from_token(token: str):
     """
     Resolve a Django user instance from a SimpleJWT access token.
-    Returns AnonymousUser on any failure.
+    Returns AnonymousUser on any failure (bad signature, expired, unknown or
+    inactive user). Signature and expiry are checked in the event loop and
+    the user comes from a short TTL cache, so a reconnecting client normally
+    costs no thread hop and no query.
+
+    simplejwt's blacklist only records refresh tokens, so an access token
+    cannot be revoked: it is honoured until it expires
+    (``ACCESS_TOKEN_LIFETIME``). A deactivated user is dropped from this
+    process's cache at once and from other processes' within
+    ``WS_JWT_USER_CACHE_TTL``.
     """
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-        user_id = payload.get("user_id")
-        if not user_id:
-            return AnonymousUser()
-        User = get_user_model()
-        return User.objects.get(pk=user_id)
-    except Exception:
+        access = AccessToken(token)
+    except TokenError:
         return AnonymousUser()
+    user_id = access.get(api_settings.USER_ID_CLAIM)
+    if not user_id:
+        return AnonymousUser()
+    # the claim is a string in recent SimpleJWT versions
+    user = user_cache.get(str(user_id))
+    if user is None:
+        try:
+            user = await _load_user(user_id)
+        except Exception:
+            user = None
+    return user or AnonymousUser()
 
 
 def JWTAuthMiddlewareStack(inner):
     """
-    Middleware stack that first applies Django's session-based AuthMiddlewareStack
-    and then, if a ?token=<JWT> query parameter is present, overrides `scope["user"]`
-    with the user resolved from that JWT.
+    Authenticate WebSocket handshakes from a ?token=<JWT> query parameter,
+    falling back to Django's session-based AuthMiddlewareStack without one.
+    With a token the session is never loaded: it would be overridden anyway.
     """
 
     base_app = AuthMiddlewareStack(inner)
 
     async def app(scope, receive, send):
-        scope = dict(scope)
-
-        # Existing user from session/cookie auth
-        user = scope.get("user", AnonymousUser())
-
-        # Try to override with JWT if provided
+        # Try JWT first if provided
         query_string = scope.get("query_string", b"").decode()
         params = parse_qs(query_string)
         token = params.get("token", [None])[0]
 
-        if token:
-            user = await _get_user_from_token(token)
+        if not token:
+            # Existing user from session/cookie auth
+            return await base_app(scope, receive, send)
 
-        scope["user"] = user
-        return await base_app(scope, receive, send)
+        scope = dict(scope)
+        scope["user"] = await _get_user_from_token(token)
+        return await inner(scope, receive, send)
 
     return app
-
@@ -113,6 +113,25 @@ CHANNEL_LAYERS = {
         "CONFIG": {"hosts": [(REDIS_HOST, REDIS_PORT)]},
     },
 }
+# Seconds LightConsumer holds lamp updates so each socket gets only the latest
+# state per lamp, batched in one frame (0 sends every update immediately).
+LIGHT_WS_COALESCE_WINDOW = float(os.getenv("LIGHT_WS_COALESCE_WINDOW", 0.05))
+# Lamps with a live LightConsumer are tracked in Redis (MQTT.presence); the
+# bridge skips fan-out for the rest and caches each answer for a few seconds.
+PRESENCE_ENABLED = os.getenv("PRESENCE_ENABLED", "true").lower() == "true"
+PRESENCE_CACHE_SECONDS = float(os.getenv("PRESENCE_CACHE_SECONDS", 2.0))
+# open sockets refresh their presence this often; entries of workers that
+# died without disconnecting stop counting after a few missed heartbeats
+PRESENCE_HEARTBEAT_SECONDS = float(os.getenv("PRESENCE_HEARTBEAT_SECONDS", 60.0))
+PRESENCE_TTL = 3 * PRESENCE_HEARTBEAT_SECONDS
+# `run_scheduler` keeps the next SCHEDULER_HORIZON seconds of schedule
+# transitions in memory; edits reach it on the lamp_schedule group.
+SCHEDULER_HORIZON = int(os.getenv("SCHEDULER_HORIZON", 3600))
+SCHEDULER_MAX_SLEEP = 300
+# Schedule overlap checks (Places_Lamp/schedule_index.py) expand recurring
+# schedules this many days ahead and cache one index per lamp.
+SCHEDULE_CONFLICT_HORIZON = 28
+SCHEDULE_INDEX_CACHE_SIZE = 1000
 
 
 # Password validation
@@ -162,6 +181,34 @@ LOGIN_URL=""
 # Brocker cridentials
 MQTT_BROKER = "node.lilms.top"
 MQTT_PORT = 1883
+# Persistent connections kept open by MQTT.publisher for outgoing commands
+MQTT_PUBLISHER_POOL_SIZE = int(os.getenv("MQTT_PUBLISHER_POOL_SIZE", 2))
+MQTT_PUBLISHER_CONNECT_TIMEOUT = 5.0
+# `run_mqtt` bridge: asyncio mode, ORM thread pool size, in-flight bound and
+# the longest socket read pause (seconds) that bound may cause
+MQTT_BRIDGE_ASYNC = os.getenv("MQTT_BRIDGE_ASYNC", "false").lower() == "true"
+MQTT_BRIDGE_ORM_WORKERS = int(os.getenv("MQTT_BRIDGE_ORM_WORKERS", 4))
+MQTT_BRIDGE_MAX_IN_FLIGHT = 1000
+MQTT_BRIDGE_MAX_PAUSE = 10.0
+# Blocking bridge: shard threads (keyed by device token), bounded queue per
+# shard and how often queue depth/lag is logged (seconds, 0 = never)
+MQTT_BRIDGE_WORKERS = int(os.getenv("MQTT_BRIDGE_WORKERS", 4))
+MQTT_BRIDGE_QUEUE_SIZE = 1000
+MQTT_BRIDGE_STATS_INTERVAL = 60
+# Horizontal scaling: bridges subscribed as $share/<group>/Devices/+/status
+# (MQTT v5) split the fleet; `run_mqtt` starts MQTT_BRIDGE_INSTANCES of them.
+MQTT_SHARED_SUBSCRIPTION_GROUP = os.getenv("MQTT_SHARED_SUBSCRIPTION_GROUP", "")
+MQTT_BRIDGE_INSTANCES = int(os.getenv("MQTT_BRIDGE_INSTANCES", 1))
+# Ingest pipeline stages (see MQTT/ingest.py). LEGACY_FORWARD re-enables the
+# old second pass through MqttConsumer.mqtt_sub on the 'mqtt' channel.
+MQTT_INGEST_PERSIST = True
+MQTT_INGEST_FAN_OUT = True
+MQTT_INGEST_LEGACY_FORWARD = os.getenv("MQTT_INGEST_LEGACY_FORWARD", "false").lower() == "true"
+MQTT_INGEST_HOOKS = []
+# Bridge write-behind: seconds between status/connection flushes (0 writes
+# every message immediately) and the lamp count that forces an early flush.
+MQTT_WRITE_BEHIND_INTERVAL = float(os.getenv("MQTT_WRITE_BEHIND_INTERVAL", 1.0))
+MQTT_WRITE_BEHIND_MAX_BATCH = int(os.getenv("MQTT_WRITE_BEHIND_MAX_BATCH", 500))
 
 
 
@@ -194,8 +241,16 @@ SIMPLE_JWT = {
     # Optionally allow the use of Blacklisting (recommended)
     "ROTATE_REFRESH_TOKENS": True,
     "BLACKLIST_AFTER_ROTATION": True,
+
+    # Put the username in the tokens so LazyJWTAuthentication needs no user row
+    "TOKEN_OBTAIN_SERIALIZER": "User.authentication.TokenObtainPairWithUsernameSerializer",
 }
 
+# WebSocket handshakes with ?token= (SmartLight/channels_jwt_middleware.py)
+# resolve users from this per-process cache.
+WS_JWT_USER_CACHE_SIZE = 10000
+WS_JWT_USER_CACHE_TTL = int(os.getenv("WS_JWT_USER_CACHE_TTL", 60))
+
 # HTTPS/SSL Configuration
 # Trust the X-Forwarded-Proto header from nginx reverse proxy
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
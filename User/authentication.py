@@ -0,0 +1,87 @@
+from django.contrib.auth import get_user_model
+from django.db.models import Model
+from django.utils.functional import SimpleLazyObject
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.settings import api_settings
+
+
+class TokenObtainPairWithUsernameSerializer(TokenObtainPairSerializer):
+    """Login tokens that also carry the username, so LazyTokenUser can answer it."""
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token["username"] = user.username
+        return token
+
+
+class LazyTokenUser(SimpleLazyObject):
+    """
+    User built from a validated access token. ``id``/``pk``/``username`` and
+    the auth flags come from the claims; anything else (including
+    ``isinstance`` checks the ORM does when the object is used in a filter)
+    loads the real row once.
+    """
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id, claims):
+        User = get_user_model()
+        super().__init__(lambda: User.objects.get(pk=user_id))
+        # LazyObject forwards attribute writes to the wrapped user
+        self.__dict__["_user_id"] = User._meta.pk.to_python(user_id)
+        self.__dict__["_claims"] = claims
+
+    @property
+    def id(self):
+        return self.__dict__["_user_id"]
+
+    pk = id
+
+    @property
+    def username(self):
+        username = self.__dict__["_claims"].get("username")
+        if username is None:
+            return self.__getattr__("username")
+        return username
+
+    def get_username(self):
+        return self.username
+
+    def __bool__(self):
+        # permission classes test ``request.user`` for truth
+        return True
+
+    def __eq__(self, other):
+        if isinstance(other, LazyTokenUser):
+            return self.id == other.id
+        if isinstance(other, Model):
+            return other._meta.concrete_model is get_user_model()._meta.concrete_model and other.pk == self.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return str(self.username)
+
+
+class LazyJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that skips the user query: ``request.user`` is a
+    ``LazyTokenUser``. Views opt in with ``authentication_classes`` and should
+    filter on ``owner_id=request.user.id`` rather than ``owner=request.user``
+    to keep the row unloaded. A deactivated user keeps access until the
+    access token expires (``ACCESS_TOKEN_LIFETIME``).
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+        return LazyTokenUser(user_id, validated_token.payload)
@@ -1,3 +1,47 @@
+from django.contrib.auth import get_user_model
 from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
 
-# Create your tests here.
+from Places_Lamp.models import Home, Room, Lamp
+from User.authentication import LazyJWTAuthentication, LazyTokenUser
+
+
+class LazyJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(username="alice", password="pass", phone_number="1")
+        self.home = Home.objects.create(owner=self.user, name="Main Home")
+        self.lamp = Lamp.objects.create(room=Room.objects.create(home=self.home, name="Hall"), name="Ceiling")
+        self.client = APIClient()
+
+    def test_login_token_carries_username(self):
+        resp = self.client.post(reverse("login"), {"username": "alice", "password": "pass"})
+        self.assertEqual(AccessToken(resp.data["access"])["username"], "alice")
+
+    def test_list_endpoints_do_not_load_the_user(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+        # lamps, their room and shares; no query for the user row
+        with self.assertNumQueries(3):
+            resp = self.client.get("/Profile/lamp/")
+        self.assertEqual([lamp["name"] for lamp in resp.data], ["Ceiling"])
+        # homes, then owner_username and shares from the serializer
+        with self.assertNumQueries(3):
+            resp = self.client.get("/Profile/home/")
+        self.assertEqual([home["name"] for home in resp.data], ["Main Home"])
+
+    def test_token_user_loads_row_only_when_needed(self):
+        token = AccessToken.for_user(self.user)
+        token["username"] = "alice"
+        user = LazyJWTAuthentication().get_user(token)
+        with self.assertNumQueries(0):
+            self.assertIsInstance(user, LazyTokenUser)
+            self.assertEqual((user.id, user.pk, user.username), (self.user.id, self.user.id, "alice"))
+            self.assertTrue(user.is_authenticated)
+            self.assertEqual(user, self.user)
+        with self.assertNumQueries(1):
+            self.assertEqual(user.phone_number, "1")
+        with self.assertNumQueries(1):
+            # the ORM sees the loaded user, without loading it again
+            self.assertEqual(Home.objects.filter(owner=user).count(), 1)
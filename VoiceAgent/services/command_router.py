@@ -33,8 +33,8 @@ def _normalize_status(value: Any) -> bool:
 
 def _find_home(user, home_name: str) -> Home:
     qs = Home.objects.filter(
-        Q(owner=user, name__iexact=home_name)
-        | Q(shared_with=user, name__iexact=home_name)
+        Q(owner_id=user.id, name__iexact=home_name)
+        | Q(shared_with=user.id, name__iexact=home_name)
     ).distinct()
     count = qs.count()
     if count == 0:
@@ -80,7 +80,7 @@ def handle_create_home(user, command: Dict[str, Any]) -> Dict[str, Any]:
         context={"request": type("R", (), {"user": user})()},
     )
     serializer.is_valid(raise_exception=True)
-    home = serializer.save(owner=user)
+    home = serializer.save(owner_id=user.id)
     return {"action": "create_home", "home": {"id": home.id, "name": home.name}}
 
 
@@ -37,18 +37,15 @@ def build_user_context(user) -> Dict:
 
     # Homes owned by the user or shared with them.
     homes_qs = (
-        Home.objects.filter(owner=user)
-        | Home.objects.filter(shared_with=user)
+        Home.objects.filter(owner_id=user.id)
+        | Home.objects.filter(shared_with=user.id)
     ).distinct()[:MAX_HOMES]
 
     # Rooms within those homes.
     rooms_qs = Room.objects.filter(home__in=homes_qs).distinct()[:MAX_ROOMS]
 
     # Lamps the user can see (owned via home/room or shared).
-    lamps_qs = (
-        Lamp.objects.filter(room__home__in=homes_qs)
-        | Lamp.objects.filter(shared_with=user)
-    ).distinct()[:MAX_LAMPS]
+    lamps_qs = Lamp.objects.accessible_by(user).select_related("room__home")[:MAX_LAMPS]
 
     return {
         "homes": _serialize_homes(homes_qs),
@@ -1,3 +1,4 @@
+from rest_framework.authentication import SessionAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -5,6 +6,7 @@ from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework import status
 
 from drf_spectacular.utils import extend_schema
+from User.authentication import LazyJWTAuthentication
 
 from .services.context_builder import build_user_context
 from .services.gemini_client import transcribe_and_parse
@@ -22,6 +24,8 @@ class VoiceCommandView(APIView):
     """
 
     permission_classes = [IsAuthenticated]
+    # request.user is token-backed; the services only need user.id
+    authentication_classes = [LazyJWTAuthentication, SessionAuthentication]
     parser_classes = [MultiPartParser, FormParser]
 
     @extend_schema(
@@ -511,11 +511,14 @@ export const DashboardPage = () => {
 
     let socket: WebSocket | null = null
     let isUnmounted = false
+    // Newest state sequence received; reconnects ask only for what changed since.
+    let lastSeq: number | null = null
 
     const connect = () => {
       if (isUnmounted) return
 
-      socket = new WebSocket(wsWithAuth)
+      const sep = wsWithAuth.includes('?') ? '&' : '?'
+      socket = new WebSocket(lastSeq === null ? wsWithAuth : `${wsWithAuth}${sep}since=${lastSeq}`)
 
       socket.onopen = () => {
         // connection established
@@ -534,26 +537,58 @@ export const DashboardPage = () => {
 
       socket.onmessage = (event) => {
         try {
-          const data = JSON.parse(event.data) as {
-            token?: string
-            status?: boolean
-            establish?: boolean
+          type LampEvent = { token?: string; status?: boolean; establish?: boolean }
+          const data = JSON.parse(event.data) as LampEvent & {
+            type?: string
+            seq?: number
+            fields?: string[]
+            lamps?: unknown[][]
+            events?: LampEvent[]
           }
 
-          if (!data?.token) return
+          // Initial sync: every visible lamp (snapshot) or only those changed
+          // since our last sequence (delta), in one frame, one array per lamp.
+          if ((data?.type === 'snapshot' || data?.type === 'delta') && data.fields && data.lamps) {
+            // A snapshot on reconnect means lamps were added, removed or re-shared.
+            if (data.type === 'snapshot' && lastSeq !== null) {
+              queryClient.invalidateQueries({ queryKey: ['lamps'] })
+            }
+            if (typeof data.seq === 'number') lastSeq = data.seq
+            const col = (name: string) => data.fields!.indexOf(name)
+            const [tokenAt, statusAt, establishAt] = [col('token'), col('status'), col('establish')]
+            const byToken = new Map(data.lamps.map((row) => [row[tokenAt] as string, row]))
+            queryClient.setQueryData<LampView[]>(['lamps'], (prev) => {
+              if (!prev) return prev
+              return prev.map((lamp) => {
+                const row = lamp.token ? byToken.get(lamp.token) : undefined
+                return row
+                  ? { ...lamp, status: Boolean(row[statusAt]), connection: Boolean(row[establishAt]) }
+                  : lamp
+              })
+            })
+            return
+          }
+
+          // Live updates: one event, or the latest event per lamp of a short window.
+          const events = (data?.type === 'batch' ? data.events ?? [] : [data]).filter(
+            (update) => update?.token,
+          )
+          if (!events.length) return
+          const byToken = new Map(events.map((update) => [update.token, update]))
 
           queryClient.setQueryData<LampView[]>(['lamps'], (prev) => {
             if (!prev) return prev
-            return prev.map((lamp) =>
-              lamp.token === data.token
+            return prev.map((lamp) => {
+              const update = lamp.token ? byToken.get(lamp.token) : undefined
+              return update
                 ? {
                     ...lamp,
-                    status: typeof data.status === 'boolean' ? data.status : lamp.status,
+                    status: typeof update.status === 'boolean' ? update.status : lamp.status,
                     connection:
-                      typeof data.establish === 'boolean' ? data.establish : lamp.connection,
+                      typeof update.establish === 'boolean' ? update.establish : lamp.connection,
                   }
-                : lamp,
-            )
+                : lamp
+            })
           })
         } catch {
           // ignore malformed payloads